@@ -12,104 +12,93 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
-import xml.etree.ElementTree as elementTree
-
-from typing import Dict, List, Set
-
-
-def get_field_from_instance(instance, label):
-    for child in instance:
-        if child.tag == 'field' and child.attrib['label'] == label:
-            return child
-    assert False
-
-
-def get_sig_from_instance(instance, label):
-    for child in instance:
-        if child.tag == 'sig' and (child.attrib['label'].endswith('/' + label) or child.attrib['label'] == label):
-            return child
-    assert False
-
-
-def get_jump_relation(instance) -> Dict[str, List[str]]:
-    node_to_int_to_node: Dict[str, Dict[int, str]] = {}
-    for child in get_field_from_instance(instance, 'branch'):
-        if child.tag != 'tuple':
-            continue
-        assert len(child) == 3
-        assert child[0].tag == 'atom'
-        predecessor: str = child[0].attrib['label']
-        if predecessor not in node_to_int_to_node:
-            node_to_int_to_node[predecessor] = {}
-        value: Dict[int, str] = node_to_int_to_node[predecessor]
-        assert child[1].tag == 'atom'
-        index: int = int(child[1].attrib['label'])
-        assert index not in value
-        assert child[2].tag == 'atom'
-        value[index] = child[2].attrib['label']
-    result: Dict[str, List[str]] = {}
-    for key in node_to_int_to_node:
-        seq: List[str] = []
-        for index in range(0, len(node_to_int_to_node[key])):
-            seq.append(node_to_int_to_node[key][index])
-        result[key] = seq
-    return result
-
-
-def get_merge_relation(instance) -> Dict[str, str]:
-    result: Dict[str, str] = {}
-    for child in get_field_from_instance(instance, 'merge'):
-        if child.tag != 'tuple':
-            continue
-        result[child[0].attrib['label']] = child[1].attrib['label']
-    return result
-
-
-def get_continue_relation(instance) -> Dict[str, str]:
-    result: Dict[str, str] = {}
-    for child in get_field_from_instance(instance, 'continue'):
-        if child.tag != 'tuple':
-            continue
-        result[child[0].attrib['label']] = child[1].attrib['label']
-    return result
-
-
-def get_entry_block(instance) -> str:
-    for child in get_sig_from_instance(instance, 'EntryBlock'):
-        if child.tag == 'atom':
-            return child.attrib['label']
-    assert False
-
-    
-def get_regular_blocks(instance) -> Set[str]:
-    result: Set[str] = set()
-    for child in get_sig_from_instance(instance, 'Block'):
-        result.add(child.attrib['label'])
-    return result
-
-
-def get_loop_header_blocks(instance) -> Set[str]:
-    result: Set[str] = set()
-    for child in get_sig_from_instance(instance, 'LoopHeader'):
-        result.add(child.attrib['label'])
-    return result
-
-
-def get_selection_header_blocks(instance) -> Set[str]:
-    result: Set[str] = set()
-    for child in get_sig_from_instance(instance, 'SelectionHeader'):
-        result.add(child.attrib['label'])
-    return result
-
-
-def get_switch_blocks(instance) -> Set[str]:
-    result: Set[str] = set()
-    for child in get_sig_from_instance(instance, 'SwitchBlock'):
-        if child.tag != 'atom':
-            continue
-        result.add(child.attrib['label'])
-    return result
+import xml.parsers.expat as expat
+
+from typing import Dict, List, Optional, Set, Tuple
+
+# The format of the cache files is shared with fleshing/fleshout.py, which writes them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "fleshing"))
+import cfg_cache_format
+
+
+class CFGRelationsReader:
+    # The handler of a single pass of expat over an Alloy instance, which keeps the atoms of the tuples of the fields,
+    # and the atoms of the sigs, that a CFG is built from, and nothing else. The first field or sig with a name is read.
+    FIELDS: List[str] = ['branch', 'merge', 'continue']
+    SIGS: List[str] = ['EntryBlock', 'Block', 'LoopHeader', 'SelectionHeader', 'SwitchBlock']
+
+    def __init__(self) -> None:
+        self.num_instances: int = 0
+        self.fields: Dict[str, List[List[str]]] = {}
+        self.sigs: Dict[str, List[str]] = {}
+        # The tuples of the field being read, and the atoms of the tuple or sig being read
+        self.tuples: Optional[List[List[str]]] = None
+        self.atoms: Optional[List[str]] = None
+
+    def start_element(self, tag: str, attributes: Dict[str, str]) -> None:
+        if tag == 'atom':
+            if self.atoms is not None:
+                self.atoms.append(attributes['label'])
+        elif tag == 'tuple':
+            if self.tuples is not None:
+                self.atoms = []
+                self.tuples.append(self.atoms)
+        elif tag == 'field' or tag == 'sig' or tag == 'skolem':
+            self.tuples = None
+            self.atoms = None
+            if tag == 'field' and attributes['label'] in self.FIELDS and attributes['label'] not in self.fields:
+                self.tuples = self.fields[attributes['label']] = []
+            elif tag == 'sig':
+                for name in self.SIGS:
+                    if (attributes['label'].endswith('/' + name) or attributes['label'] == name) and name not in self.sigs:
+                        self.atoms = self.sigs[name] = []
+                        break
+        elif tag == 'instance':
+            self.num_instances += 1
+
+    def get_jump_relation(self) -> Dict[str, List[str]]:
+        node_to_int_to_node: Dict[str, Dict[int, str]] = {}
+        for atoms in self.fields['branch']:
+            assert len(atoms) == 3
+            value: Dict[int, str] = node_to_int_to_node.setdefault(atoms[0], {})
+            index: int = int(atoms[1])
+            assert index not in value
+            value[index] = atoms[2]
+        return dict((key, [value[index] for index in range(0, len(value))]) for key, value in node_to_int_to_node.items())
+
+    def get_relations(self) -> Tuple:
+        # The relations in the order of the arguments of CFG
+        assert self.num_instances == 1
+        assert all(name in self.fields for name in self.FIELDS) and all(name in self.sigs for name in self.SIGS)
+        assert len(self.sigs['EntryBlock']) > 0
+        return (self.get_jump_relation(),
+                dict((atoms[0], atoms[1]) for atoms in self.fields['merge']),
+                dict((atoms[0], atoms[1]) for atoms in self.fields['continue']),
+                self.sigs['EntryBlock'][0],
+                set(self.sigs['Block']),
+                set(self.sigs['LoopHeader']),
+                set(self.sigs['SelectionHeader']),
+                set(self.sigs['SwitchBlock']))
+
+
+def stream_cfg_relations(xml_file) -> Tuple:
+    # The relations a CFG is built from, read in a single pass over the xml file that builds no elements, so that the
+    # skolems and unused sigs of large instances are skipped as they are parsed
+    reader = CFGRelationsReader()
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = reader.start_element
+    with open(xml_file, 'rb') as f:
+        parser.ParseFile(f)
+    return reader.get_relations()
+
+
+def read_cfg_cache_relations(xml_file) -> Optional[Tuple]:
+    # The relations of the CFG from the cache file that fleshing/fleshout.py writes next to the xml file, or None if
+    # there is none that is up to date. The analyses in the cache file are not used, so their version does not matter.
+    decoder = cfg_cache_format.read_cfg_cache_file(xml_file)
+    return decoder.read_relations() if decoder is not None else None
 
 
 class CFG:
@@ -301,22 +290,7 @@ def main():
     if len(sys.argv) != 2:
         print("Usage: " + sys.argv[0] + " <xml file>")
         sys.exit(1)
-    tree = elementTree.parse(sys.argv[1])
-
-    alloy = tree.getroot()
-    assert alloy.tag == "alloy"
-    assert len(alloy) == 1
-    instance = alloy[0]
-    assert instance.tag == "instance"
-
-    cfg = CFG(get_jump_relation(instance),
-              get_merge_relation(instance),
-              get_continue_relation(instance),
-              get_entry_block(instance),
-              get_regular_blocks(instance),
-              get_loop_header_blocks(instance),
-              get_selection_header_blocks(instance),
-              get_switch_blocks(instance))
+    cfg = CFG(*(read_cfg_cache_relations(sys.argv[1]) or stream_cfg_relations(sys.argv[1])))
     print(cfg.to_string())
 
 
@@ -31,9 +31,11 @@ logger = logging.getLogger(__name__)
 DEFAULT_AMBER_TIMEOUT = 10
 
 def execute_amber_on_host(amber_path: Path, amber_file_path: Path, timeout: int = DEFAULT_AMBER_TIMEOUT) -> AmberResult:
-    cmd = [amber_path, "-d", "-t", "spv1.3", "-v", "1.1", amber_file_path]
+    cmd = [amber_path, "-d", "-t", "spv1.3", "-v", "1.1", os.path.abspath(amber_file_path)]
     try:
-        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+        # Buffer files are referenced relative to the amber file, so amber is run from the folder containing it
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout,
+                                 cwd=os.path.dirname(os.path.abspath(amber_file_path)))
         return AmberResult(amber_file_path, process.returncode, process.stdout, process.stderr)
     except subprocess.TimeoutExpired as e:
         logger.error(traceback.format_exc())
@@ -51,6 +53,10 @@ def execute_amber_folder(amber_exec_path: Path, amber_folder: Path, use_android:
         amber_results.append(res)
         if res.return_code != 0:
             logger.info(res)
+            for member in amber_utils.find_failing_packed_members(amber_file_path, res.stdout + res.stderr):
+                logger.info(f"Failing packed test: {member}")
+            for test in amber_utils.find_failing_merged_tests(amber_file_path, res.stdout + res.stderr):
+                logger.info(f"Failing merged test: {test}. It can be split out with amber_utils split.")
     return amber_results
 
 
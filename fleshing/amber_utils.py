@@ -13,14 +13,17 @@
 # limitations under the License.
 
 import fleshing_runner
+import hashlib
+import json
 import os
 import pathlib
+import re
 import shutil
 import statistics
 
 from argparse import ArgumentParser
 from pathlib import Path
-from typing import Dict, FrozenSet, Set, Tuple
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
 
 
 def get_amber_files(folder):
@@ -30,6 +33,38 @@ def get_amber_files(folder):
                 yield os.path.join(root, file)
 
 
+def get_buffer_files(amber_file) -> List[str]:
+    # The binary files that buffers of the amber file are loaded from. These are stored next to the amber file.
+    buffer_files = []
+    with open(amber_file, 'r') as f:
+        for line in f:
+            if " FILE BINARY " in line:
+                buffer_file = os.path.join(os.path.dirname(amber_file), line.split()[-1])
+                if buffer_file not in buffer_files:
+                    buffer_files.append(buffer_file)
+    return buffer_files
+
+
+def copy_amber_file(amber_file, dst_folder, prefix, buffer_files: Optional[List[str]] = None):
+    # The buffer files are found by reading the amber file, unless they are given
+    if buffer_files is None:
+        buffer_files = get_buffer_files(amber_file)
+    new_file_name = os.path.join(dst_folder, prefix + os.path.basename(amber_file))
+    if len(buffer_files) == 0:
+        shutil.copyfile(amber_file, new_file_name)
+        return
+
+    # The buffer files are renamed along with the amber file, so the references to them need to be updated too
+    with open(amber_file, 'r') as f:
+        lines = f.readlines()
+    for buffer_file in buffer_files:
+        buffer_file_name = os.path.basename(buffer_file)
+        shutil.copyfile(buffer_file, os.path.join(dst_folder, prefix + buffer_file_name))
+        lines = [line.replace(" FILE BINARY " + buffer_file_name + "\n", " FILE BINARY " + prefix + buffer_file_name + "\n") for line in lines]
+    with open(new_file_name, 'w') as f:
+        f.writelines(lines)
+
+
 def copy_amber_files(src_folder, dst_folder):
     for test_folder in fleshing_runner.get_test_folders(src_folder):
         full_test_folder_path = os.path.join(src_folder, test_folder)
@@ -37,20 +72,72 @@ def copy_amber_files(src_folder, dst_folder):
             full_file_path = os.path.join(full_test_folder_path, file)
             if not os.path.isfile(full_file_path) or not file.endswith(".amber"):
                 continue
-            new_file_name = os.path.join(dst_folder, test_folder + "_" + file)
-            shutil.copyfile(full_file_path, new_file_name)
+            copy_amber_file(full_file_path, dst_folder, test_folder + "_")
+
+
+def copy_amber_files_from_manifest(src_folder, dst_folder):
+    # As copy_amber_files, but finding the amber files and their buffer files from the generation manifest
+    for entry in read_generation_manifest(src_folder):
+        amber_file = os.path.join(src_folder, entry["amber_file"])
+        test_folder = pathlib.PurePath(entry["amber_file"]).parts[0]
+        copy_amber_file(amber_file, dst_folder, test_folder + "_", [os.path.join(os.path.dirname(amber_file), buffer_file) for buffer_file in entry["buffer_files"]])
+
+
+GENERATION_MANIFEST_FILE = "manifest.jsonl"
+
+
+def get_generation_manifest_file(xml_folder) -> str:
+    return os.path.join(xml_folder, GENERATION_MANIFEST_FILE)
+
+
+def get_path_hash(path: str) -> str:
+    return hashlib.sha256(path.strip().encode()).hexdigest()[:16]
+
+
+def read_generation_manifest(xml_folder) -> List[Dict]:
+    # The entries of the generation manifest that fleshing_runner appends to, one per amber file. The name of an amber
+    # file is made from its xml file, seed and dispatch shape, so if it was generated more than once, its last entry is
+    # the one that describes it.
+    entries: Dict[str, Dict] = {}
+    with open(get_generation_manifest_file(xml_folder), 'r') as f:
+        for line in f:
+            if line.strip() != "":
+                entry = json.loads(line)
+                entries[entry["amber_file"]] = entry
+    return list(entries.values())
+
+
+def compact_generation_manifest(xml_folder):
+    # Rewrites the generation manifest with only the last entry of each amber file
+    write_generation_manifest(xml_folder, read_generation_manifest(xml_folder))
+
+
+def write_generation_manifest(xml_folder, entries: List[Dict]):
+    with open(get_generation_manifest_file(xml_folder), 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
 
 
 def path_stats(amber_folder) -> Tuple[float, float, int, int, float, float, int]:
-    all_paths: Dict[str, FrozenSet[str]] = {}
+    return compute_path_stats(dict((str(file), find_paths(file)) for file in get_amber_files(amber_folder)))
+
+
+def manifest_path_stats(xml_folder) -> Tuple[float, float, int, int, float, float, int]:
+    entries = read_generation_manifest(xml_folder)
+    return summarise_path_stats([len(entry["path_hashes"]) for entry in entries], [len(entry["barrier_blocks"]) for entry in entries])
+
+
+def compute_path_stats(all_paths: Dict[str, FrozenSet[str]]) -> Tuple[float, float, int, int, float, float, int]:
     unique_barriers_in_file: Dict[str, int] = {}
-    for file in get_amber_files(amber_folder):
-        paths: FrozenSet[str] = find_paths(file)
-        all_paths[str(file)] = paths
-        unique_barriers_in_file[str(file)] = len(set().union(*[get_barrier_blocks(path) for path in paths]))
-    
-    lengths = [len(paths) for paths in all_paths.values()]
-    return statistics.mean(lengths), statistics.median(lengths), max(lengths), len(all_paths), statistics.mean(unique_barriers_in_file.values()), statistics.median(unique_barriers_in_file.values()), max(unique_barriers_in_file.values())
+    for file, paths in all_paths.items():
+        unique_barriers_in_file[file] = len(set().union(*[get_barrier_blocks(path) for path in paths]))
+    return summarise_path_stats([len(paths) for paths in all_paths.values()], list(unique_barriers_in_file.values()))
+
+
+def summarise_path_stats(num_unique_paths: List[int], num_unique_barriers: List[int]) -> Tuple[float, float, int, int, float, float, int]:
+    # The mean, median and maximum number of unique paths per file, the number of files, and the mean, median and
+    # maximum number of blocks with barriers per file
+    return statistics.mean(num_unique_paths), statistics.median(num_unique_paths), max(num_unique_paths), len(num_unique_paths), statistics.mean(num_unique_barriers), statistics.median(num_unique_barriers), max(num_unique_barriers)
 
 
 def get_barrier_blocks(path: str) -> Set[str]:
@@ -75,26 +162,258 @@ def delete_file(file):
     os.remove(file)
 
 
+def delete_amber_file(amber_file):
+    for buffer_file in get_buffer_files(amber_file):
+        delete_file(buffer_file)
+    delete_file(amber_file)
+
+
+def get_instance_name(file_path: pathlib.PurePath) -> str:
+    # The folder of an amber file and the xml instance it was generated from, as a folder can hold several instances of
+    # a CFG. The instance is the xml file with the longest name that the amber file name starts with, followed by a seed.
+    instance_names = [xml_file.stem for xml_file in Path(file_path.parent).glob("*.xml") if file_path.stem.startswith(xml_file.stem + "_")]
+    if len(instance_names) == 0:
+        return file_path.parent.stem
+    return os.path.join(file_path.parent.stem, max(instance_names, key=len))
+
+
 def deduplicate(amber_folder):
+    # Tests of different instances have different CFGs, so only tests of the same instance are compared
     all_paths: Dict[str, Set[str]] = {}
     duplicate_count = 0
     for file in get_amber_files(amber_folder):
         file_path = pathlib.PurePath(file)
-        parent_name = file_path.parent.stem
+        instance_name = get_instance_name(file_path)
         paths: FrozenSet[str] = find_paths(file_path)
         
-        if parent_name not in all_paths:
-            all_paths[parent_name] = set()
+        if instance_name not in all_paths:
+            all_paths[instance_name] = set()
         
-        if paths in all_paths[parent_name]:
+        if paths in all_paths[instance_name]:
+            duplicate_count += 1
+            print(f"deleting file {file_path}")
+            delete_amber_file(file_path)
+            continue
+        all_paths[instance_name].add(paths)
+    print(f"Removed {duplicate_count} paths in total")
+
+
+def deduplicate_from_manifest(xml_folder):
+    # As deduplicate, but comparing the path hashes recorded in the generation manifest. The entries of the deleted
+    # amber files are removed from the manifest. The entries record the xml instance each test was generated from.
+    all_paths: Dict[str, Set[FrozenSet[str]]] = {}
+    kept_entries = []
+    duplicate_count = 0
+    for entry in read_generation_manifest(xml_folder):
+        file_path = pathlib.PurePath(xml_folder, entry["amber_file"])
+        paths: FrozenSet[str] = frozenset(entry["path_hashes"])
+        if paths in all_paths.setdefault(entry["xml_file"], set()):
             duplicate_count += 1
             print(f"deleting file {file_path}")
-            delete_file(file_path)
+            delete_amber_file(file_path)
             continue
-        all_paths[parent_name].add(paths)
+        all_paths[entry["xml_file"]].add(paths)
+        kept_entries.append(entry)
+    write_generation_manifest(xml_folder, kept_entries)
     print(f"Removed {duplicate_count} paths in total")
 
 
+def get_packed_members(amber_file) -> List[Tuple[int, int, str]]:
+    # The tests packed into an amber file, in workgroup order, as the first and last block ids of each test and the
+    # xml file and seed it was generated from. The list is empty if the amber file is not packed.
+    members = []
+    with open(amber_file, 'r') as f:
+        for line in f:
+            match = re.match(r"; member #\d+ \(workgroup \d+, blocks (\d+) to (\d+)\): (.*)$", line)
+            if match is not None:
+                members.append((int(match.group(1)), int(match.group(2)), match.group(3)))
+    return members
+
+
+def find_failing_packed_members(amber_file, amber_output: str) -> List[str]:
+    # Maps the buffers named in the output of a failed run of a packed amber file back to the tests they belong to.
+    # Output buffers are named after their member, and directions buffers after a block of their member.
+    members = get_packed_members(amber_file)
+    with open(amber_file, 'r') as f:
+        lines = f.readlines()
+    buffer_names = set(re.findall(r"\b(?:member_\d+_output|directions_\d+)", amber_output))
+    for line_number in re.findall(r"[Ll]ine (\d+)", amber_output):
+        if 0 < int(line_number) <= len(lines):
+            buffer_names.update(re.findall(r"\b(?:member_\d+_output|directions_\d+)", lines[int(line_number) - 1]))
+
+    failing_members = []
+    for index, (first_block_id, last_block_id, description) in enumerate(members):
+        for buffer_name in buffer_names:
+            if buffer_name.startswith(f"member_{index}_") or \
+                    (buffer_name.startswith("directions_") and first_block_id <= int(buffer_name.split('_')[1]) <= last_block_id):
+                failing_members.append(description)
+                break
+    return failing_members
+
+
+MERGED_TEST_MARKER = "# merged test "
+
+
+def get_manifest_file(merged_file) -> str:
+    return os.path.splitext(merged_file)[0] + ".manifest.json"
+
+
+def get_declared_names(amber_script: str) -> Dict[str, List[str]]:
+    # The names of the shaders, buffers and pipelines declared by an amber script
+    names: Dict[str, List[str]] = {"shaders": [], "buffers": [], "pipelines": []}
+    for line in amber_script.splitlines():
+        tokens = line.split()
+        if len(tokens) >= 3 and tokens[0] in ["SHADER", "PIPELINE"]:
+            names["shaders" if tokens[0] == "SHADER" else "pipelines"].append(tokens[2])
+        elif len(tokens) >= 2 and tokens[0] == "BUFFER":
+            names["buffers"].append(tokens[1])
+    return names
+
+
+def rename_amber_script(amber_script: str, renames: Dict[str, str]) -> str:
+    # Renames the shaders, buffers, pipelines and buffer files of an amber script. Shader bodies are left alone, as
+    # their identifiers are local to the shader.
+    result = []
+    in_shader = False
+    for line in amber_script.splitlines(keepends=True):
+        if in_shader:
+            in_shader = line.strip() != "END"
+            result.append(line)
+            continue
+        tokens = line.split()
+        in_shader = len(tokens) > 0 and tokens[0] == "SHADER" and "FILE" not in tokens
+        result.append(re.sub(r"\S+", lambda match: renames.get(match.group(0), match.group(0)), line))
+    return "".join(result)
+
+
+def get_merge_renames(amber_script: str, prefix: str) -> Dict[str, str]:
+    renames = dict((name, prefix + name) for names in get_declared_names(amber_script).values() for name in names)
+    for line in amber_script.splitlines():
+        if " FILE BINARY " in line:
+            renames[line.split()[-1]] = prefix + line.split()[-1]
+    return renames
+
+
+def merge_amber_scripts(amber_scripts: List[str], prefixes: List[str]) -> str:
+    # Each script keeps its own shaders, buffers, pipelines, runs and expectations, with its names prefixed so that
+    # they are unique in the merged script. Buffer files are expected to be renamed with the same prefix.
+    merged = "#!amber\n"
+    for prefix, amber_script in zip(prefixes, amber_scripts):
+        body = amber_script[len("#!amber\n"):] if amber_script.startswith("#!amber\n") else amber_script
+        merged += f"\n{MERGED_TEST_MARKER}{prefix}\n"
+        merged += rename_amber_script(body, get_merge_renames(body, prefix))
+    return merged
+
+
+def split_amber_script(merged_script: str) -> Dict[str, str]:
+    # The inverse of merge_amber_scripts: the original script of each merged test, by prefix
+    parts: Dict[str, str] = {}
+    prefix: Optional[str] = None
+    for line in merged_script.splitlines(keepends=True):
+        if line.startswith(MERGED_TEST_MARKER):
+            if prefix is not None:
+                # Drop the blank line that separates the merged tests
+                parts[prefix] = parts[prefix][:-1]
+            prefix = line[len(MERGED_TEST_MARKER):].strip()
+            parts[prefix] = ""
+        elif prefix is not None:
+            parts[prefix] += line
+
+    amber_scripts: Dict[str, str] = {}
+    for prefix, body in parts.items():
+        renames = dict((prefixed_name, original_name[len(prefix):]) for original_name, prefixed_name in get_merge_renames(body, "").items() if original_name.startswith(prefix))
+        amber_scripts[prefix] = "#!amber\n" + rename_amber_script(body, renames)
+    return amber_scripts
+
+
+def write_merged_amber_file(tests: List[Tuple[str, str, Dict[str, bytes]]], merged_file):
+    # Writes the tests, given as (source, amber script, buffer files) triples, to one amber file with a manifest that
+    # maps the names of each test in the merged file back to the test they came from
+    dst_folder = os.path.dirname(merged_file)
+    prefixes = [f"test_{index}_" for index in range(len(tests))]
+    manifest = []
+    for prefix, (source, amber_script, buffer_files) in zip(prefixes, tests):
+        for file_name, contents in buffer_files.items():
+            with open(os.path.join(dst_folder, prefix + file_name), 'wb') as buffer_file:
+                buffer_file.write(contents)
+        names = get_declared_names(amber_script)
+        manifest.append({"prefix": prefix,
+                         "source": str(source),
+                         "shaders": [prefix + name for name in names["shaders"]],
+                         "buffers": [prefix + name for name in names["buffers"]],
+                         "pipelines": [prefix + name for name in names["pipelines"]]})
+    with open(merged_file, 'w') as f:
+        f.write(merge_amber_scripts([amber_script for _, amber_script, _ in tests], prefixes))
+    with open(get_manifest_file(merged_file), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_amber_test(amber_file) -> Tuple[str, str, Dict[str, bytes]]:
+    with open(amber_file, 'r') as f:
+        amber_script = f.read()
+    buffer_files = {}
+    for buffer_file in get_buffer_files(amber_file):
+        with open(buffer_file, 'rb') as f:
+            buffer_files[os.path.basename(buffer_file)] = f.read()
+    return str(amber_file), amber_script, buffer_files
+
+
+def merge_amber_files(src_folder, dst_folder, tests_per_file):
+    os.makedirs(dst_folder, exist_ok=True)
+    amber_files = sorted(get_amber_files(src_folder))
+    for file_index, start in enumerate(range(0, len(amber_files), tests_per_file)):
+        merged_file = os.path.join(dst_folder, f"merged_{file_index}.amber")
+        write_merged_amber_file([read_amber_test(amber_file) for amber_file in amber_files[start:start + tests_per_file]], merged_file)
+        print(f"Merged {len(amber_files[start:start + tests_per_file])} amber files into {merged_file}")
+
+
+def get_merged_tests(merged_file) -> List[Dict]:
+    manifest_file = get_manifest_file(merged_file)
+    if not os.path.isfile(manifest_file):
+        return []
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def find_failing_merged_tests(merged_file, amber_output: str) -> List[str]:
+    # The sources of the merged tests that the output of a failed run of a merged amber file points at, either by the
+    # names of their buffers and pipelines or by the line numbers of their commands
+    with open(merged_file, 'r') as f:
+        lines = f.readlines()
+    failing_prefixes = set()
+    for line_number in re.findall(r"[Ll]ine (\d+)", amber_output):
+        for line in reversed(lines[:int(line_number)]):
+            if line.startswith(MERGED_TEST_MARKER):
+                failing_prefixes.add(line[len(MERGED_TEST_MARKER):].strip())
+                break
+    return [test["source"] for test in get_merged_tests(merged_file)
+            if test["prefix"] in failing_prefixes or re.search(r"\b" + re.escape(test["prefix"]), amber_output) is not None]
+
+
+def split_amber_file(merged_file, dst_folder, prefixes: Optional[List[str]] = None):
+    # Re-isolates the merged tests with the given prefixes, or all of them, into dst_folder together with their buffer
+    # files. As with copy_amber_files, the tests are named after the folder and file they came from.
+    os.makedirs(dst_folder, exist_ok=True)
+    sources = dict((test["prefix"], test["source"]) for test in get_merged_tests(merged_file))
+    with open(merged_file, 'r') as f:
+        amber_scripts = split_amber_script(f.read())
+    for prefix, amber_script in amber_scripts.items():
+        if prefixes is not None and prefix not in prefixes:
+            continue
+        file_prefix = pathlib.PurePath(sources[prefix]).parent.stem + "_" if prefix in sources else prefix
+        amber_file = os.path.join(dst_folder, file_prefix + (os.path.basename(sources[prefix]) if prefix in sources else "test.amber"))
+        renames = {}
+        for line in amber_script.splitlines():
+            if " FILE BINARY " in line:
+                buffer_file_name = line.split()[-1]
+                renames[buffer_file_name] = file_prefix + buffer_file_name
+                shutil.copyfile(os.path.join(os.path.dirname(merged_file), prefix + buffer_file_name),
+                                os.path.join(dst_folder, file_prefix + buffer_file_name))
+        with open(amber_file, 'w') as f:
+            f.write(rename_amber_script(amber_script, renames))
+        print(f"Split {prefix} of {merged_file} into {amber_file}")
+
+
 def extract_asm(amber_file: Path) -> str:
     with open(amber_file, 'r') as f:
         lines = f.read()
@@ -111,9 +430,25 @@ def parse_args():
     copy_parser = subparsers.add_parser("copy")
     copy_parser.add_argument("src_folder")
     copy_parser.add_argument("dst_folder")
+    copy_parser.add_argument("--manifest", action='store_true', help="Find the amber files from the generation manifest written by fleshing_runner")
     
     deduplicate_parser = subparsers.add_parser("deduplicate")
     deduplicate_parser.add_argument("folder")
+    deduplicate_parser.add_argument("--manifest", action='store_true', help="Compare the path hashes in the generation manifest written by fleshing_runner instead of reading every amber file")
+
+    stats_parser = subparsers.add_parser("stats", help="Print statistics on the unique paths and barriers of the amber files in a folder")
+    stats_parser.add_argument("folder")
+    stats_parser.add_argument("--manifest", action='store_true', help="Read the statistics from the generation manifest written by fleshing_runner")
+
+    merge_parser = subparsers.add_parser("merge", help="Merge the amber files in a folder into amber files that each run several tests")
+    merge_parser.add_argument("src_folder")
+    merge_parser.add_argument("dst_folder")
+    merge_parser.add_argument("--tests-per-file", type=int, default=100)
+
+    split_parser = subparsers.add_parser("split", help="Split a merged amber file back into the tests it was merged from")
+    split_parser.add_argument("merged_file")
+    split_parser.add_argument("dst_folder")
+    split_parser.add_argument("--prefixes", nargs="+", help="The prefixes of the tests to split out, e.g. test_3_. All tests are split out by default.")
 
     args = parser.parse_args()
     return args
@@ -123,9 +458,23 @@ def main():
     args = parse_args()
     
     if args.subparser_name == "copy":
-        copy_amber_files(args.src_folder, args.dst_folder)
+        if args.manifest:
+            copy_amber_files_from_manifest(args.src_folder, args.dst_folder)
+        else:
+            copy_amber_files(args.src_folder, args.dst_folder)
     elif args.subparser_name == "deduplicate":
-        deduplicate(args.folder)
+        if args.manifest:
+            deduplicate_from_manifest(args.folder)
+        else:
+            deduplicate(args.folder)
+    elif args.subparser_name == "stats":
+        stats = manifest_path_stats(args.folder) if args.manifest else path_stats(args.folder)
+        print(f"Unique paths per file: mean {stats[0]}, median {stats[1]}, max {stats[2]} over {stats[3]} files")
+        print(f"Blocks with barriers per file: mean {stats[4]}, median {stats[5]}, max {stats[6]}")
+    elif args.subparser_name == "merge":
+        merge_amber_files(args.src_folder, args.dst_folder, args.tests_per_file)
+    elif args.subparser_name == "split":
+        split_amber_file(args.merged_file, args.dst_folder, args.prefixes)
     else:
         print(f"Invalid command: {args.subparser_name}")
 
@@ -0,0 +1,348 @@
+# Copyright 2022 The SPIRV-Control Flow Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fleshout
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+
+from argparse import ArgumentParser
+from random import Random
+from typing import Dict, List, Tuple
+from xml.sax.saxutils import quoteattr
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+# Loops are nested at most this deeply, so that paths through large CFGs do not spend all their length in one loop nest
+MAX_LOOP_DEPTH = 4
+MAX_SWITCH_CASES = 6
+
+
+class SyntheticCFG:
+    # A random structured CFG in the form of an Alloy instance, built from nested sequences, selections, switches with
+    # parallel edges and loops. Each header has its own merge block. Every block can reach the single exit block,
+    # unless infinite_loop_percentage is positive: that percentage of loops then never exit, so that the blocks in them
+    # are doomed, as may be every block if such a loop is on every path.
+
+    def __init__(self, num_blocks: int, seed: int, infinite_loop_percentage: int = 0) -> None:
+        self.rng: Random = Random(seed)
+        self.infinite_loop_percentage: int = infinite_loop_percentage
+        self.blocks: List[str] = []
+        self.selection_headers: List[str] = []
+        self.loop_headers: List[str] = []
+        self.switch_blocks: List[str] = []
+        self.branches: List[Tuple[str, int, str]] = []
+        self.merges: List[Tuple[str, str]] = []
+        self.continues: List[Tuple[str, str]] = []
+        self.exit_block: str = self.new_block()
+        self.entry_block: str = self.new_block()
+        self.add_branches(self.entry_block, [self.add_region(max(1, num_blocks - 2), self.exit_block, 0)])
+
+
+    def new_block(self) -> str:
+        self.blocks.append(f"Block${len(self.blocks)}")
+        return self.blocks[-1]
+
+
+    def new_selection_header(self) -> str:
+        self.selection_headers.append(f"SelectionHeader${len(self.selection_headers)}")
+        return self.selection_headers[-1]
+
+
+    def new_loop_header(self) -> str:
+        self.loop_headers.append(f"LoopHeader${len(self.loop_headers)}")
+        return self.loop_headers[-1]
+
+
+    def add_branches(self, block: str, successors: List[str]) -> None:
+        for index, successor in enumerate(successors):
+            self.branches.append((block, index, successor))
+
+
+    def split(self, num_blocks: int, num_parts: int) -> List[int]:
+        # Splits num_blocks >= num_parts into num_parts positive sizes
+        cuts = sorted(self.rng.sample(range(1, num_blocks), num_parts - 1))
+        return [end - start for start, end in zip([0] + cuts, cuts + [num_blocks])]
+
+
+    def add_region(self, num_blocks: int, successor: str, loop_depth: int) -> str:
+        # Adds num_blocks blocks, which are entered at the returned block and all leave to successor
+        if num_blocks <= 3:
+            entry = successor
+            for _ in range(num_blocks):
+                block = self.new_block()
+                self.add_branches(block, [entry])
+                entry = block
+            return entry
+        kind = self.rng.choices(['sequence', 'selection', 'switch', 'loop'], [1, 3, 2, 2 if loop_depth < MAX_LOOP_DEPTH else 0])[0]
+        if kind == 'sequence':
+            first, second = self.split(num_blocks, 2)
+            return self.add_region(first, self.add_region(second, successor, loop_depth), loop_depth)
+        merge = self.new_block()
+        self.add_branches(merge, [successor])
+        if kind == 'selection':
+            header = self.new_selection_header()
+            if self.rng.random() < 0.5:
+                targets = [self.add_region(size, merge, loop_depth) for size in self.split(num_blocks - 2, 2)]
+            else:
+                targets = [self.add_region(num_blocks - 2, merge, loop_depth), merge]
+                self.rng.shuffle(targets)
+        elif kind == 'switch':
+            header = self.new_selection_header()
+            self.switch_blocks.append(header)
+            num_cases = self.rng.randint(2, min(MAX_SWITCH_CASES, num_blocks - 2))
+            cases = [self.add_region(size, merge, loop_depth) for size in self.split(num_blocks - 2, num_cases)]
+            # Cases reached from several switch values give parallel edges
+            targets = cases + [self.rng.choice(cases + [merge]) for _ in range(self.rng.randint(0, num_cases))]
+            self.rng.shuffle(targets)
+        else:
+            header = self.new_loop_header()
+            continue_target = self.new_block()
+            is_infinite = self.infinite_loop_percentage > 0 and self.rng.randrange(100) < self.infinite_loop_percentage
+            self.add_branches(continue_target, [header] if is_infinite else [header, merge])
+            self.continues.append((header, continue_target))
+            body = self.add_region(num_blocks - 3, continue_target, loop_depth + 1)
+            targets = [body, merge] if not is_infinite and self.rng.random() < 0.5 else [body]
+        self.add_branches(header, targets)
+        self.merges.append((header, merge))
+        return header
+
+
+    def get_num_blocks(self) -> int:
+        return len(self.blocks) + len(self.selection_headers) + len(self.loop_headers)
+
+
+    def to_xml(self) -> str:
+        def atoms(labels: List[str]) -> str:
+            return "".join(f"   <atom label={quoteattr(label)}/>\n" for label in labels)
+
+        def tuples(relation: List[Tuple]) -> str:
+            return "".join("   <tuple> " + " ".join(f"<atom label={quoteattr(str(label))}/>" for label in row) + " </tuple>\n" for row in relation)
+
+        return (f'<alloy builddate="unknown">\n\n'
+                f'<instance maxseq="{MAX_SWITCH_CASES * 2}" command="Synthetic CFG with {self.get_num_blocks()} blocks" noOverflow="false" filename="">\n\n'
+                f'<sig label="LoopHeader" ID="4" parentID="5">\n{atoms(self.loop_headers)}</sig>\n\n'
+                f'<field label="continue" ID="6" parentID="4">\n{tuples(self.continues)}   <types> <type ID="4"/> <type ID="7"/> </types>\n</field>\n\n'
+                f'<sig label="SelectionHeader" ID="8" parentID="5">\n{atoms(self.selection_headers)}</sig>\n\n'
+                f'<sig label="HeaderBlock" ID="5" parentID="7">\n</sig>\n\n'
+                f'<field label="merge" ID="9" parentID="5">\n{tuples(self.merges)}   <types> <type ID="5"/> <type ID="7"/> </types>\n</field>\n\n'
+                f'<sig label="Block" ID="7" parentID="2">\n{atoms(self.blocks)}</sig>\n\n'
+                f'<field label="branch" ID="10" parentID="7">\n{tuples(self.branches)}   <types> <type ID="7"/> <type ID="0"/> <type ID="7"/> </types>\n</field>\n\n'
+                f'<sig label="EntryBlock" ID="12" one="yes">\n{atoms([self.entry_block])}   <type ID="7"/>\n</sig>\n\n'
+                f'<sig label="SwitchBlock" ID="13">\n{atoms(self.switch_blocks)}   <type ID="8"/>\n</sig>\n\n'
+                f'</instance>\n\n'
+                f'</alloy>\n')
+
+
+def generate_cfg_xml(num_blocks: int, seed: int, infinite_loop_percentage: int = 0) -> str:
+    return SyntheticCFG(num_blocks, seed, infinite_loop_percentage).to_xml()
+
+
+def get_xml_file(xml_folder: str, num_blocks: int, seed: int) -> str:
+    return os.path.join(xml_folder, f"synthetic_{num_blocks}_{seed}", "test_0.xml")
+
+
+def write_cfg_xml(xml_folder: str, num_blocks: int, seed: int, infinite_loop_percentage: int = 0) -> str:
+    # Writes the CFG to a folder of its own, as fleshing_runner expects
+    xml_file = get_xml_file(xml_folder, num_blocks, seed)
+    os.makedirs(os.path.dirname(xml_file), exist_ok=True)
+    with open(xml_file, 'w') as f:
+        f.write(generate_cfg_xml(num_blocks, seed, infinite_loop_percentage))
+    return xml_file
+
+
+def run_case(xml_file: str, seed: int, x_threads: int, x_workgroups: int) -> Dict:
+    # Fleshes the xml file with the seed, timing each phase. Loading the CFG and fleshing it are timed as a whole too.
+    # The CFG is always parsed rather than read from its cache file, so that parsing and analysing it are measured.
+    fleshout.PHASE_TIMER.enabled = True
+    fleshout.PHASE_TIMER.take()
+    start_time = time.perf_counter()
+    cfg = fleshout.parse_cfg(xml_file)
+    load_time = time.perf_counter()
+    test = fleshout.fleshout(xml_file, seed=seed, x_threads=x_threads, x_workgroups=x_workgroups, cfg=cfg)
+    amber = test.to_amber()
+    end_time = time.perf_counter()
+    return {
+        "num_blocks": len(cfg.all_blocks),
+        "max_path_length": max(len(path) for path in test.get_paths()),
+        "amber_bytes": len(amber),
+        "seconds": end_time - start_time,
+        "load_seconds": load_time - start_time,
+        "fleshout_seconds": end_time - load_time,
+        "phases": fleshout.PHASE_TIMER.take(),
+    }
+
+
+def run_case_in_process(connection, xml_file: str, seed: int, x_threads: int, x_workgroups: int) -> None:
+    try:
+        result = {"status": "ok", **run_case(xml_file, seed, x_threads, x_workgroups)}
+    except (Exception, RecursionError):
+        result = {"status": "error", "error": traceback.format_exc().strip().splitlines()[-1]}
+    connection.send(result)
+    connection.close()
+
+
+def run_isolated_case(xml_file: str, seed: int, x_threads: int, x_workgroups: int, timeout: float) -> Dict:
+    # Runs the case in a process of its own, so that one case cannot slow down the next and slow cases can be stopped
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_case_in_process, args=(sender, xml_file, seed, x_threads, x_workgroups))
+    process.start()
+    sender.close()
+    if receiver.poll(timeout):
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = {"status": "error", "error": "The benchmark process exited without a result"}
+    else:
+        process.kill()
+        result = {"status": "timeout", "error": f"Stopped after {timeout} seconds"}
+    process.join()
+    receiver.close()
+    return result
+
+
+def summarise_cases(cases: List[Dict]) -> Dict[str, Dict]:
+    # The median times of the cases of each size, over the cases that completed
+    summary: Dict[str, Dict] = {}
+    for size in sorted(set(case["size"] for case in cases)):
+        completed = [case for case in cases if case["size"] == size and case["status"] == "ok"]
+        summary[str(size)] = {"num_cases": len([case for case in cases if case["size"] == size]), "num_completed": len(completed)}
+        if len(completed) == 0:
+            continue
+        summary[str(size)]["seconds"] = statistics.median(case["seconds"] for case in completed)
+        phases = sorted(set(phase for case in completed for phase in case["phases"]))
+        summary[str(size)]["phases"] = dict((phase, statistics.median(case["phases"].get(phase, 0.0) for case in completed)) for phase in phases)
+    return summary
+
+
+def run_benchmarks(sizes: List[int], seeds: List[int], x_threads: int, x_workgroups: int, timeout: float, xml_folder: str) -> Dict:
+    cases = []
+    for size in sizes:
+        for seed in seeds:
+            xml_file = write_cfg_xml(xml_folder, size, seed)
+            result = run_isolated_case(xml_file, seed, x_threads, x_workgroups, timeout)
+            cases.append({"size": size, "seed": seed, **result})
+            print(f"{size} blocks, seed {seed}: " + (f"{result['seconds']:.3f} seconds" if result["status"] == "ok" else result["error"]))
+    return {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()},
+        "options": {"sizes": sizes, "seeds": seeds, "x_threads": x_threads, "x_workgroups": x_workgroups, "timeout": timeout},
+        "cases": cases,
+        "summary": summarise_cases(cases),
+    }
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, threshold: float, min_seconds: float) -> List[str]:
+    # The regressions: sizes whose cases no longer all complete, and median times, in total or of a phase, that are
+    # more than threshold (a fraction) and more than min_seconds slower than in the baseline
+    regressions = []
+    for size, baseline_summary in baseline["summary"].items():
+        summary = results["summary"].get(size)
+        if summary is None:
+            continue
+        if summary["num_completed"] < min(summary["num_cases"], baseline_summary["num_completed"]):
+            regressions.append(f"{size} blocks: {summary['num_completed']} of {summary['num_cases']} cases completed, down from {baseline_summary['num_completed']}")
+            continue
+        if "seconds" not in summary or "seconds" not in baseline_summary:
+            continue
+        timings = [("total", summary["seconds"], baseline_summary["seconds"])]
+        timings += [(phase, seconds, baseline_summary["phases"][phase]) for phase, seconds in summary["phases"].items() if phase in baseline_summary["phases"]]
+        for name, seconds, baseline_seconds in timings:
+            if seconds > baseline_seconds * (1 + threshold) and seconds - baseline_seconds > min_seconds:
+                regressions.append(f"{size} blocks: {name} took {seconds:.4f} seconds, up from {baseline_seconds:.4f} ({seconds / baseline_seconds - 1:+.0%})")
+    return regressions
+
+
+def report_regressions(results: Dict, baseline_file: str, threshold: float, min_seconds: float) -> bool:
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    if baseline["options"]["x_threads"] != results["options"]["x_threads"] or baseline["options"]["x_workgroups"] != results["options"]["x_workgroups"]:
+        print(f"Warning: the baseline was run with {baseline['options']['x_threads']} threads and {baseline['options']['x_workgroups']} workgroups, "
+              f"but this run with {results['options']['x_threads']} threads and {results['options']['x_workgroups']} workgroups")
+    regressions = compare_to_baseline(results, baseline, threshold, min_seconds)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    print(f"Found {len(regressions)} regressions against {baseline_file}")
+    return len(regressions) == 0
+
+
+def parse_args():
+    parser = ArgumentParser(description="Benchmarks fleshing on synthetic structured CFGs, which are generated in the form of "
+                            "Alloy instances so that no Alloy, CTS or Amber installation is needed.")
+
+    subparsers = parser.add_subparsers(dest="subparser_name")
+
+    generate_parser = subparsers.add_parser("generate", help="Write synthetic CFGs to a folder, one folder per CFG, as fleshing_runner.py expects.")
+    generate_parser.add_argument("xml_folder", type=str, help="The folder to write the CFGs to.")
+    generate_parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="The numbers of blocks of the CFGs.")
+    generate_parser.add_argument("--seeds", nargs="+", type=int, default=[1], help="The seeds of the CFGs of each size.")
+
+    run_parser = subparsers.add_parser("run", help="Flesh synthetic CFGs, timing each phase, and write the results as JSON.")
+    run_parser.add_argument("output", type=str, help="The JSON file to write the results to.")
+    run_parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="The numbers of blocks of the CFGs.")
+    run_parser.add_argument("--seeds", nargs="+", type=int, default=[1, 2, 3],
+                            help="The seeds of the CFGs of each size, each also used to flesh its CFG.")
+    run_parser.add_argument("--x-threads", type=int, default=4, help="The maximum number of threads in the x dimension.")
+    run_parser.add_argument("--x-workgroups", type=int, default=1, help="The maximum number of workgroups in the x dimension.")
+    run_parser.add_argument("--timeout", type=float, default=300, help="The time in seconds after which a case is stopped.")
+    run_parser.add_argument("--xml-folder", type=str,
+                            help="The folder to write the CFGs to, which is a temporary folder by default.")
+    run_parser.add_argument("--baseline", type=str, help="Results of an earlier run to compare the results to.")
+
+    for subparser in [run_parser, subparsers.add_parser("compare", help="Compare results to a baseline.")]:
+        if subparser is not run_parser:
+            subparser.add_argument("results", type=str, help="The JSON results of a run.")
+            subparser.add_argument("baseline", type=str, help="The JSON results of an earlier run.")
+        subparser.add_argument("--threshold", type=float, default=0.25,
+                               help="The fraction by which a median time may exceed the baseline before it is a regression.")
+        subparser.add_argument("--min-seconds", type=float, default=0.005,
+                               help="The number of seconds by which a median time may exceed the baseline in any case, "
+                               "which keeps timer noise in small cases from being reported.")
+
+    args = parser.parse_args()
+    if args.subparser_name is None:
+        parser.error("A subcommand is required")
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.subparser_name == "generate":
+        for size in args.sizes:
+            for seed in args.seeds:
+                print(write_cfg_xml(args.xml_folder, size, seed))
+    elif args.subparser_name == "run":
+        with tempfile.TemporaryDirectory() as temporary_folder:
+            results = run_benchmarks(args.sizes, args.seeds, args.x_threads, args.x_workgroups, args.timeout, args.xml_folder or temporary_folder)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        if args.baseline is not None and not report_regressions(results, args.baseline, args.threshold, args.min_seconds):
+            sys.exit(1)
+    elif args.subparser_name == "compare":
+        with open(args.results, 'r') as f:
+            results = json.load(f)
+        if not report_regressions(results, args.baseline, args.threshold, args.min_seconds):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Copyright 2022 The SPIRV-Control Flow Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cfg_cache_format
+import fleshout
+import multiprocessing
+import os
+import sys
+
+from argparse import ArgumentParser
+from collections import Counter
+from typing import List, Tuple
+
+
+def get_xml_files(folders: List[str]) -> List[str]:
+    return sorted(os.path.join(root, file) for folder in folders for root, _, files in os.walk(folder) for file in files if file.endswith(".xml"))
+
+
+def warm(xml_file: str) -> Tuple[str, str]:
+    # Writes the cache file of the xml file unless it is up to date, and returns what was done
+    cache_file = cfg_cache_format.get_cfg_cache_file(xml_file)
+    try:
+        if fleshout.read_cfg_cache(xml_file) is not None:
+            return xml_file, "up to date"
+        fleshout.load_cfg(xml_file)
+    except fleshout.NoTerminalNodesInCFGError:
+        return xml_file, "no terminal nodes"
+    except Exception as error:
+        return xml_file, f"failed: {error!r}"
+    return xml_file, "written" if os.path.isfile(cache_file) else "not writable"
+
+
+def clean(xml_file: str) -> Tuple[str, str]:
+    cache_file = cfg_cache_format.get_cfg_cache_file(xml_file)
+    if not os.path.isfile(cache_file):
+        return xml_file, "no cache file"
+    os.remove(cache_file)
+    return xml_file, "removed"
+
+
+def parse_args():
+    parser = ArgumentParser(description="Writes or removes the cache files that fleshout.py reads CFGs from instead of "
+                            "parsing their xml files, for every xml file in the given folders and their subfolders.")
+
+    parser.add_argument("command", choices=["warm", "clean"],
+                        help="warm writes the cache file of every xml file that has none that is up to date; clean "
+                        "removes the cache files.")
+    parser.add_argument("folders", nargs="+", type=str, help="The folders of xml files.")
+    parser.add_argument("--jobs", type=int, default=1, help="The number of processes to write cache files with.")
+    parser.add_argument("--verbose", action='store_true', help="Print what was done for each xml file.")
+
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+
+def main():
+    args = parse_args()
+    xml_files = get_xml_files(args.folders)
+    function = warm if args.command == "warm" else clean
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = list(pool.imap_unordered(function, xml_files, chunksize=16))
+    else:
+        results = [function(xml_file) for xml_file in xml_files]
+
+    counts = Counter()
+    for xml_file, outcome in sorted(results):
+        counts[outcome.split(":")[0]] += 1
+        if args.verbose or outcome.startswith("failed"):
+            print(f"{xml_file}: {outcome}")
+    print(f"{len(xml_files)} xml files: " + ", ".join(f"{count} {outcome}" for outcome, count in sorted(counts.items())))
+    if counts["failed"] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# Copyright 2022 The SPIRV-Control Flow Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import hashlib
+import os
+import struct
+import sys
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# The cache file of a CFG, which fleshout.py writes next to its xml file and alloy-to-spirv/convert.py reads too, holds
+# after a header the labels of its blocks, separated by newlines, and then the CFG as little-endian 32 bit integers,
+# with each block given as the index of its label: its branch, merge and continue relations and its sets of blocks by
+# type, followed by whatever analyses the writer adds. The sets of blocks are kept in the order of the xml file, so
+# that sets built from them iterate in the same order as those built when the xml file is parsed.
+CFG_CACHE_MAGIC = b"CFGC"
+CFG_CACHE_FORMAT_VERSION = 2
+# The magic bytes, format version, hash of the xml file, version of the analyses, size and modification time in
+# nanoseconds of the xml file, and number of bytes of the labels
+CFG_CACHE_HEADER = struct.Struct("<4sI32s16sQqI")
+
+
+def get_cfg_cache_file(xml_file: str) -> str:
+    return xml_file.replace(".xml", ".cfg")
+
+
+def get_xml_hash(xml_file: str) -> bytes:
+    with open(xml_file, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def get_xml_stamp(xml_file: str) -> Tuple[int, int]:
+    stat = os.stat(xml_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class CFGCacheEncoder:
+
+    def __init__(self) -> None:
+        self.block_ids: Dict[str, int] = {}
+        self.numbers: array.array = array.array('I')
+
+    def add_blocks(self, blocks: Iterable[str]) -> None:
+        blocks = list(blocks)
+        self.numbers.append(len(blocks))
+        self.numbers.extend(self.block_ids.setdefault(block, len(self.block_ids)) for block in blocks)
+
+    def add_graph(self, graph: Dict[str, Iterable[str]]) -> None:
+        self.numbers.append(len(graph))
+        for block, successors in graph.items():
+            self.numbers.append(self.block_ids.setdefault(block, len(self.block_ids)))
+            self.add_blocks(successors)
+
+    def add_relations(self, jump_relation: Dict[str, List[str]], merge_relation: Dict[str, str], continue_relation: Dict[str, str], entry_block: str, block_lists: List[List[str]]) -> None:
+        # block_lists are the regular blocks, loop headers, selection headers and switch blocks in the order of the
+        # xml file
+        self.add_graph(jump_relation)
+        self.add_graph(dict((block, [merge_block]) for block, merge_block in merge_relation.items()))
+        self.add_graph(dict((block, [continue_block]) for block, continue_block in continue_relation.items()))
+        self.add_blocks([entry_block])
+        for blocks in block_lists:
+            self.add_blocks(blocks)
+
+    def to_bytes(self, xml_hash: bytes, xml_stamp: Tuple[int, int], analysis_version: bytes) -> bytes:
+        labels = "\n".join(self.block_ids).encode()
+        numbers = array.array('I', self.numbers)
+        if sys.byteorder == 'big':
+            numbers.byteswap()
+        return CFG_CACHE_HEADER.pack(CFG_CACHE_MAGIC, CFG_CACHE_FORMAT_VERSION, xml_hash, analysis_version, *xml_stamp, len(labels)) + labels + numbers.tobytes()
+
+
+class CFGCacheDecoder:
+
+    def __init__(self, labels: List[str], numbers: array.array) -> None:
+        self.labels: List[str] = labels
+        self.numbers: array.array = numbers
+        self.position: int = 0
+
+    def read_blocks(self) -> List[str]:
+        count = self.numbers[self.position]
+        blocks = [self.labels[block_id] for block_id in self.numbers[self.position + 1:self.position + 1 + count]]
+        self.position += 1 + count
+        return blocks
+
+    def read_graph(self) -> Dict[str, List[str]]:
+        count = self.numbers[self.position]
+        self.position += 1
+        graph: Dict[str, List[str]] = {}
+        for _ in range(count):
+            block = self.labels[self.numbers[self.position]]
+            self.position += 1
+            graph[block] = self.read_blocks()
+        return graph
+
+    def read_relations(self) -> Tuple:
+        # The relations in the order of the arguments of the CFG constructors
+        return (self.read_graph(),
+                dict((block, successors[0]) for block, successors in self.read_graph().items()),
+                dict((block, successors[0]) for block, successors in self.read_graph().items()),
+                self.read_blocks()[0],
+                *[set(self.read_blocks()) for _ in range(4)])
+
+    def is_at_end(self) -> bool:
+        return self.position == len(self.numbers)
+
+
+def read_cfg_cache_file(xml_file: str, analysis_version: Optional[bytes] = None) -> Optional[CFGCacheDecoder]:
+    # A decoder of the cache file of the xml file, or None if there is none that is up to date, or if analysis_version
+    # is given and the analyses in the cache file are of another version. The cache file is up to date if the xml file
+    # has the size and modification time recorded in its header, and otherwise only if it has the hash recorded there,
+    # so that the xml file is only read when it was touched or copied.
+    cache_file = get_cfg_cache_file(xml_file)
+    if not os.path.isfile(cache_file):
+        return None
+    with open(cache_file, 'rb') as f:
+        header = f.read(CFG_CACHE_HEADER.size)
+        if len(header) < CFG_CACHE_HEADER.size:
+            return None
+        magic, format_version, xml_hash, cached_analysis_version, xml_size, xml_mtime_ns, labels_size = CFG_CACHE_HEADER.unpack(header)
+        if magic != CFG_CACHE_MAGIC or format_version != CFG_CACHE_FORMAT_VERSION:
+            return None
+        if analysis_version is not None and cached_analysis_version != analysis_version:
+            return None
+        if get_xml_stamp(xml_file) != (xml_size, xml_mtime_ns) and get_xml_hash(xml_file) != xml_hash:
+            return None
+        labels = f.read(labels_size).decode().split("\n")
+        numbers = array.array('I')
+        numbers.frombytes(f.read())
+    if sys.byteorder == 'big':
+        numbers.byteswap()
+    return CFGCacheDecoder(labels, numbers)
@@ -0,0 +1,279 @@
+# Copyright 2022 The SPIRV-Control Flow Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import benchmark
+import contextlib
+import fleshing_runner
+import fleshout
+import json
+import os
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from random import Random
+from typing import Callable, Dict, List, Set, Tuple
+
+
+def reference_compute_back_edges(self) -> Dict[str, Set[str]]:
+    # The recursive search that CFG.compute_back_edges replaced
+    def dfs(back_edges: Dict[str, Set[str]], stack: List[str], visited: Set[str], block: str):
+        assert block not in visited
+        assert block not in stack
+        visited.add(block)
+        stack.append(block)
+        if block in self.structured_jump_relation:
+            for successor in self.structured_jump_relation[block]:
+                if successor in stack:
+                    assert successor in visited
+                    if block not in back_edges:
+                        back_edges[block] = set()
+                    back_edges[block].add(successor)
+                elif successor not in visited:
+                    dfs(back_edges, stack, visited, successor)
+        stack.pop()
+
+    result: Dict[str, Set[str]] = {}
+    dfs(result, [], set(), self.entry_block)
+    return result
+
+
+def reference_stream_cfg_relations(xml_file: str) -> Tuple:
+    # Loading the whole instance, which stream_cfg_relations replaced
+    return fleshout.get_cfg_relations_from_instance(fleshout.load_instance(xml_file))
+
+
+def describe_cfg(cfg: fleshout.CFG) -> Tuple:
+    # The relations and analyses of a CFG. The sets of blocks must iterate in the same order too, while the doomed
+    # blocks and back edges are only ever looked up.
+    return (cfg.jump_relation, cfg.merge_relation, cfg.continue_relation, cfg.entry_block,
+            list(cfg.regular_blocks), list(cfg.loop_header_blocks), list(cfg.selection_header_blocks), list(cfg.switch_blocks),
+            cfg.doomed_blocks, cfg.structured_back_edges, cfg.topological_ordering)
+
+
+class Replacement:
+    # An optimized function of fleshout, found as the given attribute of owner (the fleshout module or one of its
+    # classes), and the reference implementation it replaces. get_arguments gives the arguments of both for an xml file
+    # and its CFG, and describe turns their results into values that can be compared.
+
+    def __init__(self, name: str, owner, attribute: str, reference: Callable, get_arguments: Callable[[str, fleshout.CFG], Tuple], describe: Callable = lambda result: result) -> None:
+        self.name: str = name
+        self.owner = owner
+        self.attribute: str = attribute
+        self.optimized: Callable = getattr(owner, attribute)
+        self.reference: Callable = reference
+        self.get_arguments: Callable[[str, fleshout.CFG], Tuple] = get_arguments
+        self.describe: Callable = describe
+
+
+# An optimization of fleshout lands by adding its replacement here, keeping the function it replaces as the reference
+REPLACEMENTS: List[Replacement] = [
+    Replacement("doomed blocks", fleshout, "compute_doomed_blocks", fleshout.get_doomed_blocks, lambda xml_file, cfg: (cfg.jump_relation,)),
+    Replacement("back edges", fleshout.CFG, "compute_back_edges", reference_compute_back_edges, lambda xml_file, cfg: (cfg,)),
+    Replacement("xml loading", fleshout, "stream_cfg_relations", reference_stream_cfg_relations, lambda xml_file, cfg: (xml_file,)),
+    Replacement("cfg cache", fleshout, "load_cfg", fleshout.parse_cfg, lambda xml_file, cfg: (xml_file,), describe_cfg),
+]
+
+
+@contextlib.contextmanager
+def use_reference_implementations():
+    # Puts the reference implementations in place of the optimized functions of fleshout
+    for replacement in REPLACEMENTS:
+        setattr(replacement.owner, replacement.attribute, replacement.reference)
+    try:
+        yield
+    finally:
+        for replacement in REPLACEMENTS:
+            setattr(replacement.owner, replacement.attribute, replacement.optimized)
+
+
+class Report:
+    # The mismatches found, and the total time taken by each implementation of each replacement
+
+    def __init__(self) -> None:
+        self.mismatches: List[str] = []
+        self.seconds: Dict[str, List[float]] = dict((replacement.name, [0.0, 0.0]) for replacement in REPLACEMENTS)
+        self.num_cases: int = 0
+        self.num_checks: int = 0
+
+
+def time_call(function: Callable, arguments: Tuple, repeats: int):
+    # The result of the function and the shortest time taken by a call
+    best = float('inf')
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function(*arguments)
+        best = min(best, time.perf_counter() - start_time)
+    return result, best
+
+
+def flesh(xml_file: str, seed: int) -> str:
+    # The amber file, or the error if the CFG cannot be fleshed, which must also be the same
+    try:
+        return fleshout.fleshout(xml_file, seed=seed, x_threads=4, x_workgroups=2).to_amber()
+    except (fleshout.NoTerminalNodesInCFGError, fleshout.AllTerminalNodesUnreachableError, fleshout.TerminalNodesUnreachableFromCurrentNodeError) as error:
+        return repr(error)
+
+
+def check_cfg(xml_file: str, seeds: List[int], repeats: int, report: Report) -> None:
+    # Checks that each replacement gives the same result as its reference for the CFG of the xml file, and that the
+    # amber file of each seed is the same with the optimized and the reference implementations
+    report.num_cases += 1
+    cfg = fleshout.load_cfg(xml_file)
+    for replacement in REPLACEMENTS:
+        arguments = replacement.get_arguments(xml_file, cfg)
+        try:
+            expected, reference_seconds = time_call(replacement.reference, arguments, repeats)
+        except RecursionError:
+            print(f"Skipping {replacement.name} of {xml_file} as the reference implementation exceeds the recursion limit")
+            continue
+        actual, optimized_seconds = time_call(replacement.optimized, arguments, repeats)
+        report.seconds[replacement.name][0] += reference_seconds
+        report.seconds[replacement.name][1] += optimized_seconds
+        if replacement.describe(actual) != replacement.describe(expected):
+            report.mismatches.append(f"{replacement.name} of {xml_file}: expected {expected}, got {actual}")
+
+    for seed in seeds:
+        actual_amber = flesh(xml_file, seed)
+        try:
+            with use_reference_implementations():
+                expected_amber = flesh(xml_file, seed)
+        except RecursionError:
+            continue
+        if actual_amber != expected_amber:
+            report.mismatches.append(f"the amber file of {xml_file} with seed {seed} differs")
+
+
+def check_quarantine(folder: str) -> List[str]:
+    # A pair whose worker is killed for exceeding the memory limit is quarantined once, and skipped by the next run
+    if fleshing_runner.get_rss(os.getpid()) is None:
+        print("Skipping the quarantine check as the resident set size cannot be read")
+        return []
+    xml_folder = os.path.join(folder, "xml")
+    xml_file = benchmark.write_cfg_xml(xml_folder, 5000, 1)
+    quarantine_file = os.path.join(xml_folder, fleshing_runner.Quarantine.QUARANTINE_FILE)
+    entries = []
+    for _ in range(2):
+        fleshing_runner.run_fleshing(xml_folder, [1], max_rss=1)
+        with open(quarantine_file, 'r') if os.path.isfile(quarantine_file) else contextlib.nullcontext([]) as f:
+            entries.append([json.loads(line) for line in f if line.strip() != ""])
+    if len(entries[0]) != 1 or entries[0][0]["reason"] is None:
+        return [f"the worker killed for exceeding the memory limit was not quarantined: {entries[0]}"]
+    if entries[1] != entries[0]:
+        return [f"the quarantined pair was fleshed again by the next run: {entries[1]}"]
+    if os.path.exists(xml_file.replace(".xml", "_1.amber")):
+        return ["an amber file was written for the quarantined pair"]
+    return []
+
+
+def get_diamond(arms: List[str]) -> fleshout.CFG:
+    return fleshout.CFG({"a": arms, "b": ["d"], "c": ["d"]}, {"a": "d"}, {}, "a", {"b", "c", "d"}, set(), {"a"}, set())
+
+
+def get_expected_output(cfg: fleshout.CFG, path: fleshout.Path) -> List[int]:
+    test = fleshout.FleshedTest([fleshout.ModuleMember(cfg, [path], Random(0), 0)], 1, 1, 1, 1, 1, 1, False, True, False)
+    return next(values for name, values in test.get_buffers().items() if name.endswith("output_expected"))
+
+
+def check_decision_arms(folder: str) -> List[str]:
+    # When only decisions are recorded, a thread that takes the wrong arm of an if/else diamond, as it does when the
+    # arms are swapped, must record something other than the expected output, although both arms rejoin at once
+    cfg = get_diamond(["b", "c"])
+    swapped_cfg = get_diamond(["c", "b"])
+    path = fleshout.Path(cfg, Random(0), ["a", "b", "d"], defaultdict(list))
+    swapped_cfg.label_to_id = dict(cfg.label_to_id)
+    swapped_cfg.next_id = cfg.next_id
+    swapped_path = fleshout.Path(swapped_cfg, Random(0), ["a", "c", "d"], defaultdict(list))
+    assert swapped_path.directions == path.directions
+    expected_output = get_expected_output(cfg, path)
+    swapped_output = get_expected_output(swapped_cfg, swapped_path)
+    if swapped_output == expected_output:
+        return [f"swapping the arms of a diamond leaves the expected output {expected_output} unchanged"]
+    try:
+        cfg.decode_decision_output([str(value) for value in swapped_output], [path])
+    except fleshout.UndecodableDecisionOutputError:
+        return []
+    return [f"the output {swapped_output} of the swapped arm decodes as a path of the diamond"]
+
+
+# Checks of behaviour fixed in review, each given a temporary folder of its own, which is also the working directory
+CHECKS: List[Tuple[str, Callable[[str], List[str]]]] = [
+    ("quarantine", check_quarantine),
+    ("decision arms", check_decision_arms),
+]
+
+
+def run_checks(report: Report) -> None:
+    working_directory = os.getcwd()
+    for name, check in CHECKS:
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                report.mismatches += [f"{name}: {mismatch}" for mismatch in check(folder)]
+            finally:
+                os.chdir(working_directory)
+        report.num_checks += 1
+
+
+def print_report(report: Report) -> None:
+    print(f"Checked {len(REPLACEMENTS)} replacements on {report.num_cases} CFGs, and {report.num_checks} other checks")
+    for name, (reference_seconds, optimized_seconds) in report.seconds.items():
+        speedup = reference_seconds / optimized_seconds if optimized_seconds > 0 else float('inf')
+        print(f"{name}: {reference_seconds:.4f} seconds with the reference, {optimized_seconds:.4f} seconds optimized ({speedup:.1f}x)")
+    for mismatch in report.mismatches:
+        print(f"Mismatch: {mismatch}")
+    print(f"Found {len(report.mismatches)} mismatches")
+
+
+def parse_args():
+    parser = ArgumentParser(description="Checks that the optimized functions of fleshout.py give the same results as the "
+                            "reference implementations they replace, and the same amber files, on synthetic CFGs and "
+                            "example xml files, and reports the speedup of each. It also runs the other checks in CHECKS.")
+
+    parser.add_argument("--xml", nargs="*", type=str, default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_0.xml")],
+                        help="Example xml files to check, test_0.xml by default.")
+    parser.add_argument("--sizes", nargs="*", type=int, default=[10, 100, 1000],
+                        help="The numbers of blocks of the synthetic CFGs to check. The reference implementations can be "
+                        "quadratic, so large sizes are slow.")
+    parser.add_argument("--cfg-seeds", nargs="+", type=int, default=list(range(1, 11)),
+                        help="The seeds of the synthetic CFGs of each size.")
+    parser.add_argument("--infinite-loop-percentage", type=int, default=10,
+                        help="The percentage of loops of the synthetic CFGs that never exit, so that they have doomed blocks.")
+    parser.add_argument("--fleshing-seeds", nargs="+", type=int, default=[1, 2, 3],
+                        help="The seeds with which each CFG is fleshed to compare amber files.")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="The number of times each implementation is timed, of which the fastest counts.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = Report()
+    for xml_file in args.xml:
+        check_cfg(xml_file, args.fleshing_seeds, args.repeats, report)
+    with tempfile.TemporaryDirectory() as xml_folder:
+        for size in args.sizes:
+            for cfg_seed in args.cfg_seeds:
+                check_cfg(benchmark.write_cfg_xml(xml_folder, size, cfg_seed, args.infinite_loop_percentage), args.fleshing_seeds, args.repeats, report)
+    run_checks(report)
+    print_report(report)
+    if len(report.mismatches) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
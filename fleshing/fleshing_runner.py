@@ -12,18 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import amber_utils
+import cfg_cache
+import contextlib
 import cProfile
 import fleshout
+import functools
+import hashlib
 import io
+import itertools
+import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import pstats
 import random
+import re
 import sys
 import time
 import traceback
 
 from argparse import ArgumentParser
+from collections import Counter
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -47,46 +59,729 @@ def profile(func):
 def get_test_folders(xml_folder):
     return [test_folder for test_folder in next(os.walk(xml_folder))[1]]
 
+
+def get_instance_files(xml_folder, test_folder, all_instances) -> List[str]:
+    # The xml files of a test folder to flesh: test_0.xml, or if all_instances is true every instance that Alloy* wrote
+    # for the CFG, in the order of their numbers
+    if not all_instances:
+        return [os.path.join(xml_folder, test_folder, "test_0.xml")]
+    instance_files = [file for file in os.listdir(os.path.join(xml_folder, test_folder)) if file.endswith(".xml")]
+    instance_files.sort(key=lambda file: [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", file)])
+    return [os.path.join(xml_folder, test_folder, file) for file in instance_files]
+
+
+def load_instances(test_files, jobs) -> List[str]:
+    # Parses the CFGs of the xml files in bulk, in jobs processes, writing the cache files that fleshing then reads them
+    # from. Returns the xml files whose CFG has no terminal node.
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            outcomes = dict(pool.imap_unordered(cfg_cache.warm, test_files, chunksize=max(1, len(test_files) // (4 * jobs))))
+    else:
+        outcomes = dict(cfg_cache.warm(test_file) for test_file in test_files)
+    counts = Counter(outcome.split(":")[0] for outcome in outcomes.values())
+    logger.info(f"Loaded {len(test_files)} xml files: " + ", ".join(f"{count} {outcome}" for outcome, count in sorted(counts.items())))
+    return [test_file for test_file in test_files if outcomes[test_file] == "no terminal nodes"]
+
+
+def write_buffer_files(folder, buffer_files):
+    if buffer_files is None:
+        return
+    for file_name, contents in buffer_files.items():
+        with open(os.path.join(folder, file_name), 'wb') as buffer_file:
+            buffer_file.write(contents)
+
+def write_merged_amber_file(xml_folder, merged_file_index, tests):
+    merged_folder = os.path.join(xml_folder, "merged")
+    os.makedirs(merged_folder, exist_ok=True)
+    merged_file_path = os.path.join(merged_folder, f"merged_{merged_file_index}.amber")
+    amber_utils.write_merged_amber_file(tests, merged_file_path)
+    logger.info(f"Merged {len(tests)} tests into {merged_file_path}")
+
+
+def write_packed_amber_file(xml_folder, packed_file_index, members, x_threads, y_threads, z_threads, include_op_phi, record_decisions_only, pack_directions, use_buffer_files):
+    packed_folder = os.path.join(xml_folder, "packed")
+    os.makedirs(packed_folder, exist_ok=True)
+    amber_file_path = os.path.join(packed_folder, f"packed_{packed_file_index}.amber")
+    buffer_file_prefix = os.path.basename(amber_file_path)[:-len(".amber")] if use_buffer_files else None
+    test = fleshout.fleshout_packed(members, x_threads=x_threads, y_threads=y_threads, z_threads=z_threads, include_op_phi=include_op_phi, record_decisions_only=record_decisions_only, pack_directions=pack_directions)
+    with open(amber_file_path, 'w') as amber_file:
+        amber_file.write(test.to_amber(buffer_file_prefix))
+    if use_buffer_files:
+        write_buffer_files(packed_folder, test.to_buffer_files(buffer_file_prefix))
+    logger.info(f"Packed {len(members)} tests into {amber_file_path}")
+
+@functools.lru_cache(maxsize=1)
+def load_cfg(test_file):
+    # Every process keeps the CFG of the last xml file it loaded, which is enough to load each file once, as the
+    # (xml file, seed) pairs of a file are consecutive and are handed to processes in chunks
+    return fleshout.load_cfg(test_file)
+
+
+def generate_sweep(test_file, seed, thread_shapes, workgroup_shapes, x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups, include_barriers, include_op_phi, record_decisions_only, pack_directions):
+    # Returns an (amber file path, test) pair for every combination of the shapes, all drawn from one pool of paths
+    pool = fleshout.fleshout_pool(test_file, seed, x_threads=x_threads, y_threads=y_threads, z_threads=z_threads, x_workgroups=x_workgroups, y_workgroups=y_workgroups, z_workgroups=z_workgroups, include_barriers=include_barriers, cfg=load_cfg(test_file))
+    tests = []
+    for thread_shape in thread_shapes:
+        for workgroup_shape in workgroup_shapes:
+            shape_name = f"t{'x'.join(map(str, thread_shape))}_w{'x'.join(map(str, workgroup_shape))}"
+            amber_file_path = test_file.replace(".xml", f"_{seed}_{shape_name}") + ".amber"
+            tests.append((amber_file_path, fleshout.fleshout_from_pool(pool, *thread_shape, *workgroup_shape, include_op_phi=include_op_phi, record_decisions_only=record_decisions_only, pack_directions=pack_directions)))
+    return tests
+
+
+def get_generator_version() -> str:
+    # Changes whenever the flesher does, so that results cached by an older version are not used
+    with open(fleshout.__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+class FleshingCache:
+    # Remembers, in a file in the xml folder, the amber and buffer files generated for each (xml file contents, seed,
+    # generator version, options), and the xml files whose CFG has no reachable terminal node. An (xml file, seed)
+    # pair is up to date if all the files generated for it, which are recorded relative to the xml folder, still exist
+    # with the same sizes. The unique paths of the tests in those files are recorded too, so that later tests can be
+    # checked for duplicates of them.
+    CACHE_FILE = ".fleshing_cache.jsonl"
+
+    def __init__(self, xml_folder: str, options: Dict) -> None:
+        self.xml_folder: str = xml_folder
+        self.cache_file: str = os.path.join(xml_folder, FleshingCache.CACHE_FILE)
+        self.version: str = get_generator_version()
+        self.options: Dict = options
+        self.outputs: Dict[str, Dict[str, int]] = {}
+        self.signatures: Dict[str, List[List[str]]] = {}
+        self.known_signatures: Dict[str, Set[FrozenSet[str]]] = {}
+        self.failing_xml_hashes: Set[str] = set()
+        self.xml_hashes: Dict[str, str] = {}
+        self.num_hits: int = 0
+        self.num_misses: int = 0
+        self.num_known_failures: int = 0
+        if os.path.isfile(self.cache_file):
+            with open(self.cache_file, 'r') as f:
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    entry = json.loads(line)
+                    if "failing_xml_hash" in entry:
+                        self.failing_xml_hashes.add(entry["failing_xml_hash"])
+                    else:
+                        self.outputs[entry["key"]] = entry["outputs"]
+                        self.signatures[entry["key"]] = entry.get("signatures", [])
+
+
+    def append(self, entry: Dict) -> None:
+        with open(self.cache_file, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+    def get_xml_hash(self, test_file: str) -> str:
+        # Failures only depend on the CFG, so they are keyed by the contents of the xml file and the generator version
+        if test_file not in self.xml_hashes:
+            with open(test_file, 'rb') as f:
+                self.xml_hashes[test_file] = hashlib.sha256(f.read() + self.version.encode()).hexdigest()
+        return self.xml_hashes[test_file]
+
+
+    def get_key(self, test_file: str, seed: int) -> str:
+        # The outputs are written next to the xml file, so its location is part of the key as well as its contents
+        return hashlib.sha256(json.dumps({"xml": self.get_xml_hash(test_file), "xml_file": os.path.relpath(test_file, self.xml_folder), "seed": seed, "options": self.options}, sort_keys=True).encode()).hexdigest()
+
+
+    def is_known_failure(self, test_file: str) -> bool:
+        if self.get_xml_hash(test_file) in self.failing_xml_hashes:
+            self.num_known_failures += 1
+            return True
+        return False
+
+
+    def is_up_to_date(self, test_file: str, seed: int) -> bool:
+        # A pair can have no files if all its tests were duplicates
+        key = self.get_key(test_file, seed)
+        outputs = self.outputs.get(key)
+        if outputs is not None and all(os.path.isfile(os.path.join(self.xml_folder, file)) and os.path.getsize(os.path.join(self.xml_folder, file)) == size for file, size in outputs.items()):
+            self.num_hits += 1
+            self.known_signatures.setdefault(test_file, set()).update(frozenset(signature) for signature in self.signatures[key])
+            return True
+        self.num_misses += 1
+        return False
+
+
+    def get_known_signatures(self, test_file: str) -> Set[FrozenSet[str]]:
+        # The unique paths of the tests of the xml file that were found to be up to date
+        return self.known_signatures.get(test_file, set())
+
+
+    def add_outputs(self, test_file: str, seed: int, output_files: List[str], signatures: List[List[str]]) -> None:
+        key = self.get_key(test_file, seed)
+        self.outputs[key] = dict((os.path.relpath(file, self.xml_folder), os.path.getsize(file)) for file in output_files)
+        self.signatures[key] = signatures
+        self.append({"key": key, "outputs": self.outputs[key], "signatures": signatures})
+
+
+    def add_failure(self, test_file: str) -> None:
+        self.failing_xml_hashes.add(self.get_xml_hash(test_file))
+        self.append({"failing_xml_hash": self.get_xml_hash(test_file)})
+
+
+    def get_summary(self) -> str:
+        num_lookups = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / num_lookups if num_lookups > 0 else 0
+        return f"Cache: {self.num_hits} of {num_lookups} (xml file, seed) pairs were up to date ({hit_rate:.1%}) and {self.num_known_failures} xml files were known to fail"
+
+
+class Quarantine:
+    # The (xml file, seed) pairs whose worker was killed for exceeding its time or memory limit, remembered in a file in
+    # the xml folder so that later runs skip them. A pair is released if its xml file or the generator version changes,
+    # so that fixing the flesher retries the pairs it was too slow for.
+    QUARANTINE_FILE = ".fleshing_quarantine.jsonl"
+
+    def __init__(self, xml_folder: str) -> None:
+        self.xml_folder: str = xml_folder
+        self.quarantine_file: str = os.path.join(xml_folder, Quarantine.QUARANTINE_FILE)
+        self.reasons: Dict[Tuple[str, str, int], str] = {}
+        self.version: str = get_generator_version()
+        self.xml_hashes: Dict[str, str] = {}
+        self.num_skipped: int = 0
+        if os.path.isfile(self.quarantine_file):
+            with open(self.quarantine_file, 'r') as f:
+                for line in f:
+                    if line.strip() != "":
+                        entry = json.loads(line)
+                        self.reasons[(entry["xml_file"], entry["xml_hash"], entry["seed"])] = entry["reason"]
+
+
+    def get_key(self, test_file: str, seed: int) -> Tuple[str, str, int]:
+        if test_file not in self.xml_hashes:
+            with open(test_file, 'rb') as f:
+                self.xml_hashes[test_file] = hashlib.sha256(f.read() + self.version.encode()).hexdigest()
+        return os.path.relpath(test_file, self.xml_folder), self.xml_hashes[test_file], seed
+
+
+    def get_reason(self, test_file: str, seed: int) -> Optional[str]:
+        reason = self.reasons.get(self.get_key(test_file, seed))
+        if reason is not None:
+            self.num_skipped += 1
+        return reason
+
+
+    def add(self, test_file: str, seed: int, reason: str) -> None:
+        xml_file, xml_hash, seed = self.get_key(test_file, seed)
+        self.reasons[(xml_file, xml_hash, seed)] = reason
+        with open(self.quarantine_file, 'a') as f:
+            f.write(json.dumps({"xml_file": xml_file, "xml_hash": xml_hash, "seed": seed, "reason": reason}) + "\n")
+
+
+class FleshingResult:
+    # The outcome of fleshing one xml file with one seed. Its messages are logged by the process running run_fleshing,
+    # in the order of the (xml file, seed) pairs, so that the log does not depend on the number of jobs.
+
+    def __init__(self, test_file: str, seed: int) -> None:
+        self.test_file: str = test_file
+        self.seed: int = seed
+        self.num_amber_files_produced: int = 0
+        self.merged_tests: List[Tuple[str, str, Dict[str, bytes]]] = []
+        self.manifest_entries: List[Dict] = []
+        self.output_files: List[str] = []
+        self.signatures: List[List[str]] = []
+        self.num_tests: int = 0
+        self.num_duplicates: int = 0
+        self.has_terminal_node_issues: bool = False
+        self.exceeds_budget: bool = False
+        self.has_errors: bool = False
+        self.exceeded_limits: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.memory_profile: Optional[Dict] = None
+        self.messages: List[Tuple[int, str]] = []
+
+
+    def log(self, level: int, message: str) -> None:
+        self.messages.append((level, message))
+
+
+@contextlib.contextmanager
+def classify_errors(result: FleshingResult):
+    try:
+        yield
+    except (fleshout.NoTerminalNodesInCFGError, fleshout.AllTerminalNodesUnreachableError):
+        result.has_terminal_node_issues = True
+        result.log(logging.ERROR, traceback.format_exc())
+        result.log(logging.ERROR, result.test_file)
+        result.log(logging.ERROR, f"{result.seed}")
+    except fleshout.BudgetExceededError as error:
+        result.exceeds_budget = True
+        result.log(logging.WARNING, f"Skipping {result.test_file} with seed {result.seed} as {error}")
+    except (KeyError, AssertionError, fleshout.TerminalNodesUnreachableFromCurrentNodeError):
+        result.has_errors = True
+        result.log(logging.ERROR, traceback.format_exc())
+        result.log(logging.ERROR, result.test_file)
+        result.log(logging.ERROR, f"{result.seed}")
+
+
+def start_profiling(timings: bool, memprofile: bool) -> None:
+    fleshout.PHASE_TIMER.enabled = timings
+    fleshout.PHASE_TIMER.take()
+    fleshout.PHASE_TIMER.memory_profiler = fleshout.MemoryProfiler() if memprofile else None
+
+
+def finish_profiling(result: FleshingResult) -> None:
+    result.timings = fleshout.PHASE_TIMER.take()
+    if fleshout.PHASE_TIMER.memory_profiler is not None:
+        result.memory_profile = fleshout.PHASE_TIMER.memory_profiler.get_report()
+        fleshout.PHASE_TIMER.memory_profiler = None
+
+
+def merge_memory_profiles(profile: Optional[Dict], seed: int, seed_profile: Dict) -> Dict:
+    # The memory profile of an xml file over its seeds: the highest peaks, and for each phase the record of the seed
+    # with the highest peak
+    if profile is None:
+        profile = {"peak_bytes": 0, "max_rss_bytes": 0, "phases": {}}
+    profile["peak_bytes"] = max(profile["peak_bytes"], seed_profile["peak_bytes"])
+    profile["max_rss_bytes"] = max(profile["max_rss_bytes"], seed_profile["max_rss_bytes"])
+    for phase, record in seed_profile["phases"].items():
+        if phase not in profile["phases"] or record["peak_bytes"] > profile["phases"][phase]["peak_bytes"]:
+            profile["phases"][phase] = {"seed": seed, **record}
+    return profile
+
+
+def get_manifest_entry(xml_folder, amber_file_path, test, flags, amber_program_str, buffer_files, generation_time) -> Dict:
+    # The line of the generation manifest describing an amber file. Paths are relative to the xml folder, and paths
+    # through the CFG are only recorded as hashes, which is enough to find duplicate tests.
+    unique_paths = test.get_unique_paths()
+    return {
+        "amber_file": os.path.relpath(amber_file_path, xml_folder),
+        "xml_file": os.path.relpath(test.members[0].xml_file, xml_folder),
+        "seed": test.seed,
+        "threads": [test.x_threads, test.y_threads, test.z_threads],
+        "workgroups": [test.x_workgroups, test.y_workgroups, test.z_workgroups],
+        "flags": flags,
+        "path_hashes": sorted(amber_utils.get_path_hash(path) for path in unique_paths),
+        "barrier_blocks": sorted(set().union(*[amber_utils.get_barrier_blocks(path) for path in unique_paths])),
+        "buffer_bytes": dict((name, 4 * len(values)) for name, values in test.get_buffers().items()),
+        "buffer_files": sorted(buffer_files) if buffer_files is not None else [],
+        "file_size": len(amber_program_str.encode()),
+        "generation_time": generation_time,
+    }
+
+
+def get_signature(test) -> FrozenSet[str]:
+    # Tests with the same unique paths are duplicates. The paths are hashed as in the generation manifest.
+    return frozenset(amber_utils.get_path_hash(path) for path in test.get_unique_paths())
+
+
+def flesh_test_file(task, **options) -> List[FleshingResult]:
+    # Fleshes an xml file with each of the seeds of the task, stopping if its CFG has no reachable terminal node. With
+    # deduplication, the task also gives the unique paths of tests already generated for the xml file, and a test with
+    # the same unique paths as an earlier one is skipped before its amber file is emitted.
+    test_file, seeds, known_signatures = task
+    seen_signatures = set(known_signatures) if options["deduplicate"] else None
+    results = []
+    for seed in seeds:
+        results.append(flesh_test_file_with_seed(test_file, seed, seen_signatures, **options))
+        if results[-1].has_terminal_node_issues:
+            break
+    return results
+
+
+def flesh_test_file_with_seed(test_file, seed, seen_signatures, xml_folder, x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups, include_barriers, include_op_phi, record_decisions_only, pack_directions, use_buffer_files, merge, budget, thread_shapes, workgroup_shapes, split_rng, deduplicate, timings, memprofile) -> FleshingResult:
+    # Writes the amber files for one (xml file, seed) pair, or returns them in merged_tests if they are to be merged.
+    # The generation time of each amber file is the time since the previous one was written, so that the time taken
+    # to generate the paths is counted once. With timings, the time spent in each phase is returned in the result. The
+    # CFG of an xml file is loaded once per process, so its parsing and analysis are timed with its first seed. With
+    # memprofile, the memory profile of the seed is returned in the result in the same way.
+    start_profiling(timings, memprofile)
+    result = FleshingResult(test_file, seed)
+    result.log(logging.INFO, f"Fleshing {test_file} with seed {seed}")
+    flags = {"include_barriers": include_barriers, "include_op_phi": include_op_phi, "record_decisions_only": record_decisions_only, "pack_directions": pack_directions, "use_buffer_files": use_buffer_files, "split_rng": split_rng}
+    start_time = time.perf_counter()
+    with classify_errors(result):
+        if thread_shapes is not None or workgroup_shapes is not None:
+            tests = generate_sweep(test_file, seed, thread_shapes or [(x_threads, y_threads, z_threads)], workgroup_shapes or [(x_workgroups, y_workgroups, z_workgroups)], x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups, include_barriers, include_op_phi, record_decisions_only, pack_directions)
+        else:
+            test = fleshout.fleshout(test_file, seed=seed, x_threads=x_threads, y_threads=y_threads, z_threads=z_threads, x_workgroups=x_workgroups, y_workgroups=y_workgroups, z_workgroups=z_workgroups, include_barriers=include_barriers, include_op_phi=include_op_phi, record_decisions_only=record_decisions_only, pack_directions=pack_directions, budget=budget, split_rng=split_rng, cfg=load_cfg(test_file))
+            if budget is not None and budget.is_enforced():
+                result.log(logging.INFO, f"Predicted sizes: {test.predict_sizes()}")
+            tests = [(test_file.replace(".xml", f"_{seed}") + ".amber", test)]
+        for amber_file_path, test in tests:
+            result.num_tests += 1
+            if seen_signatures is not None:
+                signature = get_signature(test)
+                if signature in seen_signatures:
+                    result.num_duplicates += 1
+                    result.log(logging.INFO, f"Skipping {amber_file_path} as it has the same unique paths as an earlier test")
+                    continue
+                seen_signatures.add(signature)
+                result.signatures.append(sorted(signature))
+            buffer_file_prefix = os.path.basename(amber_file_path)[:-len(".amber")] if use_buffer_files else None
+            amber_program_str = test.to_amber(buffer_file_prefix)
+            buffer_files = test.to_buffer_files(buffer_file_prefix) if use_buffer_files else None
+            if merge > 0:
+                result.merged_tests.append((amber_file_path, amber_program_str, buffer_files if buffer_files is not None else {}))
+                continue
+            with fleshout.PHASE_TIMER.phase('file_write'):
+                with open(amber_file_path, 'w') as amber_file:
+                    amber_file.write(amber_program_str)
+                write_buffer_files(os.path.dirname(amber_file_path), buffer_files)
+            result.num_amber_files_produced += 1
+            result.output_files.append(amber_file_path)
+            result.output_files += [os.path.join(os.path.dirname(amber_file_path), file_name) for file_name in buffer_files or {}]
+            end_time = time.perf_counter()
+            result.manifest_entries.append(get_manifest_entry(xml_folder, amber_file_path, test, flags, amber_program_str, buffer_files, end_time - start_time))
+            start_time = end_time
+    finish_profiling(result)
+    return result
+
+
+def get_rss(pid: int) -> Optional[int]:
+    # The resident set size of a process in bytes, if it can be read from /proc
+    try:
+        with open(f"/proc/{pid}/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def run_isolated_task(connection, flesh, task):
+    # Sends the results of the task, or the traceback of the exception that stopped it, which would otherwise only be
+    # seen as an exit code
+    try:
+        results = flesh(task)
+    except Exception:
+        results = traceback.format_exc()
+    connection.send(results)
+    connection.close()
+
+
+def get_limit_results(task, reason: str) -> List[FleshingResult]:
+    test_file, seeds, _ = task
+    results = []
+    for seed in seeds:
+        result = FleshingResult(test_file, seed)
+        result.exceeded_limits = reason
+        result.log(logging.ERROR, f"Stopped the worker fleshing {test_file} with seed {seed} as {reason}")
+        results.append(result)
+    return results
+
+
+def get_crash_results(task, error: str) -> List[FleshingResult]:
+    # A worker that crashed is an error of the flesher, as it would be without limits, so its pairs are not quarantined
+    test_file, seeds, _ = task
+    results = []
+    for seed in seeds:
+        result = FleshingResult(test_file, seed)
+        result.has_errors = True
+        result.log(logging.ERROR, error)
+        result.log(logging.ERROR, test_file)
+        result.log(logging.ERROR, f"{seed}")
+        results.append(result)
+    return results
+
+
+def run_isolated(flesh, tasks, jobs, timeout, max_rss):
+    # Yields the results of the tasks in order, running each task in a process of its own. A process is killed if it
+    # runs for longer than timeout seconds per seed of its task, or if its resident set grows beyond max_rss bytes, and
+    # the results of its task then record why. Either limit can be None. A process that crashes instead gives results
+    # with errors.
+    tasks = iter(tasks)
+    running = {}
+    finished: Dict[int, List[FleshingResult]] = {}
+    num_started = 0
+    num_yielded = 0
+    all_started = False
+    while True:
+        while not all_started and len(running) < jobs:
+            task = next(tasks, None)
+            if task is None:
+                all_started = True
+                break
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_isolated_task, args=(sender, flesh, task))
+            process.start()
+            sender.close()
+            running[num_started] = (process, receiver, time.monotonic(), task)
+            num_started += 1
+
+        while num_yielded in finished:
+            yield from finished.pop(num_yielded)
+            num_yielded += 1
+        if all_started and len(running) == 0:
+            return
+
+        multiprocessing.connection.wait([receiver for _, receiver, _, _ in running.values()], timeout=0.1)
+        for index, (process, receiver, start_time, task) in list(running.items()):
+            time_limit = timeout * len(task[1]) if timeout is not None else None
+            if receiver.poll():
+                try:
+                    results = receiver.recv()
+                    finished[index] = get_crash_results(task, results) if isinstance(results, str) else results
+                except EOFError:
+                    process.join()
+                    finished[index] = get_crash_results(task, f"The worker fleshing {task[0]} exited with code {process.exitcode} without a result")
+            elif time_limit is not None and time.monotonic() - start_time > time_limit:
+                process.kill()
+                finished[index] = get_limit_results(task, f"it ran for more than {time_limit} seconds")
+            elif max_rss is not None and (get_rss(process.pid) or 0) > max_rss:
+                process.kill()
+                finished[index] = get_limit_results(task, f"its resident set grew beyond {max_rss} bytes")
+            else:
+                continue
+            process.join()
+            receiver.close()
+            del running[index]
+
+
+def allocate_seeds(estimates: Dict[str, int], costs: Dict[str, float], budget: float, max_seeds: int) -> Dict[str, int]:
+    # Spends the budget on seeds for each xml file in proportion to the logarithm of its estimated number of paths, as
+    # each choice between two branches doubles the paths. A seed of an xml file costs costs[xml file]. Every xml file
+    # gets at least one seed, and none gets more seeds than its estimated number of paths or than max_seeds.
+    caps = dict((test_file, max(1, min(max_seeds, estimate))) for test_file, estimate in estimates.items())
+    weights = dict((test_file, max(1, estimate.bit_length())) for test_file, estimate in estimates.items())
+
+    def allocate(scale: float) -> Dict[str, int]:
+        return dict((test_file, min(caps[test_file], max(1, round(scale * weights[test_file])))) for test_file in estimates)
+
+    low, high = 0.0, float(max_seeds)
+    for _ in range(50):
+        middle = (low + high) / 2
+        if sum(num_seeds * costs[test_file] for test_file, num_seeds in allocate(middle).items()) <= budget:
+            low = middle
+        else:
+            high = middle
+    return allocate(low)
+
+
+def get_generation_times(xml_folder) -> Dict[str, List[float]]:
+    # The generation times recorded in the generation manifest of xml_folder for each xml file
+    generation_times: Dict[str, List[float]] = {}
+    if os.path.isfile(amber_utils.get_generation_manifest_file(xml_folder)):
+        for entry in amber_utils.read_generation_manifest(xml_folder):
+            generation_times.setdefault(os.path.join(xml_folder, entry["xml_file"]), []).append(entry["generation_time"])
+    return generation_times
+
+
+def get_seed_allocation(xml_folder, test_files, seeds, seed_budget, seed_budget_seconds) -> Dict[str, int]:
+    # The number of seeds to spend on each xml file, within a budget of tests or of seconds. The cost in seconds of a
+    # test is the mean generation time recorded in the generation manifest for its xml file, or for all xml files if
+    # none is recorded for it.
+    estimates = {}
+    for test_file in test_files:
+        try:
+            estimates[test_file] = load_cfg(test_file).estimate_num_paths()
+        except (fleshout.NoTerminalNodesInCFGError, fleshout.AllTerminalNodesUnreachableError, KeyError, AssertionError):
+            # The error is reported when the xml file is fleshed
+            estimates[test_file] = 1
+    if seed_budget is not None:
+        return allocate_seeds(estimates, dict((test_file, 1.0) for test_file in test_files), seed_budget, len(seeds))
+
+    generation_times = get_generation_times(xml_folder)
+    all_times = [time for times in generation_times.values() for time in times]
+    assert len(all_times) > 0, "A budget in seconds needs the generation times of an earlier run in the generation manifest"
+    mean_time = sum(all_times) / len(all_times)
+    costs = dict((test_file, sum(generation_times[test_file]) / len(generation_times[test_file]) if test_file in generation_times else mean_time) for test_file in test_files)
+    return allocate_seeds(estimates, costs, seed_budget_seconds, len(seeds))
+
+
 # @profile
-def run_fleshing(xml_folder, seeds, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_barriers=False, include_op_phi=False):
+def run_fleshing(xml_folder, seeds, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_barriers=False, include_op_phi=False, record_decisions_only=False, pack_directions=False, use_buffer_files=False, pack=0, merge=0, budget=None, thread_shapes=None, workgroup_shapes=None, split_rng=False, jobs=1, incremental=False, deduplicate=False, timeout=None, max_rss=None, retry_quarantined=False, seed_budget=None, seed_budget_seconds=None, timings_file=None, memprofile=False, all_instances=False):
+    # If pack is positive, the tests for up to pack (xml file, seed) pairs are packed into each amber file, one
+    # workgroup per test. The packed amber files are written to a folder called packed in xml_folder.
+    # If merge is positive, up to merge independent tests are merged into each amber file, each with its own shader
+    # and pipeline. The merged amber files and their manifests are written to a folder called merged in xml_folder.
+    # If thread_shapes or workgroup_shapes are given, a pool of paths is generated once per (xml file, seed) and a test
+    # is drawn from it for every combination of the thread and workgroup shapes, instead of for a random shape.
+    # If jobs is more than 1, the (xml file, seed) pairs are fleshed in chunks by a pool of jobs processes. The amber
+    # files, the log and the summary are the same as with one process. Packing needs the block ids of the previous
+    # member, so it only runs in one process.
+    # A line describing each amber file that is not packed or merged is appended to the generation manifest of
+    # xml_folder, which amber_utils can use instead of reading every amber file. Once all are written, the manifest is
+    # rewritten without the earlier lines of amber files that were generated again, so that running the same seeds again
+    # replaces their lines rather than adding more.
+    # If incremental is true, (xml file, seed) pairs whose amber files are up to date according to the FleshingCache of
+    # xml_folder are skipped, as are the xml files known to have no reachable terminal node.
+    # If deduplicate is true, a test with the same unique paths as an earlier test of the same xml file is skipped
+    # before it is emitted, and the duplicate rate of each xml file is reported. The seeds of an xml file are then
+    # fleshed in order by one job, so that the same tests are skipped however many jobs there are.
+    # If timeout (in seconds per seed) or max_rss (in bytes) is given, each task runs in a process of its own, which
+    # is killed if it exceeds the limit. The (xml file, seed) pairs of the task are then added to the Quarantine of
+    # xml_folder, and later runs skip them unless retry_quarantined is true. A task whose process crashes is reported as
+    # an error instead.
+    # If seed_budget (a number of tests) or seed_budget_seconds is given, each xml file is fleshed with the first few
+    # seeds only, as many as get_seed_allocation spends on it according to the estimated number of paths of its CFG.
+    # If timings_file is given, the time spent in each phase of fleshing each xml file is written to it as JSON, with
+    # the totals and percentiles of each phase over the xml files. Writing merged amber files is not timed.
+    # If memprofile is true, the memory of each phase is profiled with tracemalloc, and the peaks and top allocation
+    # sites over the seeds of each xml file are written next to it, see fleshout.MemoryProfiler.
+    # If all_instances is true, every xml file of each test folder is fleshed rather than test_0.xml only, as a separate
+    # xml file with its own seeds and manifest entries. Their CFGs are first parsed in bulk by jobs processes, see
+    # load_instances.
+    assert pack == 0 or jobs == 1, "Packed tests cannot be fleshed by several jobs"
+    assert not incremental or (pack == 0 and merge == 0), "Packed and merged tests cannot be fleshed incrementally"
+    assert not deduplicate or pack == 0, "Packed tests cannot be deduplicated"
+    assert (timeout is None and max_rss is None) or pack == 0, "Packed tests cannot be fleshed in isolated processes"
     configure_logging()
     start_time = time.perf_counter()
     files_with_errors = []
     files_with_terminal_node_issues = []
-    num_xml_files_processed = 0
     num_amber_files_produced = 0
+    members = []
+    merged_tests = []
+    test_files = []
+    cache = None
+    if incremental:
+        options = {"deduplicate": deduplicate, "x_threads": x_threads, "y_threads": y_threads, "z_threads": z_threads, "x_workgroups": x_workgroups, "y_workgroups": y_workgroups, "z_workgroups": z_workgroups, "include_barriers": include_barriers, "include_op_phi": include_op_phi, "record_decisions_only": record_decisions_only, "pack_directions": pack_directions, "use_buffer_files": use_buffer_files, "budget": budget.limits if budget is not None else None, "thread_shapes": thread_shapes, "workgroup_shapes": workgroup_shapes, "split_rng": split_rng}
+        cache = FleshingCache(xml_folder, options)
     for test_folder in get_test_folders(xml_folder):
-        test_file = os.path.join(xml_folder, test_folder, "test_0.xml")
+        for test_file in get_instance_files(xml_folder, test_folder, all_instances):
+            if not os.path.isfile(test_file):
+                logger.info(f"Skipping {test_file} as it doesn't exist")
+                continue
+            test_files.append(test_file)
+            if cache is not None and cache.is_known_failure(test_file):
+                logger.info(f"Skipping {test_file} as its CFG is known to have no reachable terminal node")
+                files_with_terminal_node_issues.append(test_file)
+    if all_instances:
+        for test_file in load_instances([test_file for test_file in test_files if test_file not in files_with_terminal_node_issues], jobs):
+            logger.info(f"Skipping {test_file} as its CFG has no terminal node")
+            files_with_terminal_node_issues.append(test_file)
+            if cache is not None:
+                cache.add_failure(test_file)
+    num_xml_files_processed = len(test_files)
 
-        if not os.path.isfile(test_file):
-            logger.info(f"Skipping {test_file} as it doesn't exist")
-            continue
+    num_seeds = dict((test_file, len(seeds)) for test_file in test_files)
+    if seed_budget is not None or seed_budget_seconds is not None:
+        num_seeds = get_seed_allocation(xml_folder, test_files, seeds, seed_budget, seed_budget_seconds)
+        for test_file in test_files:
+            logger.info(f"Allocated {num_seeds[test_file]} seeds to {test_file}")
+    quarantine = Quarantine(xml_folder)
+    files_exceeding_limits = []
+    files_exceeding_budget = []
+    pending_tasks = []
+    for test_file in test_files:
+        for seed in seeds[:num_seeds[test_file]]:
+            if test_file in files_with_terminal_node_issues:
+                continue
+            quarantine_reason = None if retry_quarantined else quarantine.get_reason(test_file, seed)
+            if quarantine_reason is not None:
+                logger.info(f"Skipping {test_file} with seed {seed} as it is quarantined: its worker was stopped as {quarantine_reason}")
+                continue
+            if cache is not None and cache.is_up_to_date(test_file, seed):
+                logger.info(f"Skipping {test_file} with seed {seed} as its amber files are up to date")
+                continue
+            pending_tasks.append((test_file, seed))
 
-        for seed in seeds:
-            logger.info(f"Fleshing {test_file} with seed {seed}")
-            try:
-                _, amber_program_str = fleshout.fleshout(test_file, seed=seed, x_threads=x_threads, y_threads=y_threads, z_threads=z_threads, x_workgroups=x_workgroups, y_workgroups=y_workgroups, z_workgroups=z_workgroups, include_barriers=include_barriers, include_op_phi=include_op_phi)
-                amber_file_path = test_file.replace(".xml", f"_{seed}") + ".amber"
-                with open(amber_file_path, 'w') as amber_file:
-                    amber_file.write(amber_program_str)
+    def flesh_packed_member(task) -> FleshingResult:
+        nonlocal members, num_amber_files_produced
+        test_file, seed = task
+        start_profiling(timings_file is not None, memprofile)
+        result = FleshingResult(test_file, seed)
+        result.log(logging.INFO, f"Fleshing {test_file} with seed {seed}")
+        with classify_errors(result):
+            first_block_id = members[-1].cfg.next_id if len(members) > 0 else fleshout.CFG.ENTRY_BLOCK_ID
+            members.append(fleshout.generate_packed_member(test_file, seed, first_block_id, x_threads=x_threads, y_threads=y_threads, z_threads=z_threads, x_workgroups=x_workgroups, y_workgroups=y_workgroups, z_workgroups=z_workgroups, include_barriers=include_barriers, cfg=load_cfg(test_file)))
+            if len(members) == pack:
+                packed_members, members = members, []
+                write_packed_amber_file(xml_folder, num_amber_files_produced, packed_members, x_threads, y_threads, z_threads, include_op_phi, record_decisions_only, pack_directions, use_buffer_files)
                 num_amber_files_produced += 1
-            except (fleshout.NoTerminalNodesInCFGError, fleshout.AllTerminalNodesUnreachableError):
-                files_with_terminal_node_issues.append(test_file)
-                logger.error(traceback.format_exc())
-                logger.error(test_file)
-                logger.error(seed)
-                break # No point trying a different seed
-            except (KeyError, AssertionError, fleshout.TerminalNodesUnreachableFromCurrentNodeError):
-                files_with_errors.append(test_file)
-                logger.error(traceback.format_exc())
-                logger.error(test_file)
-                logger.error(seed)
-        num_xml_files_processed += 1
+        finish_profiling(result)
+        return result
+
+    # No other seed is tried for a file whose CFG has no reachable terminal node. Jobs may already have fleshed further
+    # seeds of such a file, which fail in the same way, so their results are skipped.
+    if deduplicate:
+        grouped_tasks = []
+        for test_file, seed in pending_tasks:
+            if len(grouped_tasks) == 0 or grouped_tasks[-1][0] != test_file:
+                grouped_tasks.append((test_file, [], cache.get_known_signatures(test_file) if cache is not None else set()))
+            grouped_tasks[-1][1].append(seed)
+    else:
+        grouped_tasks = [(test_file, [seed], set()) for test_file, seed in pending_tasks]
+    tasks = (task for task in grouped_tasks if task[0] not in files_with_terminal_node_issues)
+    duplicate_counts: Dict[str, List[int]] = {}
+    file_timings: Dict[str, Dict[str, float]] = {}
+    memory_profiles: Dict[str, Dict] = {}
+    flesh = functools.partial(flesh_test_file, deduplicate=deduplicate, xml_folder=xml_folder, x_threads=x_threads, y_threads=y_threads, z_threads=z_threads, x_workgroups=x_workgroups, y_workgroups=y_workgroups, z_workgroups=z_workgroups, include_barriers=include_barriers, include_op_phi=include_op_phi, record_decisions_only=record_decisions_only, pack_directions=pack_directions, use_buffer_files=use_buffer_files, merge=merge, budget=budget, thread_shapes=thread_shapes, workgroup_shapes=workgroup_shapes, split_rng=split_rng, timings=timings_file is not None, memprofile=memprofile)
+    with contextlib.ExitStack() as stack:
+        manifest = stack.enter_context(open(amber_utils.get_generation_manifest_file(xml_folder), 'a'))
+        if pack > 0:
+            results = map(flesh_packed_member, ((test_file, seed) for test_file, seeds, _ in tasks for seed in seeds))
+        elif timeout is not None or max_rss is not None:
+            results = run_isolated(flesh, tasks, jobs, timeout, max_rss)
+        elif jobs > 1:
+            workers = stack.enter_context(multiprocessing.Pool(jobs))
+            results = itertools.chain.from_iterable(workers.imap(flesh, tasks, chunksize=max(1, len(grouped_tasks) // (4 * jobs))))
+        else:
+            results = itertools.chain.from_iterable(map(flesh, tasks))
+
+        for result in results:
+            if result.test_file in files_with_terminal_node_issues:
+                continue
+            for level, message in result.messages:
+                logger.log(level, message)
+            if result.exceeded_limits is not None:
+                files_exceeding_limits.append(result.test_file)
+                quarantine.add(result.test_file, result.seed, result.exceeded_limits)
+            if result.exceeds_budget:
+                files_exceeding_budget.append(result.test_file)
+            if result.has_terminal_node_issues:
+                files_with_terminal_node_issues.append(result.test_file)
+                if cache is not None:
+                    cache.add_failure(result.test_file)
+            if result.has_errors:
+                files_with_errors.append(result.test_file)
+            elif cache is not None and not result.has_terminal_node_issues and result.exceeded_limits is None and not result.exceeds_budget:
+                cache.add_outputs(result.test_file, result.seed, result.output_files, result.signatures)
+            counts = duplicate_counts.setdefault(result.test_file, [0, 0])
+            counts[0] += result.num_tests
+            counts[1] += result.num_duplicates
+            num_amber_files_produced += result.num_amber_files_produced
+            if timings_file is not None:
+                timings = file_timings.setdefault(os.path.relpath(result.test_file, xml_folder), {})
+                for phase, seconds in result.timings.items():
+                    timings[phase] = timings.get(phase, 0.0) + seconds
+            if result.memory_profile is not None:
+                memory_profiles[result.test_file] = merge_memory_profiles(memory_profiles.get(result.test_file), result.seed, result.memory_profile)
+            for entry in result.manifest_entries:
+                manifest.write(json.dumps(entry) + "\n")
+            for merged_test in result.merged_tests:
+                merged_tests.append(merged_test)
+                if len(merged_tests) == merge:
+                    tests, merged_tests = merged_tests, []
+                    write_merged_amber_file(xml_folder, num_amber_files_produced, tests)
+                    num_amber_files_produced += 1
+
+    amber_utils.compact_generation_manifest(xml_folder)
+
+    if len(members) > 0:
+        write_packed_amber_file(xml_folder, num_amber_files_produced, members, x_threads, y_threads, z_threads, include_op_phi, record_decisions_only, pack_directions, use_buffer_files)
+        num_amber_files_produced += 1
+    if len(merged_tests) > 0:
+        write_merged_amber_file(xml_folder, num_amber_files_produced, merged_tests)
+        num_amber_files_produced += 1
+
+    if timings_file is not None:
+        fleshout.write_phase_timings(file_timings, timings_file)
+        logger.info(f"Wrote the time spent in each phase to {timings_file}")
+    for test_file, profile in memory_profiles.items():
+        fleshout.write_memory_profile(profile, fleshout.get_memory_profile_file(test_file))
+    if memprofile:
+        logger.info(f"Wrote memory profiles for {len(memory_profiles)} xml files")
 
     elapsed_time = time.perf_counter() - start_time
     logger.info(f"Found {len(files_with_terminal_node_issues)} CFGs have either no terminal nodes or all terminal nodes are unreachable")
     logger.info(f"Found {len(files_with_errors)} errors when generating amber files")
+    if budget is not None and budget.is_enforced():
+        logger.info(f"Found {len(files_exceeding_budget)} (xml file, seed) pairs whose smallest test exceeds the budget")
+    if timeout is not None or max_rss is not None or quarantine.num_skipped > 0:
+        logger.info(f"Found {len(files_exceeding_limits)} (xml file, seed) pairs exceeding the time or memory limit and skipped {quarantine.num_skipped} quarantined pairs")
     logger.info(f"Produced {num_amber_files_produced} amber files from {num_xml_files_processed} xml files")
+    if cache is not None:
+        logger.info(cache.get_summary())
+    if deduplicate:
+        for test_file, (num_tests, num_duplicates) in duplicate_counts.items():
+            if num_duplicates > 0:
+                logger.info(f"Skipped {num_duplicates} of {num_tests} tests of {test_file} as duplicates ({num_duplicates / num_tests:.1%})")
+        num_tests = sum(counts[0] for counts in duplicate_counts.values())
+        num_duplicates = sum(counts[1] for counts in duplicate_counts.values())
+        logger.info(f"Skipped {num_duplicates} of {num_tests} tests as duplicates")
     logger.info(f"Fleshing executed in: {elapsed_time} seconds")
 
 
@@ -98,7 +793,8 @@ def parse_args():
     parser.add_argument('xml_folder',
                         help='The folder containing xml skeletons generated by Alloy. \
                             The xml skeletons should be in a file called test_0.xml and the folder \
-                            containing the xml file should be the name of the skeleton.')
+                            containing the xml file should be the name of the skeleton. With --all-instances, \
+                            every xml file in the folder is an instance of the skeleton.')
     
     parser.add_argument("--runner-seed", type=int, 
                         help='The seed to use for the PNG in the runner. This can be used to reproduce a particular '
@@ -112,6 +808,27 @@ def parse_args():
     
     seeds_or_repeat_group.add_argument("--repeats", type=int, help='The number of times fleshing is run per xml file.')
 
+    parser.add_argument("--timings", type=str,
+                        help='Write the time spent in each phase of fleshing each xml file (parsing the xml file, analysing the '
+                        'CFG, generating the reference and candidate paths, checking their compatibility, emitting the tests '
+                        'and writing the files) to this file as JSON, with the totals and percentiles of each phase.')
+
+    parser.add_argument("--memprofile", action='store_true',
+                        help='Trace memory allocations with tracemalloc and write the peak traced memory, the peak resident set '
+                        'and the top allocation sites of each phase of fleshing, over the seeds of each xml file, to a report '
+                        'next to the xml file with the extension .memprofile.json. Fleshing is several times slower while tracing.')
+
+    seed_budget_group = parser.add_mutually_exclusive_group(required=False)
+
+    seed_budget_group.add_argument("--seed-budget", type=int,
+                        help='Generate about this many tests in total, giving each xml file a number of seeds that grows with '
+                        'the logarithm of the estimated number of paths through its CFG. Each xml file uses the first of the '
+                        'fleshing seeds, which are drawn using the runner seed if they are not given. Cannot be combined with --repeats.')
+
+    seed_budget_group.add_argument("--seed-budget-seconds", type=float,
+                        help='As for --seed-budget, but spending about this many seconds of generation time, estimated from '
+                        'the generation times recorded in the generation manifest by an earlier run.')
+
     parser.add_argument("--x-threads", type=int, default=1, 
                         help='The maximum number of threads in the x dimension')
     
@@ -136,11 +853,124 @@ def parse_args():
     parser.add_argument("--simple-barriers", action='store_true', 
                         help='Add barriers along a single path. If there are multiple threads, all threads follow that same path.')
 
+    parser.add_argument("--decisions-only", action='store_true',
+                        help='Only record the conditional blocks and the terminal block that are executed in the output buffer. '
+                        'The full path of each thread can be rebuilt from these and the directions.')
+
+    parser.add_argument("--pack-directions", action='store_true',
+                        help='Pack the directions of OpBranchConditional blocks 32 per word in their storage buffers. '
+                        'The directions of OpSwitch blocks are still stored one per word.')
+
+    parser.add_argument("--buffer-files", action='store_true',
+                        help='Write the contents of the storage buffers to binary files next to each amber file, instead of '
+                        'writing them inline. Expectations compare against reference buffers loaded from these files.')
+
+    parser.add_argument("--max-buffer-bytes", type=int,
+                        help='Fit each test to this many bytes of storage buffers, by choosing the largest thread and workgroup '
+                        'counts, up to the maxima, that are predicted to fit, and drawing threads only from the paths that fit on '
+                        'their own. Paths are shortened if none does. Pairs whose test cannot fit are skipped and reported.')
+
+    parser.add_argument("--max-amber-bytes", type=int,
+                        help='Fit each test to an amber file of this many bytes, as for --max-buffer-bytes.')
+
+    parser.add_argument("--max-stores", type=int,
+                        help='Fit each test to this many stores to the output buffer, as for --max-buffer-bytes.')
+
+    parser.add_argument("--thread-shapes", nargs="+", type=fleshout.parse_shape,
+                        help='Sweep these workgroup sizes, each written as XxYxZ, instead of choosing one at random. The paths '
+                        'are generated once per (xml file, seed) and a test is drawn from them for every combination of '
+                        'thread and workgroup shapes. Without --workgroup-shapes, the maximum workgroup counts are used.')
+
+    parser.add_argument("--workgroup-shapes", nargs="+", type=fleshout.parse_shape,
+                        help='Sweep these workgroup counts, each written as XxYxZ, as for --thread-shapes. Without '
+                        '--thread-shapes, the maximum thread counts are used.')
+
+    parser.add_argument("--split-rng", action='store_true',
+                        help='Draw every random choice from its own stream of the seed, keyed by its role and thread, so that '
+                        'the path of any thread can be regenerated on its own with fleshout --regenerate-threads. The tests '
+                        'differ from those generated without this option. Cannot be combined with budgets, --pack or shape sweeps.')
+
+    parser.add_argument("--jobs", type=int, default=1,
+                        help='Flesh the (xml file, seed) pairs in this many processes. The amber files and the log are the '
+                        'same as with one process. Cannot be combined with --pack.')
+
+    parser.add_argument("--all-instances", action='store_true',
+                        help='Flesh every xml file in each folder, such as the several instances that Alloy* can write for '
+                        'a CFG, rather than test_0.xml only. Each instance gets its own seeds and manifest entries. The '
+                        'instances are parsed in bulk first, in --jobs processes, writing their CFG cache files.')
+
+    parser.add_argument("--deduplicate", action='store_true',
+                        help='Skip each test with the same unique paths as an earlier test of the same xml file before writing it, '
+                        'instead of deleting duplicates afterwards with amber_utils deduplicate, and report the duplicate rate '
+                        'of each xml file.')
+
+    parser.add_argument("--timeout", type=int,
+                        help='Flesh each (xml file, seed) pair in a process of its own, which is killed if it runs for longer '
+                        'than this many seconds. Killed pairs are quarantined: later runs skip them until their xml file '
+                        'or fleshout.py changes. A worker that crashes is reported as an error and not quarantined. Cannot be combined with --pack.')
+
+    parser.add_argument("--max-rss", type=int,
+                        help='As for --timeout, but killing the process if its resident set grows beyond this many megabytes.')
+
+    parser.add_argument("--retry-quarantined", action='store_true',
+                        help='Flesh the (xml file, seed) pairs quarantined by earlier runs again.')
+
+    parser.add_argument("--incremental", action='store_true',
+                        help='Skip the (xml file, seed) pairs whose amber files were generated from the same xml file contents, '
+                        'options and version of the flesher and are still there, and the xml files known to have no reachable '
+                        'terminal node. These are remembered in a cache file in the xml folder. Cannot be combined with --pack '
+                        'or --merge.')
+
+    pack_or_merge_group = parser.add_mutually_exclusive_group(required=False)
+
+    pack_or_merge_group.add_argument("--pack", type=int, default=0,
+                        help='Pack the tests for this many (xml file, seed) pairs into each amber file, as one function per '
+                        'test that runs in its own workgroup. Each test uses the maximum number of threads, and the '
+                        'workgroup options only affect the random choices. The amber files are written to a folder '
+                        'called packed in the xml folder.')
+
+    pack_or_merge_group.add_argument("--merge", type=int, default=0,
+                        help='Merge this many independent tests into each amber file, each keeping its own shader, buffers '
+                        'and pipeline under uniquified names. The amber files and manifests mapping their names back to '
+                        'the tests are written to a folder called merged in the xml folder.')
+
     args = parser.parse_args()
 
     if not args.runner_seed:
         args.runner_seed = random.randrange(0, sys.maxsize)
 
+    if (args.thread_shapes is not None or args.workgroup_shapes is not None) and \
+            (args.pack > 0 or args.max_buffer_bytes is not None or args.max_amber_bytes is not None or args.max_stores is not None):
+        parser.error("Shape sweeps cannot be combined with --pack or with budgets")
+
+    if args.incremental and (args.pack > 0 or args.merge > 0):
+        parser.error("--incremental cannot be combined with --pack or --merge")
+
+    if args.deduplicate and args.pack > 0:
+        parser.error("--deduplicate cannot be combined with --pack")
+
+    if (args.timeout is not None or args.max_rss is not None) and args.pack > 0:
+        parser.error("--timeout and --max-rss cannot be combined with --pack")
+
+    if args.jobs > 1 and args.pack > 0:
+        parser.error("--jobs cannot be combined with --pack")
+
+    if args.split_rng and (args.pack > 0 or args.thread_shapes is not None or args.workgroup_shapes is not None or
+                           args.max_buffer_bytes is not None or args.max_amber_bytes is not None or args.max_stores is not None):
+        parser.error("--split-rng cannot be combined with --pack, shape sweeps or budgets")
+
+    if (args.seed_budget is not None or args.seed_budget_seconds is not None) and args.repeats is not None:
+        parser.error("--seed-budget and --seed-budget-seconds cannot be combined with --repeats")
+
+    if args.seed_budget_seconds is not None and len(get_generation_times(args.xml_folder)) == 0:
+        parser.error("--seed-budget-seconds needs the generation times of an earlier run of xml_folder, which are read from "
+                     "its generation manifest, but it has none")
+
+    if args.fleshing_seeds is None and (args.seed_budget is not None or args.seed_budget_seconds is not None):
+        # No xml file gets more seeds than the budget in tests, or than a generous bound for a budget in seconds
+        runner_rng = random.Random(args.runner_seed)
+        args.fleshing_seeds = [runner_rng.randrange(0, sys.maxsize) for _ in range(args.seed_budget if args.seed_budget is not None else 1000)]
+
     if args.fleshing_seeds is None and args.repeats is None:
         args.repeats = 1
 
@@ -180,7 +1010,7 @@ def main():
     logger.info(f"Fleshing seeds: {args.fleshing_seeds}") 
 
     logger.info("Fleshing...")
-    run_fleshing(xml_folder, args.fleshing_seeds, x_threads=args.x_threads, y_threads=args.y_threads, z_threads=args.z_threads, x_workgroups=args.x_workgroups, y_workgroups=args.y_workgroups, z_workgroups=args.z_workgroups, include_barriers=args.simple_barriers, include_op_phi=args.op_phi)
+    run_fleshing(xml_folder, args.fleshing_seeds, x_threads=args.x_threads, y_threads=args.y_threads, z_threads=args.z_threads, x_workgroups=args.x_workgroups, y_workgroups=args.y_workgroups, z_workgroups=args.z_workgroups, include_barriers=args.simple_barriers, include_op_phi=args.op_phi, record_decisions_only=args.decisions_only, pack_directions=args.pack_directions, use_buffer_files=args.buffer_files, pack=args.pack, merge=args.merge, budget=fleshout.Budget(args.max_buffer_bytes, args.max_amber_bytes, args.max_stores), thread_shapes=args.thread_shapes, workgroup_shapes=args.workgroup_shapes, split_rng=args.split_rng, jobs=args.jobs, incremental=args.incremental, deduplicate=args.deduplicate, seed_budget=args.seed_budget, seed_budget_seconds=args.seed_budget_seconds, timings_file=args.timings, memprofile=args.memprofile, all_instances=args.all_instances, timeout=args.timeout, max_rss=args.max_rss * 1024 * 1024 if args.max_rss is not None else None, retry_quarantined=args.retry_quarantined)
 
     logger.info(f"runner seed: {args.runner_seed}")
     logger.info(f"fleshing seeds: {args.fleshing_seeds}")
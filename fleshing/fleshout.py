@@ -16,15 +16,180 @@ from __future__ import annotations
 import sys
 import random
 import xml.etree.ElementTree as elementTree
+import xml.parsers.expat as expat
 import argparse
+import cfg_cache_format
+import contextlib
+import copy
+import functools
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import resource
+import struct
+import time
+import tracemalloc
 from collections import defaultdict, deque
 
 from random import Random
-from typing import Deque, DefaultDict, Dict, List, Set
+from typing import Deque, DefaultDict, Dict, FrozenSet, List, Optional, Set, Tuple
 
 
 MAX_PATH_LENGTH = 900 # Python has a limit on recursion depth of around 1000
 
+# The amber file of a test has, besides its buffers, a header listing its unique paths, its SPIR-V assembly and
+# commands declaring, binding and checking each buffer
+AMBER_HEADER_BYTES = 800
+AMBER_BYTES_PER_BUFFER = 150
+
+
+class PhaseTimer:
+    # Accumulates the time spent in each phase of fleshing while enabled, and profiles the memory of each phase while
+    # it has a memory profiler. The time of a phase named "a/b" is also counted in phase "a". When disabled, timing a
+    # phase costs one call and no clock reads.
+
+    def __init__(self) -> None:
+        self.enabled: bool = False
+        self.seconds: DefaultDict[str, float] = defaultdict(float)
+        self.memory_profiler: Optional[MemoryProfiler] = None
+
+
+    def phase(self, name: str):
+        if not self.enabled and self.memory_profiler is None:
+            return contextlib.nullcontext()
+        return TimedPhase(self, name)
+
+
+    def take(self) -> Dict[str, float]:
+        # The times accumulated since the previous call
+        seconds, self.seconds = dict(self.seconds), defaultdict(float)
+        return seconds
+
+
+class TimedPhase:
+
+    def __init__(self, timer: PhaseTimer, name: str) -> None:
+        self.timer: PhaseTimer = timer
+        self.name: str = name
+        self.start: float = 0.0
+
+
+    def __enter__(self) -> None:
+        if self.timer.memory_profiler is not None:
+            self.timer.memory_profiler.enter_phase()
+        self.start = time.perf_counter()
+
+
+    def __exit__(self, *exc_info) -> None:
+        if self.timer.enabled:
+            self.timer.seconds[self.name] += time.perf_counter() - self.start
+        if self.timer.memory_profiler is not None:
+            self.timer.memory_profiler.exit_phase(self.name)
+
+
+class MemoryProfiler:
+    # Records, for each phase of fleshing, the peak of the memory traced by tracemalloc, how far that peak is above the
+    # memory traced when the phase began, and the peak resident set of the process when the phase ended. It also
+    # records the allocation sites holding the most memory allocated since profiling began, at the end of the
+    # occurrence of the phase whose peak, sites_peak_bytes, is within a third of the highest. Phases can be nested: the
+    # peak of a phase includes those of its sub-phases.
+    NUM_TOP_SITES = 5
+
+    def __init__(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.baseline_bytes: Dict[str, int] = self.get_bytes_per_site()
+        # The memory traced when each open phase began, and the peak traced during it so far
+        self.open_phases: List[List[int]] = []
+        self.phases: Dict[str, Dict] = {}
+        self.peak_bytes: int = 0
+
+
+    @staticmethod
+    def get_max_rss_bytes() -> int:
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+    @staticmethod
+    def get_bytes_per_site() -> Dict[str, int]:
+        return dict((f"{os.path.basename(statistic.traceback[0].filename)}:{statistic.traceback[0].lineno}", statistic.size)
+                    for statistic in tracemalloc.take_snapshot().statistics('lineno'))
+
+
+    def get_top_sites(self) -> Dict[str, int]:
+        # The bytes allocated by each site since profiling began, in decreasing order
+        growth = [(size - self.baseline_bytes.get(site, 0), site) for site, size in self.get_bytes_per_site().items()]
+        return dict((site, size) for size, site in sorted(growth, reverse=True)[:MemoryProfiler.NUM_TOP_SITES] if size > 0)
+
+
+    def enter_phase(self) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        if len(self.open_phases) > 0:
+            self.open_phases[-1][1] = max(self.open_phases[-1][1], peak)
+        self.open_phases.append([current, current])
+        tracemalloc.reset_peak()
+
+
+    def exit_phase(self, name: str) -> None:
+        start, peak = self.open_phases.pop()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        if len(self.open_phases) > 0:
+            self.open_phases[-1][1] = max(self.open_phases[-1][1], peak)
+        self.peak_bytes = max(self.peak_bytes, peak)
+        record = self.phases.get(name)
+        if record is None or peak > record["peak_bytes"]:
+            # Taking a snapshot is slow, so the top sites are only updated when the peak of the phase grows by a half
+            top_sites = self.get_top_sites() if record is None or peak > record["sites_peak_bytes"] * 1.5 else record["top_sites"]
+            sites_peak = peak if record is None or top_sites is not record["top_sites"] else record["sites_peak_bytes"]
+            self.phases[name] = {"peak_bytes": peak, "growth_bytes": peak - start, "max_rss_bytes": self.get_max_rss_bytes(), "sites_peak_bytes": sites_peak, "top_sites": top_sites}
+
+
+    def get_report(self) -> Dict:
+        return {"peak_bytes": max(self.peak_bytes, tracemalloc.get_traced_memory()[1]), "max_rss_bytes": self.get_max_rss_bytes(), "phases": self.phases}
+
+
+# The phase timer of this process, enabled by --timings
+PHASE_TIMER = PhaseTimer()
+
+
+def get_percentile(sorted_values: List[float], percentage: int) -> float:
+    # The nearest-rank percentile
+    return sorted_values[max(0, math.ceil(percentage * len(sorted_values) / 100) - 1)]
+
+
+def summarise_phase_timings(file_timings: Dict[str, Dict[str, float]]) -> Dict:
+    # The times of each xml file, the total of each phase, and the percentiles of each phase over the xml files in
+    # which it ran, with the slowest xml file
+    phases = sorted(set(phase for timings in file_timings.values() for phase in timings))
+    totals = dict((phase, sum(timings.get(phase, 0.0) for timings in file_timings.values())) for phase in phases)
+    percentiles = {}
+    for phase in phases:
+        files = sorted((timings[phase], xml_file) for xml_file, timings in file_timings.items() if phase in timings)
+        values = [seconds for seconds, _ in files]
+        percentiles[phase] = {"p50": get_percentile(values, 50), "p90": get_percentile(values, 90), "p99": get_percentile(values, 99), "max": values[-1], "slowest_file": files[-1][1]}
+    return {"files": file_timings, "totals": totals, "percentiles": percentiles}
+
+
+def write_phase_timings(file_timings: Dict[str, Dict[str, float]], timings_file: str) -> None:
+    with open(timings_file, 'w') as f:
+        json.dump(summarise_phase_timings(file_timings), f, indent=2)
+        f.write("\n")
+
+
+def get_memory_profile_file(xml_file: str) -> str:
+    return xml_file.replace(".xml", ".memprofile.json")
+
+
+def write_memory_profile(report: Dict, memory_profile_file: str) -> None:
+    with open(memory_profile_file, 'w') as f:
+        json.dump(report, f, indent=1)
+        f.write("\n")
+
 
 class NoTerminalNodesInCFGError(Exception):
 
@@ -42,6 +207,36 @@ class TerminalNodesUnreachableFromCurrentNodeError(Exception):
 
     def __init__(self, node, terminal_nodes):
         super().__init__(f"No terminal node could be found starting at node {node}. The terminal nodes are:\n {terminal_nodes}") 
+        self.node = node
+        self.terminal_nodes = terminal_nodes
+
+
+    def __reduce__(self):
+        # So that the error can be raised in a worker process and reported by the parent
+        return (self.__class__, (self.node, self.terminal_nodes))
+
+
+class BudgetExceededError(Exception):
+
+    def __init__(self, sizes, limits):
+        super().__init__(f"Even the smallest test exceeds the budget: its predicted sizes are {sizes} and the limits are {limits}")
+        self.sizes = sizes
+        self.limits = limits
+
+
+    def __reduce__(self):
+        return (self.__class__, (self.sizes, self.limits))
+
+
+class UndecodableDecisionOutputError(Exception):
+
+    def __init__(self, recorded_blocks):
+        super().__init__(f"The recorded blocks {recorded_blocks} do not describe a terminating path through the CFG that follows the given directions.")
+        self.recorded_blocks = recorded_blocks
+
+
+    def __reduce__(self):
+        return (self.__class__, (self.recorded_blocks,))
 
 
 def get_field_from_instance(instance, label):
@@ -138,6 +333,71 @@ def get_switch_blocks(instance) -> Set[str]:
     return result
 
 
+class CFGRelationsReader:
+    # The handler of a single pass of expat over an Alloy instance, which keeps the atoms of the tuples of the fields,
+    # and the atoms of the sigs, that a CFG is built from, and nothing else. As with get_field_from_instance and
+    # get_sig_from_instance, the first field or sig with a name is read.
+    FIELDS: List[str] = ['branch', 'merge', 'continue']
+    SIGS: List[str] = ['EntryBlock', 'Block', 'LoopHeader', 'SelectionHeader', 'SwitchBlock']
+
+    def __init__(self) -> None:
+        self.num_instances: int = 0
+        self.fields: Dict[str, List[List[str]]] = {}
+        self.sigs: Dict[str, List[str]] = {}
+        # The tuples of the field being read, and the atoms of the tuple or sig being read
+        self.tuples: Optional[List[List[str]]] = None
+        self.atoms: Optional[List[str]] = None
+
+    def start_element(self, tag: str, attributes: Dict[str, str]) -> None:
+        if tag == 'atom':
+            if self.atoms is not None:
+                self.atoms.append(attributes['label'])
+        elif tag == 'tuple':
+            if self.tuples is not None:
+                self.atoms = []
+                self.tuples.append(self.atoms)
+        elif tag == 'field' or tag == 'sig' or tag == 'skolem':
+            self.tuples = None
+            self.atoms = None
+            if tag == 'field' and attributes['label'] in self.FIELDS and attributes['label'] not in self.fields:
+                self.tuples = self.fields[attributes['label']] = []
+            elif tag == 'sig':
+                for name in self.SIGS:
+                    if (attributes['label'].endswith('/' + name) or attributes['label'] == name) and name not in self.sigs:
+                        self.atoms = self.sigs[name] = []
+                        break
+        elif tag == 'instance':
+            self.num_instances += 1
+
+    def get_jump_relation(self) -> Dict[str, List[str]]:
+        node_to_int_to_node: Dict[str, Dict[int, str]] = {}
+        for atoms in self.fields['branch']:
+            assert len(atoms) == 3
+            value: Dict[int, str] = node_to_int_to_node.setdefault(atoms[0], {})
+            index: int = int(atoms[1])
+            assert index not in value
+            value[index] = atoms[2]
+        return dict((key, [value[index] for index in range(0, len(value))]) for key, value in node_to_int_to_node.items())
+
+    def get_block_lists(self) -> List[List[str]]:
+        # The regular blocks, loop headers, selection headers and switch blocks, in the order of the xml file
+        return [self.sigs['Block'], self.sigs['LoopHeader'], self.sigs['SelectionHeader'], self.sigs['SwitchBlock']]
+
+    def get_relations(self) -> Tuple:
+        # The relations in the order of the arguments of CFG
+        assert self.num_instances == 1
+        assert all(name in self.fields for name in self.FIELDS) and all(name in self.sigs for name in self.SIGS)
+        assert len(self.sigs['EntryBlock']) > 0
+        return (self.get_jump_relation(),
+                dict((atoms[0], atoms[1]) for atoms in self.fields['merge']),
+                dict((atoms[0], atoms[1]) for atoms in self.fields['continue']),
+                self.sigs['EntryBlock'][0],
+                set(self.sigs['Block']),
+                set(self.sigs['LoopHeader']),
+                set(self.sigs['SelectionHeader']),
+                set(self.sigs['SwitchBlock']))
+
+
 def get_all_blocks(instance) -> Set[str]:
     result: Set[str] = set()
     result.add(get_entry_block(instance))
@@ -223,6 +483,32 @@ def get_exit_blocks(graph) -> Set[str]:
     return result
 
 
+def count_paths_up_to_back_edges(graph, start) -> int:
+    # The number of paths from start that end at a block without successors or at an edge back to a block on the
+    # path. Parallel edges are counted separately. The graph is searched depth first without recursion, and each block
+    # is counted once all of its successors have been. The count of a block is then reused wherever it is reached
+    # again, although it was computed with the blocks on the stack at the time. This is exact for structured CFGs, as
+    # they are reducible: an edge to a block on the stack goes to a loop header that dominates the block it leaves,
+    # and so is on the stack whenever that block is reached. For irreducible graphs the count is only an estimate.
+    counts: Dict[str, int] = {}
+    on_stack: Set[str] = {start}
+    stack = [(start, iter(graph.get(start, [])))]
+    while stack:
+        block, successors = stack[-1]
+        successor = next((successor for successor in successors if successor not in on_stack and successor not in counts), None)
+        if successor is not None:
+            on_stack.add(successor)
+            stack.append((successor, iter(graph.get(successor, []))))
+            continue
+        stack.pop()
+        on_stack.remove(block)
+        if block not in graph:
+            counts[block] = 1
+        else:
+            counts[block] = sum(1 if successor in on_stack else counts[successor] for successor in graph[block])
+    return counts[start]
+
+
 # Function to perform BFS traversal from a given source vertex in a graph to
 # determine if a destination vertex is reachable from the source or not
 def isReachable(graph, s, d):
@@ -278,6 +564,22 @@ def get_doomed_blocks(graph):
     return result
 
 
+# The same blocks as get_doomed_blocks, which is kept as the reference implementation for differential.py, found by
+# working backwards from the exit blocks in time linear in the size of the graph
+def compute_doomed_blocks(graph) -> Set[str]:
+    all_blocks = set(graph.keys()).union(set(x for lst in graph.values() for x in lst))
+    reverse_graph = compute_reverse_graph(graph)
+    reaches_exit: Set[str] = get_exit_blocks(graph)
+    queue: Deque[str] = deque(reaches_exit)
+    while queue:
+        block = queue.popleft()
+        for predecessor in reverse_graph.get(block, ()):
+            if predecessor not in reaches_exit:
+                reaches_exit.add(predecessor)
+                queue.append(predecessor)
+    return all_blocks - reaches_exit
+
+
 # Find a paths of the desired length by doing a random walk that is
 # not allowed to visit a doomed or an exit block proceeding the last block
 def random_paths_of_desired_length_without_passing_through_doomed_(graph, start, length, path, prng):
@@ -500,6 +802,14 @@ def parallel_edges(instance, a, b):
     return False
 
 
+def pack_directions_into_words(directions: List[int]) -> List[int]:
+    # Packs binary directions 32 per word, least significant bit first
+    words: List[int] = [0] * max(1, (len(directions) + 31) // 32)
+    for index, direction in enumerate(directions):
+        words[index >> 5] |= direction << (index & 31)
+    return words
+
+
 def compute_reverse_graph(graph):
     reverse = defaultdict(set)
     for node in graph:
@@ -508,6 +818,15 @@ def compute_reverse_graph(graph):
     return reverse
 
 
+class CFGAnalyses:
+    # The analyses of a CFG that are stored in its cache file, so that they need not be computed again
+
+    def __init__(self, doomed_blocks: Set[str], back_edges: Dict[str, Set[str]], topological_ordering: List[str]) -> None:
+        self.doomed_blocks: Set[str] = doomed_blocks
+        self.back_edges: Dict[str, Set[str]] = back_edges
+        self.topological_ordering: List[str] = topological_ordering
+
+
 class CFG:
     VOID_TYPE_ID: int = 1
     MAIN_FUNCTION_TYPE_ID: int = 2
@@ -526,10 +845,17 @@ class CFG:
                  regular_blocks: Set[str],
                  loop_header_blocks: Set[str],
                  selection_header_blocks: Set[str],
-                 switch_blocks: Set[str]):
+                 switch_blocks: Set[str],
+                 first_block_id: int = ENTRY_BLOCK_ID,
+                 analyses: Optional[CFGAnalyses] = None):
+        # The analyses are computed unless given, as they are when the CFG is read from its cache file
         self.jump_relation: Dict[str, List[str]] = jump_relation
-        self.reverse_graph = compute_reverse_graph(jump_relation)
-        self.non_doomed_graph: Dict[str, List[str]] = self.create_non_doomed_graph()
+        # A plain dict, so that looking up a block without predecessors does not add it to the graph that the copies
+        # made by with_fresh_block_ids share
+        self.reverse_graph: Dict[str, Set[str]] = dict(compute_reverse_graph(jump_relation))
+        with PHASE_TIMER.phase('cfg/doomed_analysis'):
+            self.doomed_blocks: Set[str] = compute_doomed_blocks(self.jump_relation) if analyses is None else analyses.doomed_blocks
+            self.non_doomed_graph: Dict[str, List[str]] = self.create_non_doomed_graph()
         self.exit_blocks = get_exit_blocks(self.jump_relation)
         self.merge_relation = merge_relation
         self.merge_to_loop_header = dict([(self.merge_relation[block], block) for block in loop_header_blocks])
@@ -540,20 +866,23 @@ class CFG:
         self.selection_header_blocks = selection_header_blocks
         self.switch_blocks = switch_blocks
         self.all_blocks = {*self.regular_blocks, *self.loop_header_blocks, *self.selection_header_blocks}
+        # The blocks that a decision can enter, which record themselves when only decisions are recorded
+        self.decision_target_blocks: Set[str] = set(successor for block, successors in self.jump_relation.items() if self.is_conditional(block) for successor in successors)
         self.label_to_id: Dict[str, str] = {}
-        self.next_id = self.ENTRY_BLOCK_ID
+        # Blocks are numbered from first_block_id, so that the blocks of CFGs packed into one module are distinct
+        self.next_id = first_block_id
         assert len(self.loop_header_blocks.intersection(self.selection_header_blocks)) == 0
         assert len(self.loop_header_blocks.intersection(self.switch_blocks)) == 0
         assert self.switch_blocks.issubset(self.selection_header_blocks)
         self.structured_jump_relation: Dict[str, List[str]] = self.compute_structured_jump_relation()
-        self.structured_back_edges: Dict[str, Set[str]] = self.compute_back_edges()
-        self.topological_ordering: List[str] = self.compute_topological_ordering()
+        with PHASE_TIMER.phase('cfg/back_edges'):
+            self.structured_back_edges: Dict[str, Set[str]] = self.compute_back_edges() if analyses is None else analyses.back_edges
+        with PHASE_TIMER.phase('cfg/topological_order'):
+            self.topological_ordering: List[str] = self.compute_topological_ordering() if analyses is None else analyses.topological_ordering
 
 
     def create_non_doomed_graph(self) -> Dict[str, List[str]]:
-        graph = self.jump_relation.copy()
-        doomed = get_doomed_blocks(graph)
-        return get_non_doomed_graph(graph, doomed)
+        return get_non_doomed_graph(self.jump_relation.copy(), self.doomed_blocks)
 
 
     def compute_structured_jump_relation(self) -> Dict[str, List[str]]:
@@ -622,27 +951,37 @@ class CFG:
 
 
     def compute_back_edges(self) -> Dict[str, Set[str]]:
-        def dfs(back_edges: Dict[str, Set[str]], stack: List[str], visited: Set[str], block: str):
-            assert block not in visited
-            assert block not in stack
-            visited.add(block)
-            stack.append(block)
-            if block in self.structured_jump_relation:
-                for successor in self.structured_jump_relation[block]:
-                    if successor in stack:
-                        assert successor in visited
-                        if block not in back_edges:
-                            back_edges[block] = set()
-                        back_edges[block].add(successor)
-                    elif successor not in visited:
-                        dfs(back_edges, stack, visited, successor)
-            stack.pop()
-
+        # A depth first search from the entry block, visiting successors in the same order as the recursive search of
+        # differential.reference_compute_back_edges, without its limit on the depth of the CFG
         result: Dict[str, Set[str]] = {}
-        dfs(result, [], set(), self.entry_block)
+        visited: Set[str] = {self.entry_block}
+        on_stack: Set[str] = {self.entry_block}
+        stack = [(self.entry_block, iter(self.structured_jump_relation.get(self.entry_block, [])))]
+        while stack:
+            block, successors = stack[-1]
+            for successor in successors:
+                if successor in on_stack:
+                    if block not in result:
+                        result[block] = set()
+                    result[block].add(successor)
+                elif successor not in visited:
+                    visited.add(successor)
+                    on_stack.add(successor)
+                    stack.append((successor, iter(self.structured_jump_relation.get(successor, []))))
+                    break
+            else:
+                stack.pop()
+                on_stack.remove(block)
         return result
 
 
+    def estimate_num_paths(self) -> int:
+        # A cheap estimate of the number of distinct paths through the CFG: the number of ways through the CFG up to
+        # leaving it or starting the next iteration of a loop, doubled for each loop, as each iteration of a loop
+        # multiplies the ways through its body
+        return count_paths_up_to_back_edges(self.jump_relation, self.entry_block) * 2 ** len(self.loop_header_blocks)
+
+
     def parallel_edges(self, a, b):
         jump = self.jump_relation.copy()
         if a in jump:
@@ -742,6 +1081,20 @@ class CFG:
         return result
 
 
+    def with_fresh_block_ids(self, first_block_id: int = ENTRY_BLOCK_ID) -> CFG:
+        # A copy that shares the analyses of this CFG, which are never modified, but numbers its blocks afresh. Each
+        # test is fleshed with such a copy, so that loading and analysing a CFG can be done once for many tests.
+        cfg = copy.copy(self)
+        cfg.label_to_id = {}
+        cfg.next_id = first_block_id
+        return cfg
+
+
+    def assign_block_ids(self) -> None:
+        # Numbers the blocks that no path visits, in the same order as to_string does
+        self.to_string()
+
+
     @staticmethod
     def find_nth_occurrence(haystack: str, needle: str, occurrence: int) -> int:
         idx = haystack.find(needle)
@@ -793,7 +1146,12 @@ class CFG:
                                  include_op_phi: bool,
                                  path_ids: Set[str],
                                  conditional_block_ids: Set[str],
-                                 exit_blocks: Set[str]) -> str:
+                                 exit_blocks: Set[str],
+                                 record_decisions_only: bool = False,
+                                 pack_directions: bool = False,
+                                 member_prefix: str = '') -> str:
+        # A non-empty member_prefix means that the CFG is one member of a packed module: its function-local names and
+        # output buffers carry the prefix, and its threads are indexed within their workgroup.
         block_id: str = self.get_block_id(label)
         indent0 = self.indented_block_label(block_id)
         indent1 = ' '*(len("               ") - (len(block_id) + len("%temp___ = ")))
@@ -802,63 +1160,82 @@ class CFG:
         condition = 'temp_' + block_id + '_6' if block_id in path_ids else self.TRUE_CONSTANT_ID
         selector = 'temp_' + block_id + '_5' if block_id in path_ids else self.ZERO_CONSTANT_ID
         if label == self.entry_block:
-            result += '               %output_index = OpVariable %local_int_ptr Function %constant_0\n'
+            result += '               %' + member_prefix + 'output_index = OpVariable %local_int_ptr Function %constant_0\n'
             for block in conditional_block_ids:
                 result += '               %directions_' + str(block) + '_index = OpVariable %local_int_ptr Function %constant_0\n'
 
-            result += '\n               %local_invocation_idx = OpLoad %' + str(self.UINT_TYPE_ID) + ' %local_invocation_idx_var\n'
-
-            result += '               %x_wg_dim_ptr = OpAccessChain %input_int_ptr %workgroup_id_var %constant_0\n'
-            result += '               %y_wg_dim_ptr = OpAccessChain %input_int_ptr %workgroup_id_var %constant_1\n'
-            result += '               %z_wg_dim_ptr = OpAccessChain %input_int_ptr %workgroup_id_var %constant_2\n'
-            result += '               %x_wg_dim = OpLoad %' + str(self.UINT_TYPE_ID) + ' %x_wg_dim_ptr\n'
-            result += '               %y_wg_dim = OpLoad %' + str(self.UINT_TYPE_ID) + ' %y_wg_dim_ptr\n'
-            result += '               %z_wg_dim = OpLoad %' + str(self.UINT_TYPE_ID) + ' %z_wg_dim_ptr\n'
-            result += '               %z_idx_component = OpIMul %' + str(self.UINT_TYPE_ID) + ' %z_wg_dim %constant_' + str(x_workgroups * y_workgroups) + '\n'
-            result += '               %y_idx_component = OpIMul %' + str(self.UINT_TYPE_ID) + ' %y_wg_dim %constant_' + str(x_workgroups) + '\n'
-            result += '               %yz_idx_component = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %y_idx_component %z_idx_component\n'
-            result += '               %workgroup_idx = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %yz_idx_component %x_wg_dim\n\n'
-
-            result += '               %workgroup_offset = OpIMul %' + str(self.UINT_TYPE_ID) + ' %workgroup_idx %constant_' + str(workgroup_size) + '\n'
-            result += '               %thread_index_offset = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %workgroup_offset %local_invocation_idx\n\n'
+            result += '\n               %' + member_prefix + 'local_invocation_idx = OpLoad %' + str(self.UINT_TYPE_ID) + ' %local_invocation_idx_var\n'
+
+            if not member_prefix:
+                result += '               %x_wg_dim_ptr = OpAccessChain %input_int_ptr %workgroup_id_var %constant_0\n'
+                result += '               %y_wg_dim_ptr = OpAccessChain %input_int_ptr %workgroup_id_var %constant_1\n'
+                result += '               %z_wg_dim_ptr = OpAccessChain %input_int_ptr %workgroup_id_var %constant_2\n'
+                result += '               %x_wg_dim = OpLoad %' + str(self.UINT_TYPE_ID) + ' %x_wg_dim_ptr\n'
+                result += '               %y_wg_dim = OpLoad %' + str(self.UINT_TYPE_ID) + ' %y_wg_dim_ptr\n'
+                result += '               %z_wg_dim = OpLoad %' + str(self.UINT_TYPE_ID) + ' %z_wg_dim_ptr\n'
+                result += '               %z_idx_component = OpIMul %' + str(self.UINT_TYPE_ID) + ' %z_wg_dim %constant_' + str(x_workgroups * y_workgroups) + '\n'
+                result += '               %y_idx_component = OpIMul %' + str(self.UINT_TYPE_ID) + ' %y_wg_dim %constant_' + str(x_workgroups) + '\n'
+                result += '               %yz_idx_component = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %y_idx_component %z_idx_component\n'
+                result += '               %workgroup_idx = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %yz_idx_component %x_wg_dim\n\n'
+
+                result += '               %workgroup_offset = OpIMul %' + str(self.UINT_TYPE_ID) + ' %workgroup_idx %constant_' + str(workgroup_size) + '\n'
+                result += '               %thread_index_offset = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %workgroup_offset %local_invocation_idx\n\n'
+            else:
+                result += '               %' + member_prefix + 'thread_index_offset = OpCopyObject %' + str(self.UINT_TYPE_ID) + ' %' + member_prefix + 'local_invocation_idx\n\n'
 
             for block in conditional_block_ids:
-                result += '               %directions_' + str(block) + '_start_idx_ptr = OpAccessChain %storage_buffer_int_ptr %directions_' + str(block) + '_index_variable %constant_0 %thread_index_offset\n'
+                result += '               %directions_' + str(block) + '_start_idx_ptr = OpAccessChain %storage_buffer_int_ptr %directions_' + str(block) + '_index_variable %constant_0 %' + member_prefix + 'thread_index_offset\n'
                 result += '               %directions_' + str(block) + '_offset = OpLoad %' + str(self.UINT_TYPE_ID) + ' %directions_' + str(block) + '_start_idx_ptr\n'
 
-            result += '               %output_start_idx_ptr = OpAccessChain %storage_buffer_int_ptr %output_index_variable %constant_0 %thread_index_offset\n'
-            result += '               %output_offset = OpLoad %' + str(self.UINT_TYPE_ID) + ' %output_start_idx_ptr\n'
+            result += '               %' + member_prefix + 'output_start_idx_ptr = OpAccessChain %storage_buffer_int_ptr %' + member_prefix + 'output_index_variable %constant_0 %' + member_prefix + 'thread_index_offset\n'
+            result += '               %' + member_prefix + 'output_offset = OpLoad %' + str(self.UINT_TYPE_ID) + ' %' + member_prefix + 'output_start_idx_ptr\n'
             result += '\n'
 
             for block in conditional_block_ids:
                 result += '               OpStore %directions_' + str(block) + '_index %directions_' + str(block) + '_offset\n' 
-            result += '               OpStore %output_index %output_offset\n'
+            result += '               OpStore %' + member_prefix + 'output_index %' + member_prefix + 'output_offset\n'
 
             result += '\n'
 
-        predecessors = self.reverse_graph[label]
+        predecessors = self.reverse_graph.get(label, set())
         num_op_phi = 0
         if block_id in path_ids:
+            # When only decisions are recorded, only the blocks that a decision can enter, which tell the way the decision
+            # went, and the terminal blocks write to the output
+            records_block = not record_decisions_only or label in self.decision_target_blocks or block_id in exit_blocks
             if include_op_phi and label != self.entry_block:
                 result += self.create_op_phi_instructions(label, predecessors, num_successors, path_ids, indent1)        
                 num_op_phi += 2
-            else:
-                result += indent1 + '%temp_' + block_id + '_0 = OpLoad %' + str(self.UINT_TYPE_ID) + ' %output_index\n'
+            elif records_block or include_op_phi:
+                result += indent1 + '%temp_' + block_id + '_0 = OpLoad %' + str(self.UINT_TYPE_ID) + " %" + member_prefix + "output_index\n"
 
-            output_increment = 2 if block_id in exit_blocks else 1
-            result += indent1 + '%temp_' + block_id + '_1 = OpAccessChain %storage_buffer_int_ptr %output_variable %constant_0 %temp_' + block_id + '_0\n' + \
-                      '               OpStore %temp_' + block_id + '_1 %constant_' + block_id + '\n' + \
-                      indent1 + '%temp_' + block_id + '_2 = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_0 %constant_' + str(output_increment) + '\n'
+            if records_block:
+                output_increment = 2 if block_id in exit_blocks else 1
+                result += indent1 + '%temp_' + block_id + '_1 = OpAccessChain %storage_buffer_int_ptr %' + member_prefix + 'output_variable %constant_0 %temp_' + block_id + '_0\n' + \
+                          '               OpStore %temp_' + block_id + '_1 %constant_' + block_id + '\n' + \
+                          indent1 + '%temp_' + block_id + '_2 = OpIAdd %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_0 %constant_' + str(output_increment) + '\n'
 
-            if not include_op_phi:
-                result += '               OpStore %output_index %temp_' + block_id + '_2\n'
+                if not include_op_phi:
+                    result += '               OpStore %' + member_prefix + 'output_index %temp_' + block_id + '_2\n'
+            elif include_op_phi:
+                # The output index still has to flow through this block to the OpPhi instructions of its successors
+                result += indent1 + '%temp_' + block_id + '_2 = OpCopyObject %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_0\n'
 
             if block_id in conditional_block_ids:
                 if not include_op_phi or label == self.entry_block:
                     result += indent1 + '%temp_' + block_id + '_3 = OpLoad %' + str(self.UINT_TYPE_ID) + ' %directions_' + block_id + '_index\n'
 
-                result += indent1 + '%temp_' + block_id + '_4 = OpAccessChain %storage_buffer_int_ptr %directions_' + block_id + '_variable %constant_0 %temp_' + block_id + '_3\n' + \
-                          indent1 + '%temp_' + block_id + '_5 = OpLoad %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_4\n'
+                if pack_directions and label not in self.switch_blocks:
+                    # The directions are packed 32 per word, so the index counts bits: find the word, then extract the bit
+                    result += indent1 + '%temp_' + block_id + '_8 = OpShiftRightLogical %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_3 %constant_5\n' + \
+                              indent1 + '%temp_' + block_id + '_4 = OpAccessChain %storage_buffer_int_ptr %directions_' + block_id + '_variable %constant_0 %temp_' + block_id + '_8\n' + \
+                              indent1 + '%temp_' + block_id + '_9 = OpLoad %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_4\n' + \
+                              indent1 + '%temp_' + block_id + '_10 = OpBitwiseAnd %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_3 %constant_31\n' + \
+                              indent1 + '%temp_' + block_id + '_11 = OpShiftRightLogical %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_9 %temp_' + block_id + '_10\n' + \
+                              indent1 + '%temp_' + block_id + '_5 = OpBitwiseAnd %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_11 %constant_1\n'
+                else:
+                    result += indent1 + '%temp_' + block_id + '_4 = OpAccessChain %storage_buffer_int_ptr %directions_' + block_id + '_variable %constant_0 %temp_' + block_id + '_3\n' + \
+                              indent1 + '%temp_' + block_id + '_5 = OpLoad %' + str(self.UINT_TYPE_ID) + ' %temp_' + block_id + '_4\n'
 
                 if label not in self.switch_blocks:
                     result += indent1 + '%temp_' + block_id + '_6 = OpIEqual %' + str(self.BOOL_TYPE_ID) + ' %temp_' + block_id + '_5 %constant_1\n' + \
@@ -922,6 +1299,35 @@ class CFG:
         return (z_threads-1) * x_threads * y_threads + (y_threads-1) * x_threads + (x_threads-1) + 1
 
 
+    @staticmethod
+    def buffer_file_name(buffer_name: str, buffer_file_prefix: str) -> str:
+        return '.'.join(filter(None, [buffer_file_prefix, buffer_name, 'bin']))
+
+
+    @staticmethod
+    def buffer_file_contents(values: List) -> bytes:
+        return struct.pack('<{0}I'.format(len(values)), *[int(value) for value in values])
+
+
+    @staticmethod
+    def declare_buffer(buffer_name: str, values: List, buffer_files: Optional[Dict[str, bytes]], buffer_file_prefix: str) -> str:
+        # If buffer_files is given, the values are added to it as a little-endian binary file that the buffer is loaded
+        # from, rather than being written inline. The buffer then also gets a reference copy for its expectation.
+        if buffer_files is None:
+            return ' BUFFER {0} DATA_TYPE uint32 STD430 DATA {1} END\n'.format(buffer_name, ' '.join([str(value) for value in values]))
+        file_name = CFG.buffer_file_name(buffer_name, buffer_file_prefix)
+        buffer_files[file_name] = CFG.buffer_file_contents(values)
+        return ' BUFFER {0} DATA_TYPE uint32 STD430 FILE BINARY {1}\n'.format(buffer_name, file_name) + \
+               ' BUFFER {0}_expected DATA_TYPE uint32 STD430 FILE BINARY {1}\n'.format(buffer_name, file_name)
+
+
+    @staticmethod
+    def expect_buffer(buffer_name: str, values: List, use_reference_buffer: bool) -> str:
+        if use_reference_buffer:
+            return ' EXPECT {0} EQ_BUFFER {0}_expected\n'.format(buffer_name)
+        return ' EXPECT {0} IDX 0 EQ {1}\n'.format(buffer_name, ' '.join([str(value) for value in values]))
+
+
     def fleshout(self, 
                  paths: List[Path], 
                  prng: Random, 
@@ -932,7 +1338,11 @@ class CFG:
                  x_workgroups: int, 
                  y_workgroups: int, 
                  z_workgroups: int, 
-                 include_op_phi: bool) -> str:
+                 include_op_phi: bool,
+                 record_decisions_only: bool = False,
+                 pack_directions: bool = False,
+                 buffer_files: Optional[Dict[str, bytes]] = None,
+                 buffer_file_prefix: str = '') -> str:
         """
 ███████ ██      ███████ ███████ ██   ██ ██ ███    ██  ██████       ██████  ██    ██ ████████ 
 ██      ██      ██      ██      ██   ██ ██ ████   ██ ██           ██    ██ ██    ██    ██    
@@ -940,7 +1350,46 @@ class CFG:
 ██      ██      ██           ██ ██   ██ ██ ██  ██ ██ ██    ██     ██    ██ ██    ██    ██    
 ██      ███████ ███████ ███████ ██   ██ ██ ██   ████  ██████       ██████   ██████     ██                                                                                                                                                                                
         """
-        all_blocks_id: List[str] = [self.label_to_id[block] for block in self.all_blocks]
+        return CFG.fleshout_members([ModuleMember(self, paths, prng, seed)],
+                                    x_threads,
+                                    y_threads,
+                                    z_threads,
+                                    x_workgroups,
+                                    y_workgroups,
+                                    z_workgroups,
+                                    include_op_phi,
+                                    record_decisions_only,
+                                    pack_directions,
+                                    buffer_files,
+                                    buffer_file_prefix)
+
+
+    @staticmethod
+    def fleshout_members(members: List[ModuleMember],
+                         x_threads: int, 
+                         y_threads: int, 
+                         z_threads: int, 
+                         x_workgroups: int, 
+                         y_workgroups: int, 
+                         z_workgroups: int, 
+                         include_op_phi: bool,
+                         record_decisions_only: bool = False,
+                         pack_directions: bool = False,
+                         buffer_files: Optional[Dict[str, bytes]] = None,
+                         buffer_file_prefix: str = '',
+                         is_packed: bool = False,
+                         asm_only: bool = False) -> str:
+        # Unless the module is packed, its single member is fleshed into the main function. In a packed module each
+        # member is fleshed into a function of its own, and main calls the function of member k in workgroup k. Block
+        # ids must be distinct across the members, as they name the blocks and the directions buffers. Each member
+        # gets its own output buffers, and its threads are indexed within their workgroup. If asm_only is set, only the
+        # SPIR-V assembly of the shader is returned.
+        assert is_packed or len(members) == 1
+        prefixes: List[str] = ['member_{0}_'.format(index) if is_packed else '' for index in range(len(members))]
+        output_names: List[str] = [prefix + 'output' for prefix in prefixes]
+        paths: List[Path] = [path for member in members for path in member.paths]
+
+        all_blocks_id: List[str] = [member.cfg.label_to_id[block] for member in members for block in member.cfg.all_blocks]
         all_blocks_id.sort()
 
         conditional_block_ids: List[str] = list(set([id for path in paths for id in path.conditional_block_ids]))
@@ -950,50 +1399,45 @@ class CFG:
         #                2: for incrementing the last output index
         constants: Set[str] = {str(0), str(1), str(2)}.union(set(all_blocks_id))
 
-        num_local_threads = self.compute_num_threads(x_threads, y_threads, z_threads)
-        num_workgroups = self.compute_num_workgroups(x_workgroups, y_workgroups, z_workgroups)
+        num_local_threads = CFG.compute_num_threads(x_threads, y_threads, z_threads)
+        num_workgroups = CFG.compute_num_workgroups(x_workgroups, y_workgroups, z_workgroups)
         total_num_threads = num_local_threads * num_workgroups
         constants.update(str(x) for x in [x_threads, y_threads, z_threads, x_workgroups, y_workgroups, x_workgroups * y_workgroups, num_local_threads, total_num_threads])
 
-        # find the sizes of the input and output arrays
-        array_sizes: DefaultDict[str, int] = defaultdict(int)
-        index_offsets: DefaultDict[str, List[int]] = defaultdict(list)
-        for path in paths:
-            unvisited = set(conditional_block_ids).union({'output'})
-            for arr_name, size in path.array_sizes.items():
-                unvisited.remove(arr_name)
-                index_offsets[arr_name].append(array_sizes[arr_name])
-                array_sizes[arr_name] += size
-            
-            for arr_name in unvisited:
-                index_offsets[arr_name].append(0)
+        array_sizes, index_offsets, directions, expected_outputs, packed_block_ids = CFG.compute_storage_buffers(members, output_names, record_decisions_only, pack_directions)
+        if pack_directions:
+            constants.update([str(5), str(31)])
 
         # Set size of the arrays that will hold the starting indices for each thread
-        array_sizes["index"] = total_num_threads
+        array_sizes["index"] = num_local_threads if is_packed else total_num_threads
 
         unique_array_sizes: Set[int] = set(array_sizes.values())
         constants.update([constant for path in paths for constant in path.constants])
         constants.update([str(val) for val in unique_array_sizes])
 
+        # The output arrays have types of their own, so the sized types are only needed for the other arrays
+        sized_array_sizes: Set[int] = set(size for arr_name, size in array_sizes.items() if arr_name not in output_names)
+
         tab: str = '               '
         constants2string = '\n'
-        constants2string += tab + f"%dummy_val = OpConstant %{str(self.UINT_TYPE_ID)} {str(666)}\n"
+        constants2string += tab + f"%dummy_val = OpConstant %{str(CFG.UINT_TYPE_ID)} {str(666)}\n"
         for i in constants:
-            constants2string += tab + '%constant_' + str(i) + ' = OpConstant %' + str(self.UINT_TYPE_ID) + ' ' + str(i) + '\n'
+            constants2string += tab + '%constant_' + str(i) + ' = OpConstant %' + str(CFG.UINT_TYPE_ID) + ' ' + str(i) + '\n'
 
         # types_variables is used to declare various types and variables for storage buffers.
         types_variables = ''
 
         for b in set(unique_array_sizes):
-            if b != array_sizes['output'] or array_sizes['index'] == array_sizes['output']:
+            if b in sized_array_sizes:
                 types_variables += '\n' + \
                     tab + 'OpDecorate %size_' + str(b) + '_struct_type BufferBlock\n' + \
                     tab + 'OpMemberDecorate %size_' + str(b) + '_struct_type 0 Offset 0\n' + \
                     tab + 'OpDecorate %size_' + str(b) + '_array_type ArrayStride 4\n'
 
-        types_variables += '\n' + tab + 'OpDecorate %output_struct_type BufferBlock\n' + \
-                                  tab + 'OpMemberDecorate %output_struct_type 0 Offset 0\n' + \
-                                  tab + 'OpDecorate %output_array_type ArrayStride 4\n'
+        for output_name in output_names:
+            types_variables += '\n' + tab + 'OpDecorate %' + output_name + '_struct_type BufferBlock\n' + \
+                                      tab + 'OpMemberDecorate %' + output_name + '_struct_type 0 Offset 0\n' + \
+                                      tab + 'OpDecorate %' + output_name + '_array_type ArrayStride 4\n'
         
         bindings: Dict[str, int] = {}
         for i in conditional_block_ids:
@@ -1004,56 +1448,55 @@ class CFG:
                                       tab + 'OpDecorate %directions_' + str(i) + '_index_variable Binding ' + str(len(bindings)) + '\n'
             bindings[f"{i}_index"] = len(bindings)
 
-        types_variables += '\n' + tab + 'OpDecorate %output_variable DescriptorSet 0\n' + \
-                                  tab + 'OpDecorate %output_variable Binding ' + str(len(bindings)) + '\n'
-        bindings['output'] = len(bindings)
-        types_variables += '\n' + tab + 'OpDecorate %output_index_variable DescriptorSet 0\n' + \
-                                  tab + 'OpDecorate %output_index_variable Binding ' + str(len(bindings)) + '\n'
-        bindings['output_index'] = len(bindings)
+        for output_name in output_names:
+            types_variables += '\n' + tab + 'OpDecorate %' + output_name + '_variable DescriptorSet 0\n' + \
+                                      tab + 'OpDecorate %' + output_name + '_variable Binding ' + str(len(bindings)) + '\n'
+            bindings[output_name] = len(bindings)
+            types_variables += '\n' + tab + 'OpDecorate %' + output_name + '_index_variable DescriptorSet 0\n' + \
+                                      tab + 'OpDecorate %' + output_name + '_index_variable Binding ' + str(len(bindings)) + '\n'
+            bindings[output_name + '_index'] = len(bindings)
 
         storage_buffers = ''
         for s in set(unique_array_sizes):
-            if array_sizes['output'] != s or array_sizes['index'] == array_sizes['output']:
-                storage_buffers += '\n' + tab + '%size_' + str(s) + '_array_type = OpTypeArray %' + str(self.UINT_TYPE_ID) + ' %constant_' + str(s) + '\n' + \
+            if s in sized_array_sizes:
+                storage_buffers += '\n' + tab + '%size_' + str(s) + '_array_type = OpTypeArray %' + str(CFG.UINT_TYPE_ID) + ' %constant_' + str(s) + '\n' + \
                                           tab + '%size_' + str(s) + '_struct_type = OpTypeStruct %size_' + str(s) + '_array_type\n' + \
                                           tab + '%size_' + str(s) + '_pointer_type = OpTypePointer Uniform %size_' + str(s) + '_struct_type\n'
 
         storage_buffers += '\n'
         for id, size in array_sizes.items():
-            if id == "output" or id == "index":
+            if id in output_names or id == "index":
                 continue
             storage_buffers += tab + f"%directions_{str(id)}_variable = OpVariable %size_{str(size)}_pointer_type Uniform\n"
             storage_buffers += tab + f"%directions_{str(id)}_index_variable = OpVariable %size_{str(array_sizes['index'])}_pointer_type Uniform\n"
 
-        storage_buffers += '\n' + tab + '%output_array_type = OpTypeArray %' + str(self.UINT_TYPE_ID) + ' %constant_' + str(array_sizes['output']) + '\n' + \
-                                  tab + '%output_struct_type = OpTypeStruct %output_array_type\n' + \
-                                  tab + '%output_pointer_type = OpTypePointer Uniform %output_struct_type\n'+ \
-                                  tab + '%output_variable = OpVariable %output_pointer_type Uniform\n'+ \
-                                  tab + f"%output_index_variable = OpVariable %size_{str(array_sizes['index'])}_pointer_type Uniform\n\n"+ \
-                                  tab + '%local_int_ptr = OpTypePointer Function %' + str(self.UINT_TYPE_ID) + '\n'+ \
-                                  tab + '%storage_buffer_int_ptr = OpTypePointer Uniform %' + str(self.UINT_TYPE_ID) + '\n'
+        for output_name in output_names:
+            storage_buffers += '\n' + tab + '%' + output_name + '_array_type = OpTypeArray %' + str(CFG.UINT_TYPE_ID) + ' %constant_' + str(array_sizes[output_name]) + '\n' + \
+                                      tab + '%' + output_name + '_struct_type = OpTypeStruct %' + output_name + '_array_type\n' + \
+                                      tab + '%' + output_name + '_pointer_type = OpTypePointer Uniform %' + output_name + '_struct_type\n'+ \
+                                      tab + '%' + output_name + '_variable = OpVariable %' + output_name + '_pointer_type Uniform\n'+ \
+                                      tab + f"%{output_name}_index_variable = OpVariable %size_{str(array_sizes['index'])}_pointer_type Uniform\n"
+        storage_buffers += '\n' + tab + '%local_int_ptr = OpTypePointer Function %' + str(CFG.UINT_TYPE_ID) + '\n'+ \
+                                  tab + '%storage_buffer_int_ptr = OpTypePointer Uniform %' + str(CFG.UINT_TYPE_ID) + '\n'
 
         end = '\n\n END\n\n'
 
-        directions: DefaultDict[str, List[int]] = defaultdict(list)
-        for path in paths:
-            for block_id, choices in path.directions.items():
-                directions[block_id] += choices
-
         for block_id, choices in directions.items():
-            end += ' BUFFER directions_{0} DATA_TYPE uint32 STD430 DATA {1} END\n'\
-                .format(block_id, ' '.join([str(direction) for direction in directions[block_id]]))
-            end += ' BUFFER directions_{0}_index DATA_TYPE uint32 STD430 DATA {1} END\n'\
-                .format(block_id, ' '.join([str(index) for index in index_offsets[block_id]]))
+            end += CFG.declare_buffer('directions_' + block_id, directions[block_id], buffer_files, buffer_file_prefix)
+            end += CFG.declare_buffer('directions_' + block_id + '_index', index_offsets[block_id], buffer_files, buffer_file_prefix)
         
 
+        for output_name, expected_output in zip(output_names, expected_outputs):
+            end += '\n BUFFER {0} DATA_TYPE uint32 STD430 SIZE {1} FILL 0\n'.format(output_name, array_sizes[output_name])
+            end += CFG.declare_buffer(output_name + '_index', index_offsets[output_name], buffer_files, buffer_file_prefix)
+            if buffer_files is not None:
+                output_expected_file = CFG.buffer_file_name(output_name + '_expected', buffer_file_prefix)
+                buffer_files[output_expected_file] = CFG.buffer_file_contents(expected_output)
+                end += ' BUFFER {0}_expected DATA_TYPE uint32 STD430 FILE BINARY {1}\n'.format(output_name, output_expected_file)
         end += """
- BUFFER output DATA_TYPE uint32 STD430 SIZE {0} FILL 0
- BUFFER output_index DATA_TYPE uint32 STD430 DATA {1} END
-
  PIPELINE compute pipeline
    ATTACH compute_shader
-""".format(array_sizes['output'], ' '.join([str(index) for index in index_offsets['output']]))
+"""
 
         for id in conditional_block_ids:
             end += '   BIND BUFFER directions_{0} AS storage DESCRIPTOR_SET 0 BINDING {1}\n' \
@@ -1061,34 +1504,60 @@ class CFG:
             end += '   BIND BUFFER directions_{0}_index AS storage DESCRIPTOR_SET 0 BINDING {1}\n' \
                 .format(id, bindings[str(id) + "_index"])
 
+        end += '\n'
+        for output_name in output_names:
+            end += '   BIND BUFFER {0} AS storage DESCRIPTOR_SET 0 BINDING {1}\n'.format(output_name, bindings[output_name])
+            end += '   BIND BUFFER {0}_index AS storage DESCRIPTOR_SET 0 BINDING {1}\n'.format(output_name, bindings[output_name + '_index'])
         end += """
-   BIND BUFFER output AS storage DESCRIPTOR_SET 0 BINDING {0}
-   BIND BUFFER output_index AS storage DESCRIPTOR_SET 0 BINDING {1}
-
  END
- RUN pipeline {2} {3} {4}\n
-""".format(bindings['output'], bindings['output_index'], x_workgroups, y_workgroups, z_workgroups)
+ RUN pipeline {0} {1} {2}\n
+""".format(x_workgroups, y_workgroups, z_workgroups)
 
         for id in conditional_block_ids:
-            end += ' EXPECT directions_{0} IDX 0 EQ {1}\n' \
-                .format(id, ' '.join([str(direction) for direction in directions[id]]))
-            end += ' EXPECT directions_{0}_index IDX 0 EQ {1}\n' \
-                .format(id, ' '.join([str(index) for index in index_offsets[id]]))
-
-        expected_output = []
-        for path in paths:
-            expected_output += [id for id in path.id_path] + [str(0)]
-        end += ' EXPECT output IDX 0 EQ {0}\n' \
-            .format(' '.join(expected_output))
-        end += ' EXPECT output_index IDX 0 EQ {0}\n' \
-            .format(' '.join([str(index) for index in index_offsets['output']]))
+            end += CFG.expect_buffer('directions_' + id, directions[id], buffer_files is not None)
+            end += CFG.expect_buffer('directions_' + id + '_index', index_offsets[id], buffer_files is not None)
+        for output_name, expected_output in zip(output_names, expected_outputs):
+            end += CFG.expect_buffer(output_name, expected_output, buffer_files is not None)
+            end += CFG.expect_buffer(output_name + '_index', index_offsets[output_name], buffer_files is not None)
 
 
         paths2string = ''
-        for path_idx, path in enumerate(set(paths)):
-            paths2string += f"; unique path #{path_idx}: {str(path)}\n"
-
-        result_fleshed = """#!amber
+        if not is_packed:
+            for path_idx, path in enumerate(set(paths)):
+                paths2string += f"; unique path #{path_idx}: {str(path)}\n"
+        else:
+            for member_idx, member in enumerate(members):
+                member_block_ids = [int(member.cfg.label_to_id[block]) for block in member.cfg.all_blocks]
+                paths2string += f"; member #{member_idx} (workgroup {member_idx}, blocks {min(member_block_ids)} to {max(member_block_ids)}): {member.description}\n"
+                for path_idx, path in enumerate(set(member.paths)):
+                    paths2string += f"; unique path #{path_idx}: {str(path)}\n"
+
+        format_args = [CFG.MAIN_FUNCTION_ID,
+                       CFG.VOID_TYPE_ID,
+                       CFG.MAIN_FUNCTION_TYPE_ID,
+                       CFG.BOOL_TYPE_ID,
+                       CFG.UINT_TYPE_ID,
+                       CFG.TRUE_CONSTANT_ID,
+                       CFG.ZERO_CONSTANT_ID,
+                       paths2string, # {7}
+                       len(conditional_block_ids), # {8}
+                       ' and '.join(filter(None, [', '.join(conditional_block_ids[:-1])] + conditional_block_ids[-1:])), # {9}
+                       ' or '.join(filter(None, [', '.join(conditional_block_ids[:-1])] + conditional_block_ids[-1:])),  # {10}
+                       types_variables, # {11}
+                       constants2string, # {12}
+                       storage_buffers, # {13}
+                       ', '.join([str(member.seed) for member in members]), # {14}
+                       min([len(path) for path in paths]), # {15}
+                       max([len(path) for path in paths]), # {16}
+                       x_threads, # {17}
+                       y_threads, # {18}
+                       z_threads, # {19}
+                       'blocks entered by a decision and the terminal block' if record_decisions_only else 'blocks', # {20}
+                       ' (packed 32 per word for OpBranchConditional nodes)' if pack_directions else '', # {21}
+                       len(members), # {22}
+                       ', one per member' if is_packed else ''] # {23}
+
+        amber_header = """#!amber
 SHADER compute compute_shader SPIRV-ASM
 ; Follow the path(s):
 {7}
@@ -1098,11 +1567,12 @@ SHADER compute compute_shader SPIRV-ASM
 ; To follow these paths, we need to make decisions each time we reach {10}.
 ; These paths were generated with the seed {14} and have lengths ranging from {15} to {16}.
 ;
-; We equip the shader with {8}+1 storage buffers:
-; - An input storage buffer with the directions for each node {10}
-; - An output storage buffer that records the blocks that are executed
+; We equip the shader with {8}+{22} storage buffers:
+; - An input storage buffer with the directions for each node {10}{21}
+; - An output storage buffer that records the {20} that are executed{23}
 
-; SPIR-V
+""".format(*format_args)
+        result_asm = """; SPIR-V
 ; Version: 1.3
 ; Generator: Khronos Glslang Reference Front End; 8
 ; Bound: 15
@@ -1133,35 +1603,141 @@ SHADER compute compute_shader SPIRV-ASM
                %workgroup_ptr = OpTypePointer Input %vec_3_input 
                %workgroup_id_var = OpVariable %workgroup_ptr Input
 
-          %{0} = OpFunction %{1} None %{2}
-""".format(self.MAIN_FUNCTION_ID,
-                   self.VOID_TYPE_ID,
-                   self.MAIN_FUNCTION_TYPE_ID,
-                   self.BOOL_TYPE_ID,
-                   self.UINT_TYPE_ID,
-                   self.TRUE_CONSTANT_ID,
-                   self.ZERO_CONSTANT_ID,
-                   paths2string, # {7}
-                   len(conditional_block_ids), # {8}
-                   ' and '.join(filter(None, [', '.join(conditional_block_ids[:-1])] + conditional_block_ids[-1:])), # {9}
-                   ' or '.join(filter(None, [', '.join(conditional_block_ids[:-1])] + conditional_block_ids[-1:])),  # {10}
-                   types_variables, # {11}
-                   constants2string, # {12}
-                   storage_buffers, # {13}
-                   seed, # {14}
-                   min([len(path) for path in paths]), # {15}
-                   max([len(path) for path in paths]), # {16}
-                   x_threads, # {17}
-                   y_threads, # {18}
-                   z_threads) # {19}
+""".format(*format_args)
         
         path_ids: Set[str] = set(id for path in paths for id in path.id_path)
         exit_blocks: Set[str] = set(path.id_path[-1] for path in paths)
-        result_fleshed += "\n".join([self.block_to_string_fleshing(block, paths, x_workgroups, y_workgroups, num_local_threads, prng, include_op_phi, path_ids, set(conditional_block_ids), exit_blocks) for block in self.topological_ordering])
-        result_fleshed += "\n               OpFunctionEnd"
-        result_fleshed += end
+        if not is_packed:
+            member = members[0]
+            result_asm += "          %{0} = OpFunction %{1} None %{2}\n".format(CFG.MAIN_FUNCTION_ID, CFG.VOID_TYPE_ID, CFG.MAIN_FUNCTION_TYPE_ID)
+            result_asm += "\n".join([member.cfg.block_to_string_fleshing(block, member.paths, x_workgroups, y_workgroups, num_local_threads, member.rng, include_op_phi, path_ids, set(conditional_block_ids), exit_blocks, record_decisions_only, pack_directions) for block in member.cfg.topological_ordering])
+            result_asm += "\n               OpFunctionEnd"
+        else:
+            for prefix, member in zip(prefixes, members):
+                member_conditional_block_ids = set(id for path in member.paths for id in path.conditional_block_ids)
+                result_asm += "          %{0}function = OpFunction %{1} None %{2}\n".format(prefix, CFG.VOID_TYPE_ID, CFG.MAIN_FUNCTION_TYPE_ID)
+                result_asm += "\n".join([member.cfg.block_to_string_fleshing(block, member.paths, x_workgroups, y_workgroups, num_local_threads, member.rng, include_op_phi, path_ids, member_conditional_block_ids, exit_blocks, record_decisions_only, pack_directions, prefix) for block in member.cfg.topological_ordering])
+                result_asm += "\n               OpFunctionEnd\n\n"
+            result_asm += CFG.dispatch_to_members_string(prefixes)
+        if asm_only:
+            return result_asm
+        return amber_header + result_asm + end
+
+
+    @staticmethod
+    def compute_storage_buffers(members: List[ModuleMember], output_names: List[str], record_decisions_only: bool, pack_directions: bool):
+        # Returns the sizes of the directions and output buffers, the offset of each thread into each of them, the
+        # directions, the expected output of each member and the blocks whose directions are packed into bits
+        array_sizes: DefaultDict[str, int] = defaultdict(int)
+        index_offsets: DefaultDict[str, List[int]] = defaultdict(list)
+        for member, output_name in zip(members, output_names):
+            member_conditional_block_ids: Set[str] = set(id for path in member.paths for id in path.conditional_block_ids)
+            for path in member.paths:
+                unvisited = member_conditional_block_ids.union({output_name})
+                path_array_sizes: Dict[str, int] = dict((output_name if arr_name == 'output' else arr_name, size) for arr_name, size in path.array_sizes.items())
+                if record_decisions_only:
+                    path_array_sizes[output_name] = len(path.decision_id_path) + 1
+                for arr_name, size in path_array_sizes.items():
+                    unvisited.remove(arr_name)
+                    index_offsets[arr_name].append(array_sizes[arr_name])
+                    array_sizes[arr_name] += size
+                
+                for arr_name in unvisited:
+                    index_offsets[arr_name].append(0)
+
+        # Directions of OpBranchConditional blocks are packed 32 per word, and their indices count bits rather than words
+        packed_block_ids: Set[str] = set()
+        if pack_directions:
+            packed_block_ids = set(block_id for member in members for path in member.paths for label, block_id in zip(path.conditional_block_labels, path.conditional_block_ids) if label not in path.cfg.switch_blocks)
+        for block_id in packed_block_ids:
+            array_sizes[block_id] = max(1, (array_sizes[block_id] + 31) // 32)
+
+        directions: DefaultDict[str, List[int]] = defaultdict(list)
+        for member in members:
+            for path in member.paths:
+                for block_id, choices in path.directions.items():
+                    directions[block_id] += choices
+        for block_id in packed_block_ids:
+            directions[block_id] = pack_directions_into_words(directions[block_id])
+
+        expected_outputs: List[List[str]] = []
+        for member in members:
+            expected_output = []
+            for path in member.paths:
+                if record_decisions_only:
+                    assert member.cfg.decode_decision_path(path.decision_id_path, path.directions) == path.id_path
+                    expected_output += [id for id in path.decision_id_path] + [str(0)]
+                else:
+                    expected_output += [id for id in path.id_path] + [str(0)]
+            expected_outputs.append(expected_output)
+        return array_sizes, index_offsets, directions, expected_outputs, packed_block_ids
+
+
+    @staticmethod
+    def dispatch_to_members_string(prefixes: List[str]) -> str:
+        # The main function of a packed module calls the function of member k in workgroup k. The workgroup id is
+        # uniform across the workgroup, so barriers in the members stay in uniform control flow.
+        result = "          %{0} = OpFunction %{1} None %{2}\n".format(CFG.MAIN_FUNCTION_ID, CFG.VOID_TYPE_ID, CFG.MAIN_FUNCTION_TYPE_ID)
+        result += "\n%main_entry = OpLabel\n"
+        result += "               %main_workgroup_id_x_ptr = OpAccessChain %input_int_ptr %workgroup_id_var %constant_0\n"
+        result += "               %main_workgroup_id_x = OpLoad %{0} %main_workgroup_id_x_ptr\n".format(CFG.UINT_TYPE_ID)
+        result += "               OpSelectionMerge %main_merge None\n"
+        result += "               OpSwitch %main_workgroup_id_x %main_merge"
+        for index, prefix in enumerate(prefixes):
+            result += " {0} %{1}call".format(index, prefix)
+        result += "\n"
+        for prefix in prefixes:
+            result += "\n%{0}call = OpLabel\n".format(prefix)
+            result += "               %{0}call_result = OpFunctionCall %{1} %{0}function\n".format(prefix, CFG.VOID_TYPE_ID)
+            result += "               OpBranch %main_merge\n"
+        result += "\n%main_merge = OpLabel\n"
+        result += "               OpReturn\n"
+        result += "               OpFunctionEnd"
+        return result
 
-        return result_fleshed
+
+    def decode_decision_path(self, decision_id_path: List[str], directions: Dict[str, List[int]]) -> List[str]:
+        # Rebuilds the full path of a thread from the directions given to it, and checks it against the blocks that
+        # the thread records when only decisions are recorded: every visit to a block that a decision can enter,
+        # followed by its terminal block. A thread that took the wrong way at a decision entered another block, so
+        # its recorded blocks do not match.
+        id_path: List[str] = []
+        recorded_ids: List[str] = []
+        direction_indices: DefaultDict[str, int] = defaultdict(int)
+        label = self.entry_block
+        while True:
+            block_id = self.get_block_id(label)
+            id_path.append(block_id)
+            if label in self.decision_target_blocks or label not in self.jump_relation:
+                recorded_ids.append(block_id)
+            if label not in self.jump_relation:
+                break
+            if not self.is_conditional(label):
+                label = self.jump_relation[label][0]
+                continue
+            if direction_indices[block_id] >= len(directions.get(block_id, [])):
+                raise UndecodableDecisionOutputError(decision_id_path)
+            direction = directions[block_id][direction_indices[block_id]]
+            direction_indices[block_id] += 1
+            if label in self.switch_blocks:
+                label = self.jump_relation[label][direction]
+            else:
+                label = self.jump_relation[label][0 if direction == 1 else 1]
+        if recorded_ids != list(decision_id_path):
+            raise UndecodableDecisionOutputError(decision_id_path)
+        return id_path
+
+
+    def decode_decision_output(self, output: List[str], paths: List[Path]) -> List[List[str]]:
+        # Splits the contents of an output buffer written in decision-only mode into the blocks recorded by each
+        # thread, and rebuilds the full path of each thread from them.
+        id_paths: List[List[str]] = []
+        start = 0
+        for path in paths:
+            end = start + len(path.decision_id_path)
+            id_paths.append(self.decode_decision_path(output[start:end], path.directions))
+            start = end + 1
+        return id_paths
 
 
     def random_path_of_desired_length_without_passing_through_doomed(self, start, length, current_iteration_vector, iteration_vectors, prng):
@@ -1224,6 +1800,10 @@ SHADER compute compute_shader SPIRV-ASM
 
 
     def generate_path(self, prng, max_path_length=MAX_PATH_LENGTH) -> Path:
+        return Path(self, prng, *self.generate_label_path(prng, max_path_length))
+
+
+    def generate_label_path(self, prng, max_path_length=MAX_PATH_LENGTH) -> Tuple[List[str], DefaultDict[str, List[Dict[str, int]]]]:
         current_iteration_vector = dict((block, 0) for block in self.loop_header_blocks)
         iteration_vectors: DefaultDict[str, List[Dict[str, int]]] = defaultdict(list)
         rand_path_prefix = self.random_path_of_desired_length_without_passing_through_doomed(self.entry_block,
@@ -1235,7 +1815,7 @@ SHADER compute compute_shader SPIRV-ASM
             rand_path_suffix = self.find_path_to_exit_node(self.jump_relation, rand_path_prefix[-1], current_iteration_vector, iteration_vectors)
             assert rand_path_suffix is not None
             rand_path_prefix += rand_path_suffix[1:]
-        return Path(self, prng, rand_path_prefix, iteration_vectors)
+        return rand_path_prefix, iteration_vectors
 
 
 class Path:
@@ -1248,6 +1828,7 @@ class Path:
         self.id_path: List[str] = [cfg.get_block_id(label) for label in path]
         self.conditional_block_labels: List[str] = cfg.get_conditional_blocks_in_path(path)
         self.conditional_block_ids: List[str] = [cfg.get_block_id(label) for label in self.conditional_block_labels]
+        self.decision_id_path: List[str] = self.compute_decision_id_path()
         self.array_sizes: Dict[str, int] = self.compute_array_sizes()
         self.switch2edges: Dict[str, List[int]] = self.compute_switch_edges()
         self.directions: Dict[str, List[int]] = self.compute_direction_arrays()
@@ -1255,6 +1836,12 @@ class Path:
         self.barrier_blocks: Set[str] = set()
     
 
+    def compute_decision_id_path(self) -> List[str]:
+        # The blocks that are recorded when only decisions are recorded: every visit to a block that a decision can
+        # enter, followed by the terminal block of the path, which has no successors.
+        return [self.cfg.get_block_id(label) for label in self.label_path[:-1] if label in self.cfg.decision_target_blocks] + [self.id_path[-1]]
+
+
     def compute_array_sizes(self) -> Dict[str, int]:
         array_sizes: Dict[str, int] = {}
         for id in self.conditional_block_ids:
@@ -1360,6 +1947,343 @@ class Path:
         return hash(self.__key())
 
 
+class ModuleMember:
+
+    def __init__(self, cfg: CFG, paths: List[Path], rng: Random, seed: int, xml_file: str = '') -> None:
+        self.cfg: CFG = cfg
+        self.paths: List[Path] = paths
+        self.rng: Random = rng
+        self.seed: int = seed
+        self.xml_file: str = xml_file
+        self.description: str = f"{xml_file} with seed {seed}"
+
+
+class RandomStreams:
+    # Independent random generators keyed by (seed, role, index), so that any one of them can be recreated without
+    # replaying the others. Each generator is seeded from a string, which Random hashes with SHA-512.
+
+    def __init__(self, seed: int) -> None:
+        self.seed: int = seed
+
+
+    def get(self, role: str, index: int = 0) -> Random:
+        return Random(f"{self.seed}:{role}:{index}")
+
+
+class LazyPathPool:
+    # A pool of paths whose candidates are generated on demand, each from its own random stream. Candidate 0 is the
+    # reference path and candidate j > 0 is in the pool if it is compatible with, and different from, the reference
+    # path. Thread i draws candidates from its own stream until it draws one in the pool. This picks uniformly from the
+    # pool, as fleshout does, but only generates the candidates that are drawn.
+    NUM_CANDIDATES = 100
+
+    def __init__(self, cfg: CFG, streams: RandomStreams, path_length: int, include_barriers: bool, use_different_paths: bool) -> None:
+        self.cfg: CFG = cfg
+        self.streams: RandomStreams = streams
+        self.path_length: int = path_length
+        self.use_different_paths: bool = use_different_paths
+        with PHASE_TIMER.phase('reference_path'):
+            reference: Path = cfg.generate_path(streams.get('reference'), path_length)
+            reference.barrier_blocks = get_barrier_blocks(cfg, reference, 40, streams.get('barriers')) if include_barriers else set()
+        self.candidates: Dict[int, Optional[Path]] = {0: reference}
+
+
+    def add_candidate(self, index: int, path: Path) -> None:
+        reference = self.candidates[0]
+        assert reference is not None
+        path.barrier_blocks = reference.barrier_blocks
+        with PHASE_TIMER.phase('compatibility_checks'):
+            self.candidates[index] = path if reference.is_compatible(path) and path != reference else None
+
+
+    def get_candidate(self, index: int) -> Optional[Path]:
+        # None if the candidate is not in the pool
+        if index not in self.candidates:
+            with PHASE_TIMER.phase('candidate_paths'):
+                path = self.cfg.generate_path(self.streams.get('candidate', index), self.path_length)
+            self.add_candidate(index, path)
+        return self.candidates[index]
+
+
+    def generate_candidates(self, jobs: int) -> None:
+        # Generates every candidate that has not been generated yet in a pool of jobs processes. The processes walk
+        # the CFG of the pool itself, which they inherit read-only, and return the random walks, which are turned into
+        # paths here. The paths are then the same as those that get_candidate generates one at a time. The processes
+        # are always forked, whatever the default start method: a CFG pickled for a spawned process could iterate its
+        # sets in another order, and walk differently.
+        assert can_generate_candidates_in_parallel(), "Candidate paths can only be generated in parallel where processes can be forked"
+        if not self.use_different_paths:
+            return
+        indices = [index for index in range(1, LazyPathPool.NUM_CANDIDATES + 1) if index not in self.candidates]
+        with PHASE_TIMER.phase('candidate_paths'), multiprocessing.get_context('fork').Pool(jobs, initializer=init_candidate_worker, initargs=(self.cfg, self.streams.seed, self.path_length)) as workers:
+            walks = workers.map(generate_candidate_walk, indices, chunksize=max(1, len(indices) // (4 * jobs)))
+        for index, (label_path, iteration_vectors, rng_state) in zip(indices, walks):
+            rng = Random()
+            rng.setstate(rng_state)
+            self.add_candidate(index, Path(self.cfg, rng, label_path, iteration_vectors))
+
+
+    def get_thread_path(self, thread_index: int) -> Path:
+        if not self.use_different_paths:
+            return self.get_candidate(0)
+        rng = self.streams.get('thread', thread_index)
+        while True:
+            path = self.get_candidate(rng.randint(0, LazyPathPool.NUM_CANDIDATES))
+            if path is not None:
+                return path
+
+
+def can_generate_candidates_in_parallel() -> bool:
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+# The CFG and random streams of a worker process of LazyPathPool.generate_candidates
+candidate_worker_state: Dict[str, object] = {}
+
+
+def init_candidate_worker(cfg: CFG, seed: int, path_length: int) -> None:
+    candidate_worker_state['cfg'] = cfg
+    candidate_worker_state['streams'] = RandomStreams(seed)
+    candidate_worker_state['path_length'] = path_length
+
+
+def generate_candidate_walk(index: int) -> Tuple[List[str], DefaultDict[str, List[Dict[str, int]]], tuple]:
+    # The random walk of a candidate path, and the state of its random stream after the walk
+    cfg: CFG = candidate_worker_state['cfg']
+    rng = candidate_worker_state['streams'].get('candidate', index)
+    label_path, iteration_vectors = cfg.generate_label_path(rng, candidate_worker_state['path_length'])
+    return label_path, iteration_vectors, rng.getstate()
+
+
+class PathPool:
+    # The paths generated once for a CFG and seed. Tests for any number of dispatch shapes can be drawn from the same
+    # pool, each with a random generator seeded from the seed and the shape, so that each is reproducible on its own.
+
+    def __init__(self, cfg: CFG, paths: List[Path], seed: int, xml_file: str = '') -> None:
+        self.cfg: CFG = cfg
+        self.paths: List[Path] = paths
+        self.seed: int = seed
+        self.xml_file: str = xml_file
+
+
+    def shape_rng(self, dimensions: List[int]) -> Random:
+        return Random(f"{self.seed}:{'x'.join(str(dimension) for dimension in dimensions)}")
+
+
+class FleshedTest:
+    # The result of fleshing out one or more CFGs: their paths and the dispatch they run with. The amber test, the
+    # SPIR-V assembly and the buffer files are rendered from these on demand. Rendering uses a copy of the state that
+    # the random generator of each member had when fleshing finished, so every rendering of a test is the same.
+
+    def __init__(self,
+                 members: List[ModuleMember],
+                 x_threads: int,
+                 y_threads: int,
+                 z_threads: int,
+                 x_workgroups: int,
+                 y_workgroups: int,
+                 z_workgroups: int,
+                 include_op_phi: bool,
+                 record_decisions_only: bool = False,
+                 pack_directions: bool = False,
+                 is_packed: bool = False) -> None:
+        self.members: List[ModuleMember] = members
+        self.seed: int = members[0].seed
+        self.x_threads: int = x_threads
+        self.y_threads: int = y_threads
+        self.z_threads: int = z_threads
+        self.x_workgroups: int = x_workgroups
+        self.y_workgroups: int = y_workgroups
+        self.z_workgroups: int = z_workgroups
+        self.include_op_phi: bool = include_op_phi
+        self.record_decisions_only: bool = record_decisions_only
+        self.pack_directions: bool = pack_directions
+        self.is_packed: bool = is_packed
+        self.rng_states = [member.rng.getstate() for member in members]
+        self.renderings: Dict[Optional[str], Tuple[str, Dict[str, bytes]]] = {}
+        for member in members:
+            member.cfg.assign_block_ids()
+
+
+    def get_paths(self) -> List[Path]:
+        # The path of every thread, in the order of the threads
+        return [path for member in self.members for path in member.paths]
+
+
+    def get_unique_paths(self) -> FrozenSet[str]:
+        return frozenset(str(path) for path in self.get_paths())
+
+
+    def get_barrier_blocks(self) -> Set[str]:
+        return set(member.cfg.get_block_id(block) for member in self.members for block in member.paths[0].barrier_blocks)
+
+
+    def get_output_names(self) -> List[str]:
+        return ['member_{0}_output'.format(index) if self.is_packed else 'output' for index in range(len(self.members))]
+
+
+    def get_buffers(self) -> Dict[str, List[int]]:
+        # The initial contents of the directions and index buffers, and the expected contents of the output buffers
+        output_names = self.get_output_names()
+        _, index_offsets, directions, expected_outputs, _ = CFG.compute_storage_buffers(self.members, output_names, self.record_decisions_only, self.pack_directions)
+        buffers: Dict[str, List[int]] = {}
+        for block_id, choices in directions.items():
+            buffers['directions_' + block_id] = choices
+            buffers['directions_' + block_id + '_index'] = index_offsets[block_id]
+        for output_name, expected_output in zip(output_names, expected_outputs):
+            buffers[output_name + '_index'] = index_offsets[output_name]
+            buffers[output_name + '_expected'] = [int(id) for id in expected_output]
+        return buffers
+
+
+    def render(self, buffer_files: Optional[Dict[str, bytes]] = None, buffer_file_prefix: str = '', asm_only: bool = False) -> str:
+        members = []
+        for member, rng_state in zip(self.members, self.rng_states):
+            rng = Random()
+            rng.setstate(rng_state)
+            members.append(ModuleMember(member.cfg, member.paths, rng, member.seed, member.xml_file))
+        with PHASE_TIMER.phase('emission'):
+            return CFG.fleshout_members(members,
+                                        self.x_threads,
+                                        self.y_threads,
+                                        self.z_threads,
+                                        self.x_workgroups,
+                                        self.y_workgroups,
+                                        self.z_workgroups,
+                                        self.include_op_phi,
+                                        self.record_decisions_only,
+                                        self.pack_directions,
+                                        buffer_files,
+                                        buffer_file_prefix,
+                                        self.is_packed,
+                                        asm_only)
+
+
+    def get_rendering(self, buffer_file_prefix: Optional[str]) -> Tuple[str, Dict[str, bytes]]:
+        if buffer_file_prefix not in self.renderings:
+            buffer_files: Optional[Dict[str, bytes]] = None if buffer_file_prefix is None else {}
+            amber = self.render(buffer_files, buffer_file_prefix or '')
+            self.renderings[buffer_file_prefix] = (amber, buffer_files or {})
+        return self.renderings[buffer_file_prefix]
+
+
+    def to_amber(self, buffer_file_prefix: Optional[str] = None) -> str:
+        # With a buffer_file_prefix, the buffers are loaded from the files given by to_buffer_files for the same prefix
+        return self.get_rendering(buffer_file_prefix)[0]
+
+
+    def to_buffer_files(self, buffer_file_prefix: str) -> Dict[str, bytes]:
+        return self.get_rendering(buffer_file_prefix)[1]
+
+
+    def to_asm(self) -> str:
+        return self.render(asm_only=True)
+
+
+    def to_cfg_string(self) -> str:
+        return "\n\n".join([member.cfg.to_string() for member in self.members])
+
+
+    def predict_sizes(self) -> Dict[str, int]:
+        # The sizes that Budget limits, computed from the buffers without rendering the amber file. The size of the
+        # amber file is estimated for buffers that are declared inline.
+        buffers = self.get_buffers()
+        return {'buffer_bytes': 4 * sum(len(values) for values in buffers.values()),
+                'amber_bytes': predict_fixed_amber_bytes(self.get_paths(), len(self.to_asm())) + \
+                               sum((1 if name.endswith('output_expected') else 2) * sum(len(str(value)) + 1 for value in values) for name, values in buffers.items()),
+                'stores': sum(len(values) for name, values in buffers.items() if name.endswith('output_expected'))}
+
+
+class Budget:
+    # Limits on the cost of a test: the bytes of storage buffers it needs on the device, the bytes of its amber file,
+    # and the number of stores that its threads make to the output buffers. Limits that are None are not enforced.
+
+    def __init__(self, max_buffer_bytes: Optional[int] = None, max_amber_bytes: Optional[int] = None, max_stores: Optional[int] = None) -> None:
+        self.limits: Dict[str, Optional[int]] = {'buffer_bytes': max_buffer_bytes,
+                                                 'amber_bytes': max_amber_bytes,
+                                                 'stores': max_stores}
+
+
+    def fits(self, sizes: Dict[str, int]) -> bool:
+        return all(limit is None or sizes[name] <= limit for name, limit in self.limits.items())
+
+
+    def is_enforced(self) -> bool:
+        return any(limit is not None for limit in self.limits.values())
+
+
+def predict_fixed_amber_bytes(paths: List[Path], asm_bytes: int) -> int:
+    num_buffers = 2 * (len(set(id for path in paths for id in path.conditional_block_ids)) + 1)
+    return AMBER_HEADER_BYTES + sum(len(str(path)) + len("; unique path #: \n") + 2 for path in set(paths)) + asm_bytes + AMBER_BYTES_PER_BUFFER * num_buffers
+
+
+def predict_path_sizes(path: Path, record_decisions_only: bool) -> Dict[str, int]:
+    # The sizes that one thread following path adds to a test, not counting its entries in the index buffers. The
+    # directions are written to the amber file twice, as data and as expectation, and the output once.
+    output = (path.decision_id_path if record_decisions_only else path.id_path) + [str(0)]
+    directions = [direction for choices in path.directions.values() for direction in choices]
+    return {'buffer_bytes': 4 * (len(directions) + len(output)),
+            'amber_bytes': 2 * sum(len(str(value)) + 1 for value in directions) + sum(len(value) + 1 for value in output),
+            'stores': len(output)}
+
+
+def predict_dispatch_sizes(thread_sizes: Dict[str, int], num_threads: int, num_index_buffers: int, fixed_amber_bytes: int) -> Dict[str, int]:
+    # The sizes of a test from the summed sizes of its threads. Each thread has an entry in every index buffer.
+    index_value_bytes = len(str(thread_sizes['buffer_bytes'] // 4)) + 1
+    return {'buffer_bytes': thread_sizes['buffer_bytes'] + 4 * num_threads * num_index_buffers,
+            'amber_bytes': fixed_amber_bytes + thread_sizes['amber_bytes'] + 2 * index_value_bytes * num_threads * num_index_buffers,
+            'stores': thread_sizes['stores']}
+
+
+def shrink_dispatch(dimensions: List[int], fits) -> List[int]:
+    # Shrinks the x, y and z thread counts and the x, y and z workgroup counts in dimensions until fits holds for the
+    # number of threads. The largest count is shrunk first, and workgroups before threads.
+    dimensions = dimensions.copy()
+    while any(dimension > 1 for dimension in dimensions):
+        if fits(CFG.compute_num_threads(*dimensions[:3]) * CFG.compute_num_workgroups(*dimensions[3:])):
+            break
+        index = max(range(len(dimensions)), key=lambda index: (dimensions[index], index))
+        dimensions[index] -= 1
+    return dimensions
+
+
+def fit_pool_to_budget(pool: List[Path], asm_bytes: int, budget: Budget, record_decisions_only: bool) -> List[Path]:
+    # The paths of the pool that fit the budget as the only thread of a test, with the fixed sizes of a test over the
+    # whole pool, which bound those of any test drawn from it. Other paths could never be drawn, and dropping them
+    # tightens the bound so that more threads fit. The first path is the one the others are compatible with, so the
+    # pool is empty if it does not fit.
+    fixed_amber_bytes = predict_fixed_amber_bytes(pool, asm_bytes)
+    num_index_buffers = len(set(id for path in pool for id in path.conditional_block_ids)) + 1
+
+    def fits(path: Path) -> bool:
+        return budget.fits(predict_dispatch_sizes(predict_path_sizes(path, record_decisions_only), 1, num_index_buffers, fixed_amber_bytes))
+
+    if not fits(pool[0]):
+        return []
+    return [pool[0]] + [path for path in pool[1:] if fits(path)]
+
+
+def fit_dispatch_to_budget(pool: List[Path], asm_bytes: int, budget: Budget, dimensions: List[int], record_decisions_only: bool, rng: Random) -> Tuple[List[int], List[Path]]:
+    # Returns the largest dispatch, up to dimensions, that fits the budget, and the paths of its threads. The cheapest
+    # path in the pool bounds the number of threads that could fit, so only that many paths are drawn. The dispatch is
+    # then shrunk further until the paths actually drawn for its threads fit.
+    fixed_amber_bytes = predict_fixed_amber_bytes(pool, asm_bytes)
+    path_sizes: Dict[Path, Dict[str, int]] = dict((path, predict_path_sizes(path, record_decisions_only)) for path in pool)
+    cheapest = dict((name, min(sizes[name] for sizes in path_sizes.values())) for name in ['buffer_bytes', 'amber_bytes', 'stores'])
+    dimensions = shrink_dispatch(dimensions, lambda num_threads: budget.fits(predict_dispatch_sizes(dict((name, num_threads * size) for name, size in cheapest.items()), num_threads, 1, fixed_amber_bytes)))
+
+    paths = [rng.choice(pool) for _ in range(CFG.compute_num_threads(*dimensions[:3]) * CFG.compute_num_workgroups(*dimensions[3:]))]
+    prefix_sizes: List[Dict[str, int]] = [{'buffer_bytes': 0, 'amber_bytes': 0, 'stores': 0}]
+    prefix_num_index_buffers: List[int] = [1]
+    conditional_block_ids: Set[str] = set()
+    for path in paths:
+        prefix_sizes.append(dict((name, size + path_sizes[path][name]) for name, size in prefix_sizes[-1].items()))
+        conditional_block_ids.update(path.conditional_block_ids)
+        prefix_num_index_buffers.append(len(conditional_block_ids) + 1)
+    dimensions = shrink_dispatch(dimensions, lambda num_threads: budget.fits(predict_dispatch_sizes(prefix_sizes[num_threads], num_threads, prefix_num_index_buffers[num_threads], fixed_amber_bytes)))
+    return dimensions, paths[:CFG.compute_num_threads(*dimensions[:3]) * CFG.compute_num_workgroups(*dimensions[3:])]
+
+
 def get_barrier_blocks(cfg: CFG, path: Path, likelihood_percentage: int, rng) -> set:
     return set(block for block in path.label_path if block != cfg.entry_block and rng.choices([True, False], [likelihood_percentage, 100-likelihood_percentage], k=1)[0])
 
@@ -1368,19 +2292,17 @@ def generate_paths(original_path, cfg, rng, path_length) -> List[Path]:
     MAX_PATH_GENERATION_ATTEMPTS = 100
     paths = [original_path]
     for _ in range(MAX_PATH_GENERATION_ATTEMPTS):
-        new_path = cfg.generate_path(rng, path_length)
+        with PHASE_TIMER.phase('candidate_paths'):
+            new_path = cfg.generate_path(rng, path_length)
         new_path.barrier_blocks = original_path.barrier_blocks
-        if original_path.is_compatible(new_path) and new_path != original_path:
+        with PHASE_TIMER.phase('compatibility_checks'):
+            is_new_compatible_path = original_path.is_compatible(new_path) and new_path != original_path
+        if is_new_compatible_path:
             paths.append(new_path)
     return paths
 
 
-def fleshout(xml_file, path_length=MAX_PATH_LENGTH, seed=None, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_barriers=True, include_op_phi=True, use_different_paths=True):
-    rng = Random()
-    if seed is None:
-        seed = random.randrange(0, sys.maxsize)
-    rng.seed(seed)
-
+def load_instance(xml_file):
     tree = elementTree.parse(xml_file)
 
     alloy = tree.getroot()
@@ -1389,9 +2311,157 @@ def fleshout(xml_file, path_length=MAX_PATH_LENGTH, seed=None, x_threads=1, y_th
     instance = alloy[0]
     assert instance.tag == "instance"
 
-    if not any(block in get_jump_relation(instance) for block in get_all_blocks(instance) ):
+    jump_relation = get_jump_relation(instance)
+    if not any(block in jump_relation for block in get_all_blocks(instance)):
+        raise NoTerminalNodesInCFGError()
+    return instance
+
+
+def read_cfg_instance(xml_file) -> CFGRelationsReader:
+    # Reads the fields and sigs a CFG is built from in a single pass over the xml file that builds no elements, so that
+    # the skolems and unused sigs of large instances are skipped as they are parsed
+    reader = CFGRelationsReader()
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = reader.start_element
+    with open(xml_file, 'rb') as f:
+        parser.ParseFile(f)
+    return reader
+
+
+def check_terminal_nodes(relations: Tuple) -> None:
+    jump_relation, _, _, entry_block, *blocks = relations
+    if not any(block in jump_relation for block in set([entry_block]).union(*blocks)):
         raise NoTerminalNodesInCFGError()
 
+
+def stream_cfg_relations(xml_file) -> Tuple:
+    # The relations a CFG is built from, in the order of the arguments of CFG. This gives the same relations as
+    # load_instance followed by get_cfg_relations_from_instance.
+    relations = read_cfg_instance(xml_file).get_relations()
+    check_terminal_nodes(relations)
+    return relations
+
+
+def parse_cfg(xml_file) -> CFG:
+    # Parsing and analysing the CFG of the xml file, without its cache file
+    with PHASE_TIMER.phase('xml_parse'):
+        relations = stream_cfg_relations(xml_file)
+    with PHASE_TIMER.phase('cfg'):
+        return CFG(*relations, CFG.ENTRY_BLOCK_ID)
+
+
+def load_cfg(xml_file) -> CFG:
+    # The per file stage of fleshing: parsing and analysing the CFG, which can then be passed to fleshout and the other
+    # per seed stages for any number of seeds. The CFG is read from the cache file next to the xml file if that is up
+    # to date, and the cache file is written otherwise.
+    with PHASE_TIMER.phase('cfg_cache'):
+        cfg = read_cfg_cache(xml_file)
+    if cfg is not None:
+        return cfg
+    with PHASE_TIMER.phase('cfg_cache'):
+        xml_stamp = cfg_cache_format.get_xml_stamp(xml_file)
+        xml_hash = cfg_cache_format.get_xml_hash(xml_file)
+    with PHASE_TIMER.phase('xml_parse'):
+        reader = read_cfg_instance(xml_file)
+        relations = reader.get_relations()
+        check_terminal_nodes(relations)
+    with PHASE_TIMER.phase('cfg'):
+        cfg = CFG(*relations, CFG.ENTRY_BLOCK_ID)
+    with PHASE_TIMER.phase('cfg_cache'):
+        write_cfg_cache(cfg_cache_format.get_cfg_cache_file(xml_file), encode_cfg_cache(cfg, reader.get_block_lists(), xml_hash, xml_stamp))
+    return cfg
+
+
+def get_cfg_relations_from_instance(instance) -> Tuple:
+    return (get_jump_relation(instance),
+            get_merge_relation(instance),
+            get_continue_relation(instance),
+            get_entry_block(instance),
+            get_regular_blocks(instance),
+            get_loop_header_blocks(instance),
+            get_selection_header_blocks(instance),
+            get_switch_blocks(instance))
+
+
+def cfg_from_instance(instance, first_block_id=CFG.ENTRY_BLOCK_ID) -> CFG:
+    with PHASE_TIMER.phase('xml_parse'):
+        relations = get_cfg_relations_from_instance(instance)
+    with PHASE_TIMER.phase('cfg'):
+        return CFG(*relations, first_block_id)
+
+
+# The cache file of a CFG holds, after its relations, its doomed blocks, back edges and topological order, see
+# cfg_cache_format. The analyses are only used if the header has the hash of this file, so that analyses computed by
+# an older version are not.
+@functools.lru_cache(maxsize=1)
+def get_analysis_version() -> bytes:
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()[:16]
+
+
+def encode_cfg_cache(cfg: CFG, block_lists: List[List[str]], xml_hash: bytes, xml_stamp: Tuple[int, int]) -> bytes:
+    # block_lists are the regular blocks, loop headers, selection headers and switch blocks in the order of the xml file
+    encoder = cfg_cache_format.CFGCacheEncoder()
+    encoder.add_relations(cfg.jump_relation, cfg.merge_relation, cfg.continue_relation, cfg.entry_block, block_lists)
+    encoder.add_blocks(cfg.doomed_blocks)
+    encoder.add_graph(cfg.structured_back_edges)
+    encoder.add_blocks(cfg.topological_ordering)
+    return encoder.to_bytes(xml_hash, xml_stamp, get_analysis_version())
+
+
+def read_cfg_cache(xml_file: str) -> Optional[CFG]:
+    # The CFG, or None if the cache file of the xml file is not up to date
+    decoder = cfg_cache_format.read_cfg_cache_file(xml_file, get_analysis_version())
+    if decoder is None:
+        return None
+    relations = decoder.read_relations()
+    analyses = CFGAnalyses(set(decoder.read_blocks()),
+                           dict((block, set(successors)) for block, successors in decoder.read_graph().items()),
+                           decoder.read_blocks())
+    assert decoder.is_at_end()
+    return CFG(*relations, CFG.ENTRY_BLOCK_ID, analyses)
+
+
+def write_cfg_cache(cache_file: str, data: bytes) -> None:
+    # The file is replaced in one step, as processes fleshing the same xml file can write it at the same time. A cache
+    # file that cannot be written, as in a read-only folder, is left out.
+    temporary_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_file, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_file, cache_file)
+    except OSError:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
+def generate_path_pool(cfg, rng, path_length, include_barriers, use_different_paths) -> List[Path]:
+    with PHASE_TIMER.phase('reference_path'):
+        path: Path = cfg.generate_path(rng, path_length)
+        path.barrier_blocks = get_barrier_blocks(cfg, path, 40, rng) if include_barriers else set()
+    return generate_paths(path, cfg, rng, path_length) if use_different_paths else [path]
+
+
+def fleshout(xml_file, path_length=MAX_PATH_LENGTH, seed=None, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_barriers=True, include_op_phi=True, use_different_paths=True, record_decisions_only=False, pack_directions=False, budget: Optional[Budget] = None, split_rng=False, jobs=1, cfg: Optional[CFG] = None) -> FleshedTest:
+    # With a budget, the paths of the pool that could not fit the budget are dropped, and the thread and workgroup
+    # counts are the largest, up to the maxima, that are predicted to fit it, rather than random. If no path fits as a
+    # single thread, the paths are regenerated with half the length, and BudgetExceededError is raised if even paths
+    # of length 1 do not fit.
+    # With split_rng, every random choice comes from its own stream of the seed, see fleshout_split_rng. The candidate
+    # paths are then generated by jobs processes if jobs is more than 1. The CFG loaded from xml_file by load_cfg can be
+    # given to avoid loading it again.
+    if seed is None:
+        seed = random.randrange(0, sys.maxsize)
+    if split_rng:
+        assert budget is None or not budget.is_enforced(), "Budgets are not supported with split random streams"
+        return fleshout_split_rng(xml_file, path_length, seed, x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups, include_barriers, include_op_phi, use_different_paths, record_decisions_only, pack_directions, jobs, cfg)
+    assert jobs == 1, "Candidate paths are only generated in parallel with split random streams"
+    rng = Random()
+    rng.seed(seed)
+
+    if cfg is None:
+        cfg = load_cfg(xml_file)
+
     num_x_threads = rng.randint(1, x_threads) 
     num_y_threads = rng.randint(1, y_threads)
     num_z_threads = rng.randint(1, z_threads)
@@ -1399,31 +2469,129 @@ def fleshout(xml_file, path_length=MAX_PATH_LENGTH, seed=None, x_threads=1, y_th
     num_y_workgroups = rng.randint(1, y_workgroups) 
     num_z_workgroups = rng.randint(1, z_workgroups)  
 
-    cfg = CFG(get_jump_relation(instance),
-              get_merge_relation(instance),
-              get_continue_relation(instance),
-              get_entry_block(instance),
-              get_regular_blocks(instance),
-              get_loop_header_blocks(instance),
-              get_selection_header_blocks(instance),
-              get_switch_blocks(instance))
-
-    path: Path = cfg.generate_path(rng, path_length)
-    path.barrier_blocks = get_barrier_blocks(cfg, path, 40, rng) if include_barriers else set()
-    paths: List[Path] = generate_paths(path, cfg, rng, path_length) if use_different_paths else [path]
-    num_required_paths = CFG.compute_num_threads(num_x_threads, num_y_threads, num_z_threads) * CFG.compute_num_workgroups(num_x_workgroups, num_y_workgroups, num_z_workgroups)
-    paths = [rng.choice(paths) for _ in range(num_required_paths)]
-
-    return cfg.to_string(), cfg.fleshout(paths,
-                                         rng, 
-                                         seed, 
-                                         num_x_threads,
-                                         num_y_threads,
-                                         num_z_threads,
-                                         num_x_workgroups,
-                                         num_y_workgroups,
-                                         num_z_workgroups, 
-                                         include_op_phi) 
+    cfg = cfg.with_fresh_block_ids()
+
+    paths: List[Path] = generate_path_pool(cfg, rng, path_length, include_barriers, use_different_paths)
+    if budget is not None and budget.is_enforced():
+        while True:
+            # The assembly of a test over the whole pool bounds the assembly of any test drawn from it
+            asm_bytes = len(FleshedTest([ModuleMember(cfg, paths, rng, seed, xml_file)], 1, 1, 1, 1, 1, 1, include_op_phi, record_decisions_only, pack_directions).to_asm())
+            fitting_paths = fit_pool_to_budget(paths, asm_bytes, budget, record_decisions_only)
+            if len(fitting_paths) > 0 or path_length <= 1:
+                break
+            path_length = path_length // 2
+            paths = generate_path_pool(cfg, rng, path_length, include_barriers, use_different_paths)
+        if len(fitting_paths) < len(paths):
+            paths = fitting_paths or paths[:1]
+            asm_bytes = len(FleshedTest([ModuleMember(cfg, paths, rng, seed, xml_file)], 1, 1, 1, 1, 1, 1, include_op_phi, record_decisions_only, pack_directions).to_asm())
+        dimensions, paths = fit_dispatch_to_budget(paths, asm_bytes, budget, [x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups], record_decisions_only, rng)
+        num_x_threads, num_y_threads, num_z_threads, num_x_workgroups, num_y_workgroups, num_z_workgroups = dimensions
+    else:
+        num_required_paths = CFG.compute_num_threads(num_x_threads, num_y_threads, num_z_threads) * CFG.compute_num_workgroups(num_x_workgroups, num_y_workgroups, num_z_workgroups)
+        paths = [rng.choice(paths) for _ in range(num_required_paths)]
+
+    test = FleshedTest([ModuleMember(cfg, paths, rng, seed, xml_file)],
+                       num_x_threads,
+                       num_y_threads,
+                       num_z_threads,
+                       num_x_workgroups,
+                       num_y_workgroups,
+                       num_z_workgroups,
+                       include_op_phi,
+                       record_decisions_only,
+                       pack_directions)
+    if budget is not None and budget.is_enforced() and not budget.fits(test.predict_sizes()):
+        raise BudgetExceededError(test.predict_sizes(), budget.limits)
+    return test
+
+
+def load_split_rng_pool(xml_file, seed, path_length=MAX_PATH_LENGTH, include_barriers=True, use_different_paths=True, cfg: Optional[CFG] = None) -> LazyPathPool:
+    # Block ids are assigned before any path is generated, so that they do not depend on which paths are generated
+    cfg = (cfg or load_cfg(xml_file)).with_fresh_block_ids()
+    cfg.assign_block_ids()
+    return LazyPathPool(cfg, RandomStreams(seed), path_length, include_barriers, use_different_paths)
+
+
+def fleshout_split_rng(xml_file, path_length=MAX_PATH_LENGTH, seed=None, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_barriers=True, include_op_phi=True, use_different_paths=True, record_decisions_only=False, pack_directions=False, jobs=1, cfg: Optional[CFG] = None) -> FleshedTest:
+    # The thread and workgroup counts, the reference path, the barriers, every candidate path, the path of every thread
+    # and the rendering each use their own stream of the seed. The path of any thread can then be regenerated on its
+    # own with regenerate_thread_paths, and the tests differ from those that fleshout generates for the same seed.
+    if seed is None:
+        seed = random.randrange(0, sys.maxsize)
+    pool = load_split_rng_pool(xml_file, seed, path_length, include_barriers, use_different_paths, cfg)
+    if jobs > 1:
+        pool.generate_candidates(jobs)
+
+    rng = pool.streams.get('dimensions')
+    dimensions = [rng.randint(1, maximum) for maximum in [x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups]]
+    num_required_paths = CFG.compute_num_threads(*dimensions[:3]) * CFG.compute_num_workgroups(*dimensions[3:])
+    paths = [pool.get_thread_path(thread_index) for thread_index in range(num_required_paths)]
+
+    return FleshedTest([ModuleMember(pool.cfg, paths, pool.streams.get('render'), seed, xml_file)], *dimensions, include_op_phi, record_decisions_only, pack_directions)
+
+
+def regenerate_thread_paths(xml_file, seed, thread_indices: List[int], path_length=MAX_PATH_LENGTH, include_barriers=True, use_different_paths=True, cfg: Optional[CFG] = None) -> Dict[int, Path]:
+    # The paths of the given threads of the test that fleshout_split_rng generates for the seed, generating only the
+    # candidates that these threads draw. The thread indices are global, counting across workgroups.
+    pool = load_split_rng_pool(xml_file, seed, path_length, include_barriers, use_different_paths, cfg)
+    return {thread_index: pool.get_thread_path(thread_index) for thread_index in thread_indices}
+
+
+def fleshout_pool(xml_file, seed, path_length=MAX_PATH_LENGTH, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_barriers=True, use_different_paths=True, cfg: Optional[CFG] = None) -> PathPool:
+    # The pool draws from its seed exactly as fleshout does, so that it is the pool of the test that fleshout generates
+    # for the same xml file, seed and maxima.
+    rng = Random(seed)
+
+    if cfg is None:
+        cfg = load_cfg(xml_file)
+
+    for maximum in [x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups]:
+        rng.randint(1, maximum)
+
+    cfg = cfg.with_fresh_block_ids()
+
+    return PathPool(cfg, generate_path_pool(cfg, rng, path_length, include_barriers, use_different_paths), seed, xml_file)
+
+
+def fleshout_from_pool(pool: PathPool, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_op_phi=True, record_decisions_only=False, pack_directions=False) -> FleshedTest:
+    # Unlike fleshout, the thread and workgroup counts are exactly the ones given
+    dimensions = [x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups]
+    rng = pool.shape_rng(dimensions)
+    num_required_paths = CFG.compute_num_threads(x_threads, y_threads, z_threads) * CFG.compute_num_workgroups(x_workgroups, y_workgroups, z_workgroups)
+    paths = [rng.choice(pool.paths) for _ in range(num_required_paths)]
+    return FleshedTest([ModuleMember(pool.cfg, paths, rng, pool.seed, pool.xml_file)], *dimensions, include_op_phi, record_decisions_only, pack_directions)
+
+
+def parse_shape(shape: str) -> Tuple[int, int, int]:
+    # A shape is written as XxYxZ, for example 4x2x1
+    x, y, z = (int(size) for size in shape.split('x'))
+    if min(x, y, z) < 1:
+        raise ValueError(f"Invalid shape {shape}")
+    return x, y, z
+
+
+def generate_packed_member(xml_file, seed, first_block_id, path_length=MAX_PATH_LENGTH, x_threads=1, y_threads=1, z_threads=1, x_workgroups=1, y_workgroups=1, z_workgroups=1, include_barriers=True, use_different_paths=True, cfg: Optional[CFG] = None) -> ModuleMember:
+    # The member draws from its seed exactly as fleshout does, so that its pool of paths is the pool of the standalone
+    # test for the same xml file and seed. Every member of a packed module occupies one workgroup of the maximum size.
+    rng = Random(seed)
+
+    if cfg is None:
+        cfg = load_cfg(xml_file)
+
+    for maximum in [x_threads, y_threads, z_threads, x_workgroups, y_workgroups, z_workgroups]:
+        rng.randint(1, maximum)
+
+    cfg = cfg.with_fresh_block_ids(first_block_id)
+
+    paths: List[Path] = generate_path_pool(cfg, rng, path_length, include_barriers, use_different_paths)
+    paths = [rng.choice(paths) for _ in range(CFG.compute_num_threads(x_threads, y_threads, z_threads))]
+    # Number every block now, so that the next member can start after the last block of this one
+    cfg.assign_block_ids()
+    return ModuleMember(cfg, paths, rng, seed, xml_file)
+
+
+def fleshout_packed(members: List[ModuleMember], x_threads=1, y_threads=1, z_threads=1, include_op_phi=True, record_decisions_only=False, pack_directions=False) -> FleshedTest:
+    return FleshedTest(members, x_threads, y_threads, z_threads, len(members), 1, 1, include_op_phi, record_decisions_only, pack_directions, is_packed=True)
 
 
 def parse_args():
@@ -1469,21 +2637,94 @@ def parse_args():
     parser.add_argument("--simple-barriers", action='store_true', 
                         help='Add barriers along a single path. If there are multiple threads, all threads follow that same path.')
 
+    parser.add_argument("--decisions-only", action='store_true',
+                        help='Only record the blocks that are entered by a decision, that is the successors of conditional blocks, and '
+                        'the terminal block that are executed in the output buffer. The full path of each thread can be '
+                        'rebuilt from the directions, and the recorded blocks check which way each decision went.')
+
+    parser.add_argument("--pack-directions", action='store_true',
+                        help='Pack the directions of OpBranchConditional blocks 32 per word in their storage buffers. '
+                        'The directions of OpSwitch blocks are still stored one per word.')
+
+    parser.add_argument("--max-buffer-bytes", type=int,
+                        help='Fit the test to this many bytes of storage buffers, by choosing the largest thread and workgroup '
+                        'counts, up to the maxima, that are predicted to fit, and drawing threads only from the paths that fit on '
+                        'their own. Paths are shortened if none does. It is an error if no test can fit.')
+
+    parser.add_argument("--max-amber-bytes", type=int,
+                        help='Fit the test to an amber file of this many bytes, as for --max-buffer-bytes.')
+
+    parser.add_argument("--max-stores", type=int,
+                        help='Fit the test to this many stores to the output buffer, as for --max-buffer-bytes.')
+
+    parser.add_argument("--split-rng", action='store_true',
+                        help='Draw every random choice from its own stream of the seed, keyed by its role and thread, so that '
+                        'the path of any thread can be regenerated on its own. The tests differ from those generated without '
+                        'this option. Cannot be combined with budgets.')
+
+    parser.add_argument("--path-jobs", type=int, default=1,
+                        help='With --split-rng, generate the candidate paths in this many forked processes. The test is the same '
+                        'for any number of processes. Not available where processes cannot be forked, as on Windows.')
+
+    parser.add_argument("--regenerate-threads", nargs="+", type=int,
+                        help='Only print the paths of these threads of the test generated with --split-rng, generating no '
+                        'other paths. Thread indices count across workgroups.')
+
+    parser.add_argument("--timings", type=str,
+                        help='Write the time spent in each phase of fleshing (parsing the xml file, analysing the CFG, '
+                        'generating the reference and candidate paths, checking their compatibility and emitting the '
+                        'test) to this file as JSON.')
+
+    parser.add_argument("--memprofile", action='store_true',
+                        help='Trace memory allocations with tracemalloc and write the peak traced memory, the peak resident '
+                        'set and the top allocation sites of each phase of fleshing to a report next to the xml file, with '
+                        'the extension .memprofile.json. Fleshing is several times slower while tracing.')
+
     args = parser.parse_args()
 
+    if (args.split_rng or args.regenerate_threads is not None) and \
+            (args.max_buffer_bytes is not None or args.max_amber_bytes is not None or args.max_stores is not None):
+        parser.error("Budgets cannot be combined with --split-rng or --regenerate-threads")
+
+    if args.path_jobs > 1 and not args.split_rng:
+        parser.error("--path-jobs requires --split-rng")
+
+    if args.path_jobs > 1 and not can_generate_candidates_in_parallel():
+        parser.error("--path-jobs needs processes to be forked, which this platform does not support")
+
     if not args.seed:
         args.seed = random.randrange(0, sys.maxsize)
     return args
 
+def write_reports(args) -> None:
+    if args.timings is not None:
+        write_phase_timings({args.xml: PHASE_TIMER.take()}, args.timings)
+    if PHASE_TIMER.memory_profiler is not None:
+        write_memory_profile(PHASE_TIMER.memory_profiler.get_report(), get_memory_profile_file(args.xml))
+
+
 def main():
     args = parse_args()
+    PHASE_TIMER.enabled = args.timings is not None
+    if args.memprofile:
+        PHASE_TIMER.memory_profiler = MemoryProfiler()
     print(f"Fleshing with seed {args.seed}")
-    asm = fleshout(args.xml, path_length=args.l, seed=args.seed, x_threads=args.x_threads, y_threads=args.y_threads, z_threads=args.z_threads, x_workgroups=args.x_workgroups, y_workgroups=args.y_workgroups, z_workgroups=args.z_workgroups, include_barriers=args.simple_barriers, include_op_phi=args.op_phi)
+    if args.regenerate_threads is not None:
+        for thread_index, path in regenerate_thread_paths(args.xml, args.seed, args.regenerate_threads, path_length=args.l, include_barriers=args.simple_barriers).items():
+            print(f"Thread {thread_index}: {path}")
+        write_reports(args)
+        return
+    budget = Budget(args.max_buffer_bytes, args.max_amber_bytes, args.max_stores)
+    test = fleshout(args.xml, path_length=args.l, seed=args.seed, x_threads=args.x_threads, y_threads=args.y_threads, z_threads=args.z_threads, x_workgroups=args.x_workgroups, y_workgroups=args.y_workgroups, z_workgroups=args.z_workgroups, include_barriers=args.simple_barriers, include_op_phi=args.op_phi, record_decisions_only=args.decisions_only, pack_directions=args.pack_directions, budget=budget, split_rng=args.split_rng, jobs=args.path_jobs)
+    if budget.is_enforced():
+        print(f"Predicted sizes: {test.predict_sizes()}")
     print('\n')
-    print(asm[0])
+    print(test.to_cfg_string())
 
     print('\n')
-    print(asm[1])
+    print(test.to_amber())
+
+    write_reports(args)
 
     
 if __name__ == "__main__":
@@ -0,0 +1,362 @@
+# Copyright 2022 The SPIRV-Control Flow Project Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import benchmark
+import fleshout
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from typing import Dict, List, Optional, Tuple
+
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+
+ROOT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCRAPER_PATH = os.path.join(ROOT_FOLDER, "spirv-to-alloy", "scrape-vulkan-cts.py")
+FEASIBILITY_CHECKER_PATH = os.path.join(ROOT_FOLDER, "isCFGdeemedFeasible.py")
+FLESHING_RUNNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fleshing_runner.py")
+AMBER_RUNNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "amber_runner.py")
+
+# The tools the pipeline runs, with the file name of the executable standing in for each. RunAlloy is run by
+# isCFGdeemedFeasible.py as a java class, so its stand-in is a java executable found first on the PATH.
+TOOLS: Dict[str, str] = {
+    "glslangValidator": "glslangValidator",
+    "spirv-as": "spirv-as",
+    "spirv-dis": "spirv-dis",
+    "spirv-to-alloy": "spirv-to-alloy",
+    "RunAlloy": "java",
+    "amber": "amber",
+}
+
+# The stages of the pipeline as test.py runs them, in order, and the tools each runs
+STAGES: Dict[str, List[str]] = {
+    "scrape": ["glslangValidator", "spirv-as", "spirv-dis", "spirv-to-alloy"],
+    "feasibility": ["RunAlloy"],
+    "fleshing": [],
+    "amber": ["amber"],
+}
+
+# The body of each stand-in, which has the arguments the pipeline passes to the tool, and sets item to the name of
+# the example the call is for when the arguments tell it. Stand-ins are bash scripts, which start far faster than a
+# Python interpreter, and time themselves with EPOCHREALTIME so as not to start any process of their own to do so.
+STAND_IN_BODIES: Dict[str, str] = {
+    # -V --target-env vulkan1.1 input -o output: the "binary" is the shader text, so it differs for each shader
+    "glslangValidator": 'cp "$4" "$6"',
+    # input -o output
+    "spirv-as": 'cp "$1" "$3"',
+    # binary --raw-id -o assembly
+    "spirv-dis": 'cp "{canned_folder}/dis.asm" "$4"',
+    # binary function-id module-prefix [skip-validation]: the scraper skips modules that are the same after their
+    # first line, so the checksum of the binary is added to the canned module
+    "spirv-to-alloy": 'item=$(basename "$3")\n'
+                      'echo "module $3"\n'
+                      'cat "{canned_folder}/module.als"\n'
+                      'echo "// $(cksum < "$1")"',
+    # java options... class module.als, with the instance folder given as -Dout=folder
+    "RunAlloy": 'for arg in "$@"; do case $arg in -Dout=*) out=${{arg#-Dout=}};; esac; als=$arg; done\n'
+                'item=$(basename "$als" .als)\n'
+                'cp "{canned_folder}/test_0.xml" "$out/test_0.xml"\n'
+                'echo "Solver=sat4j Bitwidth=4 MaxSeq=4 Translation took 0.01s. 100 vars. 20 primary vars. 300 clauses."\n'
+                'echo "Solving took 0.01s."\n'
+                'echo "Instance written to $out/test_0.xml"',
+    # -d -t spv1.3 -v 1.1 file.amber, run from the folder of the xml file the amber file was generated from
+    "amber": 'item=$(basename "$(dirname "$6")")\n'
+             'echo "Summary: 1 pass, 0 fail"',
+}
+
+CANNED_ASSEMBLY = """; SPIR-V
+; Version: 1.3
+; Generator: Khronos Glslang Reference Front End; 8
+; Bound: 7
+; Schema: 0
+               OpCapability Shader
+          %1 = OpExtInstImport "GLSL.std.450"
+               OpMemoryModel Logical GLSL450
+               OpEntryPoint GLCompute %4 "main"
+               OpExecutionMode %4 LocalSize 1 1 1
+          %2 = OpTypeVoid
+          %3 = OpTypeFunction %2
+          %4 = OpFunction %2 None %3
+          %5 = OpLabel
+               OpReturn
+               OpFunctionEnd
+"""
+
+
+def write_stand_in(tools_folder: str, tool: str, latency: float, canned_folder: str, calls_file: str) -> str:
+    # Writes the stand-in for the tool, which waits for the latency and appends a line with the tool, the times at
+    # which it started and finished and the example it was called for to the calls file
+    path = os.path.join(tools_folder, TOOLS[tool])
+    with open(path, 'w') as f:
+        f.write("#!/usr/bin/env bash\n")
+        f.write("start=$EPOCHREALTIME\n")
+        f.write("item=-\n")
+        if latency > 0:
+            f.write(f"sleep {latency}\n")
+        f.write(STAND_IN_BODIES[tool].format(canned_folder=canned_folder) + "\n")
+        f.write(f'echo "{tool} $start $EPOCHREALTIME $item" >> "{calls_file}"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def write_canned_outputs(canned_folder: str, cfg_blocks: int) -> None:
+    # The assembly, Alloy module and instance the stand-ins return. The module only has what isCFGdeemedFeasible.py
+    # reads from it; the instance is a synthetic CFG.
+    os.makedirs(canned_folder, exist_ok=True)
+    with open(os.path.join(canned_folder, "dis.asm"), 'w') as f:
+        f.write(CANNED_ASSEMBLY)
+    with open(os.path.join(canned_folder, "module.als"), 'w') as f:
+        f.write(f"// #blocks: {cfg_blocks}\n// #exit blocks: 1\n// #jumps: {cfg_blocks}\n"
+                "one sig HeaderBlock = none\none sig LoopHeader = none\none sig SwitchBlock = none\n")
+    with open(os.path.join(canned_folder, "test_0.xml"), 'w') as f:
+        f.write(benchmark.generate_cfg_xml(cfg_blocks, 1))
+
+
+def write_corpus(cts_folder: str, size: int) -> None:
+    # A stand-in CTS of size amber files, each with one compute shader, in GLSL or, for every other file, in assembly
+    amber_folder = os.path.join(cts_folder, "external", "vulkancts", "data", "vulkan", "amber", "benchmark")
+    os.makedirs(amber_folder, exist_ok=True)
+    for i in range(size):
+        with open(os.path.join(amber_folder, f"test_{i}.amber"), 'w') as f:
+            if i % 2 == 0:
+                f.write(f"#!amber\n\nSHADER compute compute_shader GLSL\n#version 430\n// shader {i}\nvoid main() {{}}\nEND\n\nRUN compute_pipeline 1 1 1\n")
+            else:
+                f.write(f"#!amber\n\nSHADER compute compute_shader SPIRV-ASM\n; shader {i}\n{CANNED_ASSEMBLY}END\n\nRUN compute_pipeline 1 1 1\n")
+
+
+def get_stage_commands(work_folder: str, tools_folder: str, fleshing_seeds: List[int], jobs: int) -> Dict[str, List[str]]:
+    # The commands of the stages, with the arguments test.py gives them
+    tool_paths = dict((tool, os.path.join(tools_folder, file_name)) for tool, file_name in TOOLS.items())
+    als_folder = os.path.join(work_folder, "als")
+    xml_folder = os.path.join(work_folder, "xml")
+    return {
+        "scrape": [sys.executable, SCRAPER_PATH, als_folder, "benchmark", os.path.join(work_folder, "cts"),
+                   tool_paths["glslangValidator"], tool_paths["spirv-as"], tool_paths["spirv-dis"], tool_paths["spirv-to-alloy"]],
+        "feasibility": [sys.executable, FEASIBILITY_CHECKER_PATH, "-a", als_folder, "-x", xml_folder, "-c", os.path.join(work_folder, "alloystar")],
+        "fleshing": [sys.executable, FLESHING_RUNNER_PATH, xml_folder, "--fleshing-seeds"] + [str(seed) for seed in fleshing_seeds]
+                    + ["--deduplicate", "--jobs", str(jobs)],
+        "amber": [sys.executable, AMBER_RUNNER_PATH, xml_folder, tool_paths["amber"]],
+    }
+
+
+def count_files(folder: str, extension: str) -> int:
+    return sum(1 for _, _, files in os.walk(folder) for file in files if file.endswith(extension))
+
+
+def count_stage_files(work_folder: str) -> Dict[str, Tuple[int, int]]:
+    # The number of files each stage reads and writes
+    num_amber_tests = count_files(os.path.join(work_folder, "cts"), ".amber")
+    num_modules = count_files(os.path.join(work_folder, "als"), ".als")
+    num_instances = count_files(os.path.join(work_folder, "xml"), ".xml")
+    num_amber_files = count_files(os.path.join(work_folder, "xml"), ".amber")
+    return {
+        "scrape": (num_amber_tests, num_modules),
+        "feasibility": (num_modules, num_instances),
+        "fleshing": (num_instances, num_amber_files),
+        "amber": (num_amber_files, num_amber_files),
+    }
+
+
+def read_calls(calls_file: str) -> List[Tuple[str, float, float, str]]:
+    # The tool, start and finish time, and example of each call of a stand-in
+    calls = []
+    if not os.path.isfile(calls_file):
+        return calls
+    with open(calls_file, 'r') as f:
+        for line in f:
+            tool, start, finish, item = line.split()
+            calls.append((tool, float(start), float(finish), item))
+    return calls
+
+
+def get_distribution(values: List[float]) -> Optional[Dict[str, float]]:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return {"p50": fleshout.get_percentile(values, 50), "p90": fleshout.get_percentile(values, 90), "max": values[-1]}
+
+
+def measure_spawn_seconds(tools_folder: str, num_calls: int = 20) -> float:
+    # The mean time it takes Python to run a stand-in that does nothing, which is the least a call of a tool costs
+    # the pipeline, however fast the tool
+    path = os.path.join(tools_folder, "noop")
+    with open(path, 'w') as f:
+        f.write("#!/usr/bin/env bash\n")
+    os.chmod(path, 0o755)
+    start_time = time.perf_counter()
+    for _ in range(num_calls):
+        subprocess.run([path], capture_output=True)
+    return (time.perf_counter() - start_time) / num_calls
+
+
+def run_stage(stage: str, command: List[str], work_folder: str, tools_folder: str) -> Tuple[float, float]:
+    # Runs the stage as test.py does, from the work folder, with the stand-ins first on the PATH, and returns the times
+    # at which it started and finished
+    environment = dict(os.environ, PATH=tools_folder + os.pathsep + os.environ.get("PATH", ""))
+    log_file = os.path.join(work_folder, f"{stage}.log")
+    start_time = time.time()
+    with open(log_file, 'w') as log:
+        result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, cwd=work_folder, env=environment)
+    finish_time = time.time()
+    if result.returncode != 0:
+        with open(log_file, 'r') as log:
+            print(log.read()[-10000:])
+        print(f"Error running the {stage} stage: {command}")
+        sys.exit(1)
+    return start_time, finish_time
+
+
+def summarise_stages(stage_times: Dict[str, Tuple[float, float]], stage_files: Dict[str, Tuple[int, int]],
+                     calls: List[Tuple[str, float, float, str]], spawn_seconds: float) -> Dict[str, Dict]:
+    # For each stage: its throughput; the time spent in tools, and the rest, which is the overhead of the pipeline
+    # itself; and how long each example waited, after the last tool call of an earlier stage for it, for the first
+    # tool call of the stage for it
+    ready_times: Dict[str, float] = {}
+    summary = {}
+    for stage, tools in STAGES.items():
+        start_time, finish_time = stage_times[stage]
+        seconds = finish_time - start_time
+        num_inputs, num_outputs = stage_files[stage]
+        stage_calls = [call for call in calls if call[0] in tools]
+        tool_seconds = sum(finish - start for _, start, finish, _ in stage_calls)
+        first_starts: Dict[str, float] = {}
+        last_finishes: Dict[str, float] = {}
+        for _, start, finish, item in stage_calls:
+            if item != "-":
+                first_starts[item] = min(start, first_starts.get(item, start))
+                last_finishes[item] = max(finish, last_finishes.get(item, finish))
+        waits = [first_starts[item] - ready_times[item] for item in first_starts if item in ready_times]
+        ready_times.update(last_finishes)
+        overhead_seconds = seconds - tool_seconds
+        summary[stage] = {
+            "seconds": seconds,
+            "num_inputs": num_inputs,
+            "num_outputs": num_outputs,
+            "inputs_per_second": num_inputs / seconds if seconds > 0 else None,
+            "tool_calls": dict((tool, sum(1 for call in stage_calls if call[0] == tool)) for tool in tools),
+            "tool_seconds": tool_seconds,
+            "spawn_seconds": spawn_seconds * len(stage_calls),
+            "overhead_seconds": overhead_seconds,
+            "overhead_seconds_per_input": overhead_seconds / num_inputs if num_inputs > 0 else None,
+            "overhead_fraction": overhead_seconds / seconds if seconds > 0 else None,
+            "queueing_seconds": get_distribution(waits),
+        }
+    return summary
+
+
+def run_corpus(size: int, latencies: Dict[str, float], cfg_blocks: int, fleshing_seeds: List[int], jobs: int,
+               work_folder: str, spawn_seconds: Optional[float] = None) -> Dict:
+    # Runs the pipeline on a stand-in CTS of the given number of amber files
+    if os.path.exists(work_folder):
+        shutil.rmtree(work_folder)
+    tools_folder = os.path.join(work_folder, "tools")
+    canned_folder = os.path.join(work_folder, "canned")
+    calls_file = os.path.join(work_folder, "calls.txt")
+    os.makedirs(tools_folder)
+    os.makedirs(os.path.join(work_folder, "als"))
+    os.makedirs(os.path.join(work_folder, "alloystar"))
+    write_canned_outputs(canned_folder, cfg_blocks)
+    for tool in TOOLS:
+        write_stand_in(tools_folder, tool, latencies[tool], canned_folder, calls_file)
+    write_corpus(os.path.join(work_folder, "cts"), size)
+    if spawn_seconds is None:
+        spawn_seconds = measure_spawn_seconds(tools_folder)
+
+    stage_times = {}
+    for stage, command in get_stage_commands(work_folder, tools_folder, fleshing_seeds, jobs).items():
+        stage_times[stage] = run_stage(stage, command, work_folder, tools_folder)
+        print(f"{size} files, {stage}: {stage_times[stage][1] - stage_times[stage][0]:.2f} seconds")
+
+    stages = summarise_stages(stage_times, count_stage_files(work_folder), read_calls(calls_file), spawn_seconds)
+    seconds = stage_times["amber"][1] - stage_times["scrape"][0]
+    return {
+        "size": size,
+        "seconds": seconds,
+        "spawn_seconds_per_call": spawn_seconds,
+        "stages": stages,
+        # The stage that most limits throughput other than by waiting for tools
+        "bottleneck": max(stages, key=lambda stage: stages[stage]["overhead_seconds"]),
+    }
+
+
+def print_results(results: Dict) -> None:
+    print(f"{'files':>7} {'stage':<12} {'seconds':>9} {'inputs/s':>9} {'tools':>6} {'overhead/input':>15} {'queued p50':>11}")
+    for corpus in results["corpora"]:
+        for stage, summary in corpus["stages"].items():
+            tool_fraction = summary["tool_seconds"] / summary["seconds"] if summary["seconds"] > 0 else 0.0
+            inputs_per_second = f"{summary['inputs_per_second']:.1f}" if summary["inputs_per_second"] is not None else "-"
+            overhead = f"{summary['overhead_seconds_per_input'] * 1000:.2f} ms" if summary["overhead_seconds_per_input"] is not None else "-"
+            queued = f"{summary['queueing_seconds']['p50']:.2f} s" if summary["queueing_seconds"] is not None else "-"
+            print(f"{corpus['size']:>7} {stage:<12} {summary['seconds']:>9.2f} {inputs_per_second:>9} {tool_fraction:>6.0%} {overhead:>15} {queued:>11}")
+        print(f"{corpus['size']:>7} files: {corpus['seconds']:.2f} seconds, bottleneck {corpus['bottleneck']}, "
+              f"{corpus['spawn_seconds_per_call'] * 1000:.2f} ms to start a tool that does nothing")
+
+
+def parse_tool_latency(text: str) -> Tuple[str, float]:
+    tool, _, latency = text.partition("=")
+    if tool not in TOOLS:
+        raise ValueError(f"Unknown tool {tool}")
+    return tool, float(latency)
+
+
+def parse_args():
+    parser = ArgumentParser(description="Benchmarks the pipeline run by test.py, from scraping the CTS to running amber "
+                            "files, with stand-ins for its tools that return canned outputs after a given latency, to find "
+                            "where the pipeline itself, rather than the tools, limits throughput.")
+
+    parser.add_argument("output", type=str, help="The JSON file to write the results to.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES,
+                        help="The numbers of amber files in the stand-in CTS. Large sizes take hours.")
+    parser.add_argument("--latency", type=float, default=0.0, help="The time in seconds each call of a tool takes.")
+    parser.add_argument("--tool-latency", nargs="+", type=parse_tool_latency, default=[], metavar="TOOL=SECONDS",
+                        help=f"The time in seconds each call of the given tool takes, instead of --latency. The tools are: {', '.join(TOOLS)}.")
+    parser.add_argument("--cfg-blocks", type=int, default=20, help="The number of blocks of the CFG of the canned instance.")
+    parser.add_argument("--fleshing-seeds", nargs="+", type=int, default=[1, 2], help="The seeds each instance is fleshed with.")
+    parser.add_argument("--jobs", type=int, default=1, help="The number of processes fleshing_runner.py uses.")
+    parser.add_argument("--work-folder", type=str,
+                        help="The folder to run the pipeline in, which is a temporary folder by default. It is emptied "
+                        "before each size.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    latencies = dict((tool, args.latency) for tool in TOOLS)
+    latencies.update(args.tool_latency)
+
+    corpora = []
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        for size in args.sizes:
+            corpora.append(run_corpus(size, latencies, args.cfg_blocks, args.fleshing_seeds, args.jobs, args.work_folder or os.path.join(temporary_folder, "work")))
+    results = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()},
+        "options": {"sizes": args.sizes, "latencies": latencies, "cfg_blocks": args.cfg_blocks, "fleshing_seeds": args.fleshing_seeds, "jobs": args.jobs},
+        "corpora": corpora,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
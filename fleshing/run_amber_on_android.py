@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import amber_utils
 import logging
+import os
 import subprocess
 import sys
 
@@ -43,6 +45,17 @@ def execute_amber_on_android(android_serial: Optional[str], amber_file_path: Pat
         # is wrong, e.g. the device is not connected, so it makes sense to exit the testing process completely.
         sys.exit(1)
 
+    # Push any buffer files that the Amber file loads from. They are referenced by name, relative to the Amber file.
+    buffer_files = amber_utils.get_buffer_files(amber_file_path)
+    if len(buffer_files) > 0:
+        cmd = get_adb_prefix(android_serial) + ["push"] + buffer_files + [ANDROID_TEMP_DIR]
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            logger.error(
+                f'Error pushing buffer files to Android device: stopping. Return code: {process.returncode}, stdout: '
+                f'{process.stdout}, stderr: {process.stderr}')
+            sys.exit(1)
+
     amber_command = "./amber -d -t spv1.3 -v 1.1 test.amber"
     cmd = get_adb_prefix(android_serial) + ["shell", f"cd {ANDROID_TEMP_DIR} && " + amber_command]
     process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
@@ -64,6 +77,16 @@ def execute_amber_on_android(android_serial: Optional[str], amber_file_path: Pat
         # Again, this means that something drastic has happened, so it does not make sense to continue.
         sys.exit(1)
 
+    if len(buffer_files) > 0:
+        cmd = get_adb_prefix(android_serial) + ["shell", "rm"] + \
+            [ANDROID_TEMP_DIR + os.path.basename(buffer_file) for buffer_file in buffer_files]
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            logger.error(
+                f'Error removing buffer files from Android device: stopping. Return code: {process.returncode}, '
+                f'stdout: {process.stdout}, stderr: {process.stderr}')
+            sys.exit(1)
+
     return result
 
 